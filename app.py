@@ -6,17 +6,15 @@ from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 import threading
-import schedule
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
+import query_stats
+import structured_logging
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
-
 class Base(DeclarativeBase):
     pass
 
@@ -24,11 +22,99 @@ db = SQLAlchemy(model_class=Base)
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "default_secret_key")
 
-# Configure SQLite database
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///instagram.db"
+# Logging: nivel raíz, niveles por logger ('werkzeug=WARNING,urllib3=ERROR'), formato
+# ('json' o 'text'), fichero opcional, tamaño de la cola (lo que no cabe se descarta)
+# y máximo de líneas INFO/DEBUG por punto del código cada LOG_RATE_WINDOW segundos
+app.config["LOG_LEVEL"] = os.environ.get("LOG_LEVEL", "INFO")
+app.config["LOG_LEVELS"] = os.environ.get("LOG_LEVELS", "urllib3=WARNING,googleapiclient.discovery_cache=ERROR")
+app.config["LOG_FORMAT"] = os.environ.get("LOG_FORMAT", "json")
+app.config["LOG_FILE"] = os.environ.get("LOG_FILE")
+app.config["LOG_QUEUE_SIZE"] = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+app.config["LOG_RATE_LIMIT"] = int(os.environ.get("LOG_RATE_LIMIT", "20"))
+app.config["LOG_RATE_WINDOW"] = float(os.environ.get("LOG_RATE_WINDOW", "60"))
+structured_logging.init_app(app)
+
+# Configure SQLite database (DATABASE_URL permite usar otra base, p. ej. PostgreSQL)
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///instagram.db")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 db.init_app(app)
 
+# Trazas de ejecución: fracción de ejecuciones correctas que se guardan (las lentas y
+# las fallidas se guardan siempre) y número máximo de trazas conservadas por cuenta
+app.config["TRACE_SAMPLE_RATE"] = float(os.environ.get("TRACE_SAMPLE_RATE", "0.25"))
+app.config["TRACE_SLOW_MS"] = int(os.environ.get("TRACE_SLOW_MS", "60000"))
+app.config["TRACE_MAX_PER_ACCOUNT"] = int(os.environ.get("TRACE_MAX_PER_ACCOUNT", "200"))
+
+# Minutos de antelación con los que se prepara cada publicación programada (0 = desactivado)
+app.config["PREFETCH_LEAD_MINUTES"] = int(os.environ.get("PREFETCH_LEAD_MINUTES", "10"))
+
+# Planificador: zona horaria por defecto de los horarios nuevos (vacía = hora local del
+# servidor), minutos de retraso tras los que una ejecución perdida se descarta al arrancar
+# y motor con el que se publican las cuentas vencidas ('threaded' o 'async')
+app.config["SCHEDULE_TIMEZONE"] = os.environ.get("SCHEDULE_TIMEZONE", "")
+app.config["SCHEDULE_MISFIRE_GRACE_MINUTES"] = int(os.environ.get("SCHEDULE_MISFIRE_GRACE_MINUTES", "5"))
+app.config["SCHEDULER_ENGINE"] = os.environ.get("SCHEDULER_ENGINE", "threaded")
+# Sin planificador en este proceso (scripts y benchmarks); /health/ready no lo exige
+app.config["DISABLE_SCHEDULER"] = os.environ.get("DISABLE_SCHEDULER", "").lower() in ("1", "true", "yes")
+
+# Correo saliente (restablecimiento de contraseña). Sin EMAIL_USER/EMAIL_PASSWORD ni
+# SMTP_HOST el envío solo se simula en el log; SMTP_HOST/SMTP_PORT permiten usar un
+# servidor local de pruebas (SMTP_SSL=0)
+app.config["EMAIL_USER"] = os.environ.get("EMAIL_USER")
+app.config["EMAIL_PASSWORD"] = os.environ.get("EMAIL_PASSWORD")
+app.config["EMAIL_FROM"] = os.environ.get("EMAIL_FROM", os.environ.get("EMAIL_USER", "noreply@localhost"))
+app.config["EMAIL_SIMULATE"] = not (app.config["EMAIL_USER"] and app.config["EMAIL_PASSWORD"]) and not os.environ.get("SMTP_HOST")
+app.config["SMTP_HOST"] = os.environ.get("SMTP_HOST", "smtp.gmail.com")
+app.config["SMTP_PORT"] = int(os.environ.get("SMTP_PORT", "465"))
+app.config["SMTP_SSL"] = os.environ.get("SMTP_SSL", "1").lower() in ("1", "true", "yes")
+app.config["SMTP_STARTTLS"] = os.environ.get("SMTP_STARTTLS", "").lower() in ("1", "true", "yes")
+app.config["SMTP_TIMEOUT"] = int(os.environ.get("SMTP_TIMEOUT", "30"))
+# Segundos que la conexión SMTP sigue abierta sin correos que enviar
+app.config["SMTP_IDLE_SECONDS"] = int(os.environ.get("SMTP_IDLE_SECONDS", "120"))
+app.config["EMAIL_BATCH_SIZE"] = int(os.environ.get("EMAIL_BATCH_SIZE", "20"))
+app.config["EMAIL_MAX_ATTEMPTS"] = int(os.environ.get("EMAIL_MAX_ATTEMPTS", "6"))
+app.config["EMAIL_RETRY_BASE_SECONDS"] = int(os.environ.get("EMAIL_RETRY_BASE_SECONDS", "30"))
+
+# Detección de duplicados por hash perceptual: distancia de Hamming máxima y acción
+# a tomar ('skip' para omitir la imagen, 'flag' para publicarla dejando aviso)
+app.config["DUPLICATE_HAMMING_THRESHOLD"] = int(os.environ.get("DUPLICATE_HAMMING_THRESHOLD", "3"))
+app.config["DUPLICATE_ACTION"] = os.environ.get("DUPLICATE_ACTION", "skip")
+
+# Segundos que se reutiliza una página cacheada (/, /dashboard, /config); 0 = sin caché
+app.config["VIEW_CACHE_TTL"] = int(os.environ.get("VIEW_CACHE_TTL", "30"))
+
+# Instrumentación SQL: presupuesto de consultas por petición, umbral de consulta lenta
+# (se registra con su EXPLAIN) y cabeceras X-SQL-* fuera del modo debug
+app.config["SQL_QUERY_BUDGET"] = int(os.environ.get("SQL_QUERY_BUDGET", "20"))
+app.config["SLOW_QUERY_MS"] = float(os.environ.get("SLOW_QUERY_MS", "200"))
+app.config["SQL_STATS_HEADER"] = os.environ.get("SQL_STATS_HEADER", "").lower() in ("1", "true", "yes")
+query_stats.init_app(app)
+
+# Motor asíncrono (async_publisher): llamadas simultáneas por API externa
+app.config["ASYNC_DRIVE_CONCURRENCY"] = int(os.environ.get("ASYNC_DRIVE_CONCURRENCY", "8"))
+app.config["ASYNC_GEMINI_CONCURRENCY"] = int(os.environ.get("ASYNC_GEMINI_CONCURRENCY", "4"))
+app.config["ASYNC_INSTAGRAM_CONCURRENCY"] = int(os.environ.get("ASYNC_INSTAGRAM_CONCURRENCY", "4"))
+
+# Descargas de Drive: tamaño de cada petición por rangos, reintentos por trozo y
+# segmentos en paralelo para ficheros grandes (1 = siempre secuencial)
+app.config["DRIVE_CHUNK_SIZE"] = int(os.environ.get("DRIVE_CHUNK_SIZE", str(4 * 1024 * 1024)))
+app.config["DRIVE_DOWNLOAD_RETRIES"] = int(os.environ.get("DRIVE_DOWNLOAD_RETRIES", "5"))
+app.config["DRIVE_PARALLEL_RANGES"] = int(os.environ.get("DRIVE_PARALLEL_RANGES", "4"))
+app.config["DRIVE_PARALLEL_MIN_BYTES"] = int(os.environ.get("DRIVE_PARALLEL_MIN_BYTES", str(32 * 1024 * 1024)))
+
+# Caché de imágenes compartida entre cuentas (image_cache): directorio y tamaño máximo
+# antes de expulsar las entradas menos usadas; 0 = sin caché
+app.config["IMAGE_CACHE_DIR"] = os.environ.get("IMAGE_CACHE_DIR", os.path.join('.', 'image_cache'))
+app.config["IMAGE_CACHE_MAX_BYTES"] = int(os.environ.get("IMAGE_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+
+# Publicaciones fallidas por un error transitorio (error_codes.RETRYABLE): intentos
+# antes de dar la imagen por fallida y renombrarla en Drive
+app.config["ERROR_RETRY_MAX_ATTEMPTS"] = int(os.environ.get("ERROR_RETRY_MAX_ATTEMPTS", "3"))
+
+# Gemini: modelo y tiempo máximo por llamada de las cuentas que no los configuran
+app.config["GEMINI_MODEL"] = os.environ.get("GEMINI_MODEL", "gemini-1.5-flash")
+app.config["GEMINI_TIMEOUT_SECONDS"] = int(os.environ.get("GEMINI_TIMEOUT_SECONDS", "60"))
+
 # Setup login manager
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -37,28 +123,53 @@ login_manager.login_message = "Por favor inicia sesión para acceder a esta pág
 login_manager.login_message_category = "warning"
 
 # Import models after db initialization to avoid circular imports
-from models import User, Account, PublicationHistory
+from models import User, Account, PublicationHistory, PublicationTrace, PreparedPost, QueueItem, ImageHash, PublicationSlot
 from forms import LoginForm, AdminForm, AccountForm, RequestResetForm, ResetPasswordForm
-from email_utils import send_reset_email
+from email_utils import send_reset_email, email_sender
 import instagram_publisher
+import tracing
+import content_queue
+import scheduling
+import error_codes
+from view_cache import view_cache
+from static_assets import static_assets
+from scheduler_state import scheduler_state
+from gemini_pool import gemini_pool, fingerprint
+from image_cache import image_cache
+
+# Las páginas cacheadas se invalidan al escribir historial, cuentas, horarios o cola de contenido
+view_cache.init_app(app, [PublicationHistory, Account, QueueItem, PublicationSlot])
+
+# URLs con hash y cabeceras de caché inmutable para los recursos de build_static.py
+static_assets.init_app(app)
 
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
 
 @app.route('/')
+@view_cache.cached
 def index():
     accounts = Account.query.all()
     account_stats = []
 
+    # Recuentos y última publicación de todas las cuentas en dos consultas agrupadas
+    counts = {(account_id, status): count for account_id, status, count in db.session.query(
+        PublicationHistory.account_id, PublicationHistory.status, db.func.count()
+    ).filter(PublicationHistory.status.in_(('success', 'error'))).group_by(
+        PublicationHistory.account_id, PublicationHistory.status).all()}
+    latest_by_account = dict(db.session.query(
+        PublicationHistory.account_id, db.func.max(PublicationHistory.timestamp)
+    ).group_by(PublicationHistory.account_id).all())
+
     for account in accounts:
         # Get success and error counts for each account
-        success_count = PublicationHistory.query.filter_by(account_id=account.id, status='success').count()
-        error_count = PublicationHistory.query.filter_by(account_id=account.id, status='error').count()
+        success_count = counts.get((account.id, 'success'), 0)
+        error_count = counts.get((account.id, 'error'), 0)
         total_count = success_count + error_count
 
         # Get latest publication
-        latest = PublicationHistory.query.filter_by(account_id=account.id).order_by(PublicationHistory.timestamp.desc()).first()
+        latest = latest_by_account.get(account.id)
 
         account_stats.append({
             'id': account.id,
@@ -67,7 +178,7 @@ def index():
             'success_count': success_count,
             'error_count': error_count,
             'total_count': total_count,
-            'latest': latest.timestamp if latest else None
+            'latest': latest
         })
 
     return render_template('index.html', account_stats=account_stats)
@@ -106,6 +217,7 @@ def logout():
 
 @app.route('/dashboard')
 @login_required
+@view_cache.cached
 def dashboard():
     accounts = Account.query.all()
 
@@ -126,26 +238,23 @@ def dashboard():
         (db.extract('year', PublicationHistory.timestamp) == current_year)
     ).count()
 
-    # Verificar estado del planificador
-    has_schedules = False
-    scheduled_tasks = []
-    for account in accounts:
-        if account.morning_post and account.morning_time:
-            has_schedules = True
-            scheduled_tasks.append(f"Cuenta {account.name}: Mañana a las {account.morning_time}")
-        if account.afternoon_post and account.afternoon_time:
-            has_schedules = True
-            scheduled_tasks.append(f"Cuenta {account.name}: Tarde a las {account.afternoon_time}")
-        if account.evening_post and account.evening_time:
-            has_schedules = True
-            scheduled_tasks.append(f"Cuenta {account.name}: Noche a las {account.evening_time}")
-
-    scheduler_status = "activo" if has_schedules else "sin tareas programadas"
-    logging.info(f"Estado del planificador: {scheduler_status}")
-    if has_schedules:
-        logging.info(f"Tareas programadas ({len(scheduled_tasks)}):")
-        for task in scheduled_tasks:
-            logging.info(f"  - {task}")
+    # Errores de los últimos 7 días por código y cuenta (índice ix_history_error_code)
+    since = datetime.utcnow() - timedelta(days=7)
+    error_rows = db.session.query(
+        PublicationHistory.error_code, PublicationHistory.account_id, db.func.count()
+    ).filter(
+        PublicationHistory.error_code.isnot(None), PublicationHistory.timestamp >= since
+    ).group_by(PublicationHistory.error_code, PublicationHistory.account_id).all()
+    account_names = {account.id: account.name for account in accounts}
+    error_breakdown = {}
+    for code, account_id, count in error_rows:
+        entry = error_breakdown.setdefault(code, {'code': code, 'label': error_codes.label(code), 'total': 0, 'accounts': []})
+        entry['total'] += count
+        entry['accounts'].append((account_names.get(account_id, account_id), count))
+    error_breakdown = sorted(error_breakdown.values(), key=lambda entry: entry['total'], reverse=True)
+
+    # Estado del planificador en memoria (sin consultar los horarios en la base)
+    scheduler = scheduler_state.snapshot(limit=10)
 
     return render_template('dashboard.html', 
                            accounts=accounts,
@@ -154,15 +263,65 @@ def dashboard():
                            error_posts=error_posts,
                            recent_publications=recent_publications,
                            monthly_posts=monthly_posts,
-                           scheduler_status=scheduler_status)
+                           error_breakdown=error_breakdown,
+                           scheduler=scheduler)
+
+@app.route('/api/scheduler')
+@login_required
+def scheduler_api():
+    """Trabajos programados, latido del hilo y retraso del planificador (desde memoria)"""
+    return jsonify(scheduler_state.snapshot())
+
+@app.route('/api/gemini')
+@login_required
+def gemini_api():
+    """Latencia y errores de las llamadas a Gemini por clave de API (identificada por su huella)"""
+    stats = gemini_pool.stats()
+    keys = {}
+    for account in Account.query.all():
+        key = fingerprint(account.gemini_api_key)
+        entry = keys.setdefault(key, {'key': key, 'accounts': [], **stats.get(key, {'calls': 0})})
+        entry['accounts'].append({'id': account.id, 'name': account.name,
+                                  'model': account.gemini_model or app.config["GEMINI_MODEL"]})
+    return jsonify(list(keys.values()))
+
+@app.route('/api/image-cache')
+@login_required
+def image_cache_api():
+    """Tamaño, aciertos y expulsiones de la caché de imágenes compartida"""
+    return jsonify(image_cache.stats())
+
+@app.route('/health/ready')
+def readiness():
+    """Sonda de disponibilidad: base de datos accesible y planificador vivo (si está activado)"""
+    checks = {}
+    try:
+        db.session.execute(db.text('SELECT 1'))
+        checks['database'] = 'ok'
+    except Exception as e:
+        db.session.rollback()
+        checks['database'] = f"error: {str(e)}"
+
+    if app.config["DISABLE_SCHEDULER"]:
+        checks['scheduler'] = 'disabled'
+    else:
+        checks['scheduler'] = 'ok' if scheduler_state.alive() else 'stale'
+
+    ready = checks['database'] == 'ok' and checks['scheduler'] != 'stale'
+    return jsonify({'status': 'ready' if ready else 'unavailable', 'checks': checks}), 200 if ready else 503
 
 @app.route('/config', methods=['GET', 'POST'])
 @login_required
+@view_cache.cached
 def config():
-    accounts = Account.query.all()
+    accounts = Account.query.options(db.selectinload(Account.slots)).all()
     account_count = len(accounts)
     can_add_more = account_count < 4
-    return render_template('config.html', accounts=accounts, can_add_more=can_add_more, account_count=account_count)
+    queue_pending = content_queue.pending_counts()
+    slot_names = {label: name for label, name, _ in scheduling.FORM_SLOTS}
+    return render_template('config.html', accounts=accounts, can_add_more=can_add_more, account_count=account_count,
+                           queue_pending=queue_pending, slot_names=slot_names,
+                           weekday_labels=scheduling.weekday_labels)
 
 @app.route('/account/new', methods=['GET', 'POST'])
 @login_required
@@ -182,22 +341,22 @@ def new_account():
             instagram_password=form.instagram_password.data,
             folder_id=form.folder_id.data,
             gemini_api_key=form.gemini_api_key.data,
+            gemini_model=form.gemini_model.data or None,
+            gemini_timeout=form.gemini_timeout.data,
             google_credentials=form.google_credentials.data,
             gemini_prompt=form.gemini_prompt.data,
-            morning_post=form.morning_post.data,
-            morning_time=form.morning_time.data,
-            afternoon_post=form.afternoon_post.data,
-            afternoon_time=form.afternoon_time.data,
-            evening_post=form.evening_post.data,
-            evening_time=form.evening_time.data
+            posts_per_slot=form.posts_per_slot.data,
+            queue_order=form.queue_order.data,
+            queue_seed=form.queue_seed.data or 0
         )
 
         db.session.add(account)
+        scheduling.sync_account_slots(account, slot_values(form))
         db.session.commit()
 
-        # Recargar el planificador para incluir la nueva cuenta
-        logging.info("Recargando el planificador para incluir la nueva cuenta")
-        initialize_tasks()
+        # El planificador recoge los horarios nuevos sin recargar los demás
+        scheduler_state.update_account(account)
+        scheduler_wakeup.set()
 
         # Mostrar un mensaje especial cuando se alcance el límite
         new_count = Account.query.count()
@@ -208,6 +367,9 @@ def new_account():
 
         return redirect(url_for('config'))
 
+    if request.method == 'GET':
+        form.timezone.data = app.config["SCHEDULE_TIMEZONE"]
+
     return render_template('config.html', form=form, edit_mode=False)
 
 @app.route('/account/edit/<int:account_id>', methods=['GET', 'POST'])
@@ -222,26 +384,39 @@ def edit_account(account_id):
         account.instagram_username = form.instagram_username.data
         account.instagram_password = form.instagram_password.data
         account.folder_id = form.folder_id.data
+        if account.gemini_api_key != form.gemini_api_key.data:
+            gemini_pool.discard(account.gemini_api_key)
         account.gemini_api_key = form.gemini_api_key.data
+        account.gemini_model = form.gemini_model.data or None
+        account.gemini_timeout = form.gemini_timeout.data
         account.gemini_prompt = form.gemini_prompt.data
 
-        # Actualizar configuración de horarios
-        account.morning_post = form.morning_post.data
-        account.morning_time = form.morning_time.data
-        account.afternoon_post = form.afternoon_post.data
-        account.afternoon_time = form.afternoon_time.data
-        account.evening_post = form.evening_post.data
-        account.evening_time = form.evening_time.data
+        # Actualizar configuración de horarios (solo se recalculan los que cambian)
+        changed_slots = scheduling.sync_account_slots(account, slot_values(form))
+
+        # Cola de contenido: si cambia el criterio de orden se reordenan los pendientes
+        reorder_queue = (account.queue_order != form.queue_order.data
+                         or (account.queue_seed or 0) != (form.queue_seed.data or 0))
+        account.posts_per_slot = form.posts_per_slot.data
+        account.queue_order = form.queue_order.data
+        account.queue_seed = form.queue_seed.data or 0
 
         db.session.commit()
 
-        # Recargar el planificador para aplicar los cambios inmediatamente
-        logging.info("Recargando el planificador para aplicar los cambios de horario")
-        initialize_tasks()
+        if reorder_queue:
+            content_queue.reorder(account)
+
+        if changed_slots:
+            logging.info(f"Cuenta {account.name}: {changed_slots} horarios actualizados")
+            scheduler_wakeup.set()
+        scheduler_state.update_account(account)
 
-        flash('Cuenta actualizada correctamente y planificador recargado', 'success')
+        flash('Cuenta actualizada correctamente', 'success')
         return redirect(url_for('config'))
 
+    if request.method == 'GET':
+        fill_slot_fields(form, account)
+
     return render_template('config.html', form=form, edit_mode=True, account=account)
 
 @app.route('/account/delete/<int:account_id>', methods=['POST'])
@@ -251,10 +426,16 @@ def delete_account(account_id):
 
     # Delete related publication history
     PublicationHistory.query.filter_by(account_id=account.id).delete()
+    PublicationTrace.query.filter_by(account_id=account.id).delete()
+    QueueItem.query.filter_by(account_id=account.id).delete()
+    ImageHash.query.filter_by(account_id=account.id).delete()
+    for prepared in PreparedPost.query.filter_by(account_id=account.id).all():
+        instagram_publisher.discard_prepared_post(prepared)
 
     # Delete account
     db.session.delete(account)
     db.session.commit()
+    scheduler_state.remove_account(account_id)
 
     flash('Cuenta eliminada correctamente', 'success')
     return redirect(url_for('config'))
@@ -267,23 +448,15 @@ def run_script(account_id):
     try:
         logging.info(f"Ejecutando script para la cuenta: {account.name}")
 
-        # Clean up and validate Google credentials
-        google_creds = account.google_credentials.strip()
-        padding = 4 - (len(google_creds) % 4) if len(google_creds) % 4 else 0
-        google_creds += "=" * padding
-
-        # Create temporary credentials file
-        temp_creds_path = os.path.join(os.getcwd(), f"temp_credentials_{account.id}.json")
-        logging.info(f"Creando archivo temporal de credenciales en: {temp_creds_path}")
+        temp_creds_path = None
 
         try:
-            # Decode and write Google credentials
-            decoded_creds = base64.b64decode(google_creds)
-
-            with open(temp_creds_path, "wb") as f:
-                f.write(decoded_creds)
+            # Create temporary credentials file
+            temp_creds_path = write_credentials_file(account)
+            logging.info(f"Archivo temporal de credenciales creado en: {temp_creds_path}")
 
             # Run the script with account info
+            started_at = datetime.utcnow()
             try:
                 result = instagram_publisher.publish_for_account(
                     account_id=account.id,
@@ -294,9 +467,11 @@ def run_script(account_id):
                     credentials_path=temp_creds_path
                 )
             except Exception as e:
-                # Si hay un error pero la publicación ya pudo completarse
-                if "token '<'" in str(e) or "is not valid JSON" in str(e):
-                    # Este es un error de timeout o respuesta no JSON después de la publicación
+                # Si hay un error pero la publicación ya pudo completarse: el checkpoint
+                # guarda el media ID y el renombrado se reintenta en la próxima ejecución
+                # Solo cuentan las imágenes publicadas en esta ejecución
+                if PreparedPost.query.filter(PreparedPost.account_id == account.id, PreparedPost.stage == 'posted',
+                                             PreparedPost.updated_at >= started_at).count():
                     logging.warning(f"Se completó la publicación pero hubo un error posterior: {str(e)}")
                     result = {'status': 'partial_success', 'message': 'Imagen publicada en Instagram, pero hubo un error al finalizar el proceso. El archivo en Google Drive podría no haberse renombrado.'}
                 else:
@@ -314,7 +489,7 @@ def run_script(account_id):
 
         finally:
             # Clean up temporary file
-            if os.path.exists(temp_creds_path):
+            if temp_creds_path and os.path.exists(temp_creds_path):
                 os.remove(temp_creds_path)
                 logging.info("Archivo temporal de credenciales eliminado")
 
@@ -329,37 +504,123 @@ def history():
 
     if account_id:
         account = Account.query.get_or_404(account_id)
-        publications = PublicationHistory.query.filter_by(account_id=account_id).order_by(PublicationHistory.timestamp.desc()).all()
-        return render_template('history.html', publications=publications, account=account, accounts=Account.query.all())
+        publications = PublicationHistory.query.options(db.joinedload(PublicationHistory.error_message)) \
+            .filter_by(account_id=account_id).order_by(PublicationHistory.timestamp.desc()).all()
     else:
         # Show all publications
-        publications = PublicationHistory.query.order_by(PublicationHistory.timestamp.desc()).all()
-        return render_template('history.html', publications=publications, account=None, accounts=Account.query.all())
+        account = None
+        publications = PublicationHistory.query.options(db.joinedload(PublicationHistory.error_message)) \
+            .order_by(PublicationHistory.timestamp.desc()).all()
 
-def run_publication_for_account(account_id):
-    """Run the publication script for a specific account within an app context"""
+    # Solo se enlazan las ejecuciones cuya traza se guardó (las demás se descartan por muestreo)
+    run_ids = {pub.run_id for pub in publications if pub.run_id}
+    traced_runs = set()
+    if run_ids:
+        traced_runs = {row.run_id for row in db.session.query(PublicationTrace.run_id).filter(PublicationTrace.run_id.in_(run_ids))}
+
+    return render_template('history.html', publications=publications, account=account, accounts=Account.query.all(), traced_runs=traced_runs)
+
+@app.route('/history/trace/<string:run_id>')
+@login_required
+def trace_detail(run_id):
+    trace = PublicationTrace.query.filter_by(run_id=run_id).first_or_404()
+    spans = tracing.decode_spans(trace.spans)
+
+    # Totales por tipo de paso para ver de un vistazo dónde se fue el tiempo
+    totals = {}
+    for span in spans:
+        total = totals.setdefault(span['name'], {'name': span['name'], 'count': 0, 'duration_ms': 0, 'bytes': 0})
+        total['count'] += 1
+        total['duration_ms'] += span['duration_ms']
+        total['bytes'] += span['bytes'] or 0
+    totals = sorted(totals.values(), key=lambda t: t['duration_ms'], reverse=True)
+
+    return render_template('trace.html', trace=trace, spans=spans, totals=totals,
+                           total_ms=max(trace.duration_ms or 0, 1))
+
+def slot_values(form):
+    """Horarios del formulario de cuenta en el formato de scheduling.sync_account_slots"""
+    values = {}
+    for label, _, default_time in scheduling.FORM_SLOTS:
+        enabled = getattr(form, f"{label}_post").data
+        time_of_day = getattr(form, f"{label}_time").data or default_time
+        weekdays = sum(1 << day for day in getattr(form, f"{label}_days").data or [])
+        values[label] = (bool(enabled), time_of_day, weekdays, form.timezone.data or '')
+    return values
+
+def fill_slot_fields(form, account):
+    """Rellena los campos de horario del formulario con los horarios de la cuenta"""
+    slots = {slot.label: slot for slot in account.slots}
+    for label, _, default_time in scheduling.FORM_SLOTS:
+        slot = slots.get(label)
+        getattr(form, f"{label}_post").data = slot.enabled if slot else False
+        getattr(form, f"{label}_time").data = slot.time_of_day if slot else default_time
+        weekdays = slot.weekdays if slot else scheduling.ALL_DAYS
+        getattr(form, f"{label}_days").data = [day for day in range(7) if weekdays & (1 << day)]
+    form.timezone.data = next((slot.timezone for slot in account.slots if slot.timezone), '')
+
+def write_credentials_file(account, suffix=''):
+    """Decodifica las credenciales de Google de la cuenta en un fichero temporal y devuelve su ruta"""
+    # Clean up and validate Google credentials
+    google_creds = account.google_credentials.strip()
+    padding = 4 - (len(google_creds) % 4) if len(google_creds) % 4 else 0
+    google_creds += "=" * padding
+
+    temp_creds_path = os.path.join(os.getcwd(), f"temp_credentials_{account.id}{suffix}.json")
+    with open(temp_creds_path, "wb") as f:
+        f.write(base64.b64decode(google_creds))
+    return temp_creds_path
+
+def prefetch_for_account(account_id):
+    """Prepara la próxima publicación de una cuenta antes de su hora programada"""
     with app.app_context():
         account = Account.query.get(account_id)
         if not account:
             logging.error(f"Account with ID {account_id} not found")
             return
 
-        logging.info(f"Running scheduled publication for account: {account.name}")
+        logging.info(f"Precargando la próxima publicación de la cuenta: {account.name}")
+        temp_creds_path = None
 
         try:
-            # Clean up and validate Google credentials
-            google_creds = account.google_credentials.strip()
-            padding = 4 - (len(google_creds) % 4) if len(google_creds) % 4 else 0
-            google_creds += "=" * padding
+            temp_creds_path = write_credentials_file(account, suffix='_prefetch')
+            result = instagram_publisher.prefetch_for_account(
+                account_id=account.id,
+                instagram_username=account.instagram_username,
+                instagram_password=account.instagram_password,
+                folder_id=account.folder_id,
+                gemini_api_key=account.gemini_api_key,
+                credentials_path=temp_creds_path
+            )
+            logging.info(f"Resultado de la precarga: {result}")
 
-            # Create temporary credentials file
-            temp_creds_path = os.path.join(os.getcwd(), f"temp_credentials_{account.id}.json")
+        except Exception as e:
+            logging.error(f"Error durante la precarga: {str(e)}", exc_info=True)
+
+        finally:
+            if temp_creds_path and os.path.exists(temp_creds_path):
+                os.remove(temp_creds_path)
+
+def run_in_background(job_func, **kwargs):
+    """Lanza un trabajo en un hilo aparte para no retrasar el resto de tareas del planificador"""
+    threading.Thread(target=job_func, kwargs=kwargs, daemon=True).start()
+
+def run_publication_for_account(account_id):
+    """Run the publication script for a specific account within an app context"""
+    with app.app_context():
+        account = Account.query.get(account_id)
+        if not account:
+            logging.error(f"Account with ID {account_id} not found")
+            return {"status": "error", "message": f"Account with ID {account_id} not found"}
 
-            # Decode and write Google credentials
-            decoded_creds = base64.b64decode(google_creds)
+        logging.info(f"Running scheduled publication for account: {account.name}")
 
-            with open(temp_creds_path, "wb") as f:
-                f.write(decoded_creds)
+        temp_creds_path = None
+        result = None
+
+        try:
+            # Create temporary credentials file
+            temp_creds_path = write_credentials_file(account)
 
             # Run the script with account info
             result = instagram_publisher.publish_for_account(
@@ -368,89 +629,134 @@ def run_publication_for_account(account_id):
                 instagram_password=account.instagram_password,
                 folder_id=account.folder_id,
                 gemini_api_key=account.gemini_api_key,
-                credentials_path=temp_creds_path
+                credentials_path=temp_creds_path,
+                trigger='scheduled'
             )
 
             logging.info(f"Scheduled publication result: {result}")
 
         except Exception as e:
             logging.error(f"Error during scheduled publication: {str(e)}", exc_info=True)
+            result = {"status": "error", "message": str(e)}
 
         finally:
             # Clean up temporary file
-            if os.path.exists(temp_creds_path):
+            if temp_creds_path and os.path.exists(temp_creds_path):
                 os.remove(temp_creds_path)
 
+        return result
+
+def run_async_publication(account_ids):
+    """Publica varias cuentas a la vez con el motor asíncrono"""
+    import async_publisher  # importa app, por eso no se carga al inicio
+    results = async_publisher.publish_accounts(account_ids)
+    for account_id, result in results.items():
+        logging.info(f"Scheduled publication result (cuenta {account_id}): {result}")
+    return results
+
+def run_tracked(slot_ids, job_func, **kwargs):
+    """Ejecuta una publicación programada anotando en scheduler_state su duración y resultado"""
+    started_at = datetime.utcnow()
+    start = time.perf_counter()
+    scheduler_state.run_started(slot_ids)
+    outcome = 'error'
+    try:
+        result = job_func(**kwargs)
+        if job_func is run_async_publication:
+            # Un resultado por cuenta: basta un error para marcar la ejecución conjunta
+            statuses = {r.get('status') for r in result.values() if isinstance(r, dict)}
+            outcome = 'error' if 'error' in statuses or not statuses else 'success'
+        elif isinstance(result, dict):
+            outcome = result.get('status', 'error')
+    finally:
+        duration_ms = int((time.perf_counter() - start) * 1000)
+        scheduler_state.run_finished(slot_ids, outcome, started_at, duration_ms)
+
+# Despierta el bucle del planificador cuando cambia algún horario
+scheduler_wakeup = threading.Event()
+
 def initialize_tasks():
-    """Initialize and schedule publication tasks for all accounts"""
+    """Prepara los horarios al arrancar el planificador.
+
+    Las ejecuciones perdidas mientras la aplicación estaba parada se descartan si
+    llevan más de SCHEDULE_MISFIRE_GRACE_MINUTES de retraso (como hacía schedule).
+    """
     with app.app_context():
-        accounts = Account.query.all()
-
-        # Clear existing jobs
-        schedule.clear()
-
-        # Log all schedules for debugging
-        log_schedules = []
-
-        for account in accounts:
-            # Morning post
-            if account.morning_post and account.morning_time:
-                schedule.every().day.at(account.morning_time).do(
-                    run_publication_for_account, account_id=account.id
-                ).tag(f"account_{account.id}")
-                log_schedules.append(f"Cuenta {account.name}: Mañana a las {account.morning_time}")
-
-            # Afternoon post
-            if account.afternoon_post and account.afternoon_time:
-                schedule.every().day.at(account.afternoon_time).do(
-                    run_publication_for_account, account_id=account.id
-                ).tag(f"account_{account.id}")
-                log_schedules.append(f"Cuenta {account.name}: Tarde a las {account.afternoon_time}")
-
-            # Evening post
-            if account.evening_post and account.evening_time:
-                schedule.every().day.at(account.evening_time).do(
-                    run_publication_for_account, account_id=account.id
-                ).tag(f"account_{account.id}")
-                log_schedules.append(f"Cuenta {account.name}: Noche a las {account.evening_time}")
-
-        if log_schedules:
-            logging.info(f"Tareas programadas ({len(log_schedules)}):")
-            for schedule_log in log_schedules:
-                logging.info(f"  - {schedule_log}")
+        now = datetime.utcnow()
+        grace = timedelta(minutes=app.config["SCHEDULE_MISFIRE_GRACE_MINUTES"])
+        stale = PublicationSlot.query.filter(db.or_(
+            PublicationSlot.next_run_at < now - grace,
+            db.and_(PublicationSlot.enabled.is_(True), PublicationSlot.next_run_at.is_(None))
+        )).all()
+        for slot in stale:
+            if slot.next_run_at is not None:
+                logging.warning(f"Ejecución perdida de la cuenta {slot.account_id} a las {slot.time_of_day}: se programa la siguiente")
+            scheduling.reschedule(slot, now)
+        db.session.commit()
+
+        active = PublicationSlot.query.options(db.joinedload(PublicationSlot.account)).filter(
+            PublicationSlot.next_run_at.isnot(None)).all()
+        scheduler_state.load(active)
+        if active:
+            logging.info(f"Horarios programados: {len(active)}")
         else:
             logging.warning("No se encontraron horarios para programar publicaciones")
 
+def run_due_slots():
+    """Lanza las precargas y publicaciones vencidas y programa su siguiente ejecución.
+
+    Devuelve el retraso (segundos) del horario vencido más antiguo, o None si no había ninguno.
+    """
+    now = datetime.utcnow()
+    due = scheduling.due_slots(now)
+    prefetches = [slot for slot in scheduling.due_prefetches(now) if slot not in due]
+    dispatch_lag = max(((now - slot.next_run_at).total_seconds() for slot in due), default=None)
+
+    for slot in prefetches:
+        slot.prefetch_at = None
+    slots_by_account = {}
+    for slot in due:
+        logging.info(f"Ejecutando horario {slot.time_of_day} de la cuenta {slot.account_id}")
+        scheduling.advance(slot, now)
+        slots_by_account.setdefault(slot.account_id, []).append(slot.id)
+    # Se guarda antes de lanzar los trabajos para que ningún horario se ejecute dos veces
+    db.session.commit()
+    for slot in due:
+        scheduler_state.update_slot(slot)
+
+    # La precarga y la publicación de una misma cuenta se esperan entre sí
+    # (instagram_publisher.exclusive_account), así que se lanzan sin más
+    for account_id in {slot.account_id for slot in prefetches}:
+        run_in_background(prefetch_for_account, account_id=account_id)
+    if not slots_by_account:
+        return dispatch_lag
+    if app.config["SCHEDULER_ENGINE"] == 'async':
+        slot_ids = [slot_id for ids in slots_by_account.values() for slot_id in ids]
+        run_in_background(run_tracked, slot_ids=slot_ids, job_func=run_async_publication,
+                          account_ids=list(slots_by_account))
+    else:
+        for account_id, slot_ids in slots_by_account.items():
+            run_in_background(run_tracked, slot_ids=slot_ids, job_func=run_publication_for_account,
+                              account_id=account_id)
+    return dispatch_lag
+
 def schedule_tasks():
     """Schedule task execution in an infinite loop"""
     # Run the scheduler loop
     while True:
         try:
             with app.app_context():
-                pending_jobs = schedule.get_jobs()
-                now = datetime.now()
-                current_time = now.strftime("%H:%M")
-
-                if pending_jobs:
-                    logging.debug(f"Comprobando {len(pending_jobs)} tareas programadas a las {current_time}")
-
-                    # Log more detailed information about each job
-                    for job in pending_jobs:
-                        next_run = job.next_run
-                        time_diff = (next_run - now).total_seconds() if next_run else None
-                        should_run = time_diff is not None and time_diff <= 0
-
-                        if should_run:
-                            logging.info(f"Ejecutando tarea: {job.tags}")
-
-                        # Log detailed info about all jobs every 15 minutes
-                        if now.minute % 15 == 0:
-                            logging.debug(f"Tarea: {job.tags}, Próxima ejecución: {next_run}, Debe ejecutarse ahora: {should_run}")
-
-                schedule.run_pending()
-            time.sleep(60)  # Check every minute
+                dispatch_lag = run_due_slots()
+                wakeup = scheduling.next_wakeup()
+            scheduler_state.tick(dispatch_lag)
+
+            # Dormir hasta el próximo horario (como mucho un minuto) o hasta que se edite alguno
+            idle_seconds = 60 if wakeup is None else (wakeup - datetime.utcnow()).total_seconds()
+            scheduler_wakeup.wait(min(60, max(1, idle_seconds)))
+            scheduler_wakeup.clear()
         except Exception as e:
             logging.error(f"Error en el planificador: {str(e)}")
+            scheduler_state.tick(error=str(e))
             time.sleep(60)  # Continuar a pesar de errores
 
 def start_scheduler():
@@ -461,8 +767,16 @@ def start_scheduler():
     # Luego iniciar el bucle del planificador en un hilo separado
     scheduler_thread = threading.Thread(target=schedule_tasks, daemon=True)
     scheduler_thread.start()
+    scheduler_state.started(scheduler_thread)
     logging.info("Scheduler started in background thread")
 
+    if app.config["SCHEDULER_ENGINE"] == 'async':
+        import async_publisher  # importa app, por eso no se carga al inicio
+        async_publisher.check_http_support()
+
+    # Enviar los correos que quedaran pendientes de una ejecución anterior
+    email_sender.start()
+
 # Rutas para el restablecimiento de contraseña
 @app.route('/reset_request', methods=['GET', 'POST'])
 def reset_request():
@@ -505,35 +819,65 @@ def reset_password(token, user_id):
 
     return render_template('reset_password.html', form=form)
 
+# Columnas añadidas a tablas ya existentes: (tabla, columna, definición SQL)
+COLUMN_MIGRATIONS = [
+    ('account', 'gemini_prompt',
+     "TEXT DEFAULT "
+     "'Describe la imagen que te envío con un texto continuo ideal para un pie de foto en Instagram. Identifica la especie del ave y proporciona detalles sobre su aspecto, hábitat y distribución, manteniendo un tono natural, atractivo y animado. Incluye emojis y hashtags adecuados para resaltar la belleza de la naturaleza y la fotografía de aves. Con enfoque en la fotografía. Responde únicamente con el texto solicitado, sin añadir introducciones ni comentarios adicionales.'"),
+    ('publication_history', 'run_id', 'VARCHAR(32)'),
+    ('account', 'posts_per_slot', 'INTEGER DEFAULT 1'),
+    ('account', 'queue_order', "VARCHAR(20) DEFAULT 'name'"),
+    ('account', 'queue_seed', 'INTEGER DEFAULT 0'),
+    ('prepared_post', 'stage', "VARCHAR(20) NOT NULL DEFAULT 'pending'"),
+    ('prepared_post', 'media_id', 'VARCHAR(64)'),
+    ('prepared_post', 'updated_at', 'DATETIME'),
+    ('account', 'gemini_model', 'VARCHAR(64)'),
+    ('account', 'gemini_timeout', 'INTEGER'),
+    ('publication_history', 'error_code', 'VARCHAR(32)'),
+    ('publication_history', 'error_message_id', 'INTEGER REFERENCES error_message(id)'),
+    ('content_queue', 'attempts', 'INTEGER NOT NULL DEFAULT 0'),
+]
+
 # Initialize the database and handle migrations
 with app.app_context():
     try:
-        # Verificar si necesitamos añadir la columna gemini_prompt
+        # Verificar qué columnas faltan en las tablas existentes
         inspector = db.inspect(db.engine)
-        columns = [col['name'] for col in inspector.get_columns('account')] if inspector.has_table('account') else []
-        needs_gemini_prompt = 'gemini_prompt' not in columns and inspector.has_table('account')
+        pending_columns = [
+            (table, column, ddl) for table, column, ddl in COLUMN_MIGRATIONS
+            if inspector.has_table(table) and column not in [col['name'] for col in inspector.get_columns(table)]
+        ]
 
         # Crear tablas base
         db.create_all()
         logging.info("Base de datos inicializada correctamente")
 
-        # Migración manual para añadir columna gemini_prompt si es necesario
-        if needs_gemini_prompt:
+        # Migración manual para añadir las columnas que falten
+        for table, column, ddl in pending_columns:
             try:
-                # Migración manual para SQLite (añadir columna)
                 with db.engine.connect() as conn:
-                    conn.execute(db.text(
-                        "ALTER TABLE account ADD COLUMN gemini_prompt TEXT DEFAULT "
-                        "'Describe la imagen que te envío con un texto continuo ideal para un pie de foto en Instagram. Identifica la especie del ave y proporciona detalles sobre su aspecto, hábitat y distribución, manteniendo un tono natural, atractivo y animado. Incluye emojis y hashtags adecuados para resaltar la belleza de la naturaleza y la fotografía de aves. Con enfoque en la fotografía. Responde únicamente con el texto solicitado, sin añadir introducciones ni comentarios adicionales.'"
-                    ))
+                    conn.execute(db.text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
                     conn.commit()
 
-                logging.info("Migración completada: columna gemini_prompt añadida correctamente")
+                logging.info(f"Migración completada: columna {column} añadida a {table}")
             except Exception as migration_error:
                 logging.error(f"Error en migración: {str(migration_error)}")
 
+        # Horarios: pasar las antiguas columnas fijas de account a publication_slot
+        scheduling.migrate_fixed_slots()
+
+        # Errores guardados como texto libre antes de existir error_code (solo una vez)
+        if any(column == 'error_code' for _, column, _ in pending_columns):
+            error_codes.backfill()
+
+        # Crear los índices de columnas añadidas por migración (create_all no toca tablas existentes)
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=db.engine, checkfirst=True)
+
     except Exception as e:
         logging.error(f"Error al inicializar la base de datos: {str(e)}")
 
-# Iniciar el planificador en un hilo separado
-start_scheduler()
\ No newline at end of file
+# Iniciar el planificador en un hilo separado (DISABLE_SCHEDULER=1 para scripts y benchmarks)
+if not app.config["DISABLE_SCHEDULER"]:
+    start_scheduler()
\ No newline at end of file
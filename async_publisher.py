@@ -0,0 +1,522 @@
+"""Motor de publicación asíncrono: muchas cuentas a la vez en un único event loop.
+
+Es una variante de instagram_publisher.publish_for_account con los mismos pasos
+(cola, checkpoints, duplicados, trazas), pero:
+
+- Drive y Gemini se llaman por HTTP asíncrono (aiohttp, dependencia del proyecto).
+  Si aiohttp no está instalado, las llamadas bloqueantes de googleapiclient/genai
+  se ejecutan en un executor y se registra un error (check_http_support).
+- instagrapi es bloqueante: sus llamadas van a un ThreadPoolExecutor acotado.
+- Cada API externa tiene su propio semáforo (ASYNC_DRIVE_CONCURRENCY,
+  ASYNC_GEMINI_CONCURRENCY, ASYNC_INSTAGRAM_CONCURRENCY).
+- Todo el acceso a la base de datos pasa por un único hilo con su propio app
+  context, de modo que la sesión de SQLAlchemy nunca se comparte entre hilos.
+
+Uso: python async_publisher.py 1 2 3   (IDs de cuenta; sin argumentos, todas)
+"""
+import asyncio
+import base64
+import contextvars
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from google.oauth2 import service_account
+import google.auth.transport.requests
+
+from app import app, db, write_credentials_file
+from models import Account, PreparedPost, PublicationHistory, QueueItem
+import content_queue
+import drive_download
+import error_codes
+import image_index
+import instagram_publisher
+import structured_logging
+import tracing
+from gemini_pool import gemini_pool
+from image_cache import image_cache
+
+DRIVE_API = 'https://www.googleapis.com/drive/v3/files'
+GEMINI_API = 'https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent'
+DRIVE_SCOPES = ['https://www.googleapis.com/auth/drive']
+# Cada cuánto se vuelve a intentar tomar el cerrojo de una cuenta ocupada por su precarga
+ACCOUNT_LOCK_POLL_SECONDS = 0.5
+
+_warned_without_aiohttp = False
+
+
+def check_http_support():
+    """Avisa (una vez por proceso) si falta aiohttp: Drive y Gemini irían por hilos"""
+    global _warned_without_aiohttp
+    if aiohttp is None and not _warned_without_aiohttp:
+        _warned_without_aiohttp = True
+        logging.error("aiohttp no está instalado: el motor asíncrono llamará a Drive y Gemini con "
+                      "googleapiclient/genai en hilos. Instala las dependencias de pyproject.toml (uv sync)")
+    return aiohttp is not None
+
+
+class HttpDrive:
+    """Cliente de la API REST de Drive sobre aiohttp"""
+
+    def __init__(self, http, credentials_path, executor):
+        self.http = http
+        self.credentials = service_account.Credentials.from_service_account_file(credentials_path, scopes=DRIVE_SCOPES)
+        self.executor = executor
+
+    async def _headers(self):
+        if not self.credentials.valid:
+            # El refresco del token usa requests (bloqueante)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.executor, self.credentials.refresh, google.auth.transport.requests.Request())
+        return {'Authorization': f'Bearer {self.credentials.token}'}
+
+    async def list_images(self, folder_id):
+        params = {
+            'q': f"'{folder_id}' in parents and (mimeType contains 'image/')",
+            'fields': 'nextPageToken, files(id, name, mimeType, modifiedTime)',
+            'pageSize': '1000',
+        }
+        images = []
+        while True:
+            async with self.http.get(DRIVE_API, params=params, headers=await self._headers()) as response:
+                response.raise_for_status()
+                data = await response.json()
+            images.extend(data.get('files', []))
+            if not data.get('nextPageToken'):
+                break
+            params['pageToken'] = data['nextPageToken']
+        return [img for img in images if "_enviada" not in img['name']]
+
+    async def download(self, file_id, file_path):
+        """Descarga reanudable (mismos parciales que drive_download) con verificación MD5.
+
+        Igual que download_image, usa la caché compartida de imágenes.
+        """
+        async with self.http.get(f"{DRIVE_API}/{file_id}", params={'fields': 'size, md5Checksum, modifiedTime'},
+                                 headers=await self._headers()) as response:
+            response.raise_for_status()
+            metadata = await response.json()
+        if metadata.get('size') is not None:
+            metadata['size'] = int(metadata['size'])
+
+        key = image_cache.key(file_id, metadata)
+        if image_cache.get(key, file_path):
+            return file_path
+        await self._fetch(file_id, file_path, metadata)
+        # put puede expulsar entradas (recorre el directorio de la caché): fuera del event loop
+        await asyncio.get_running_loop().run_in_executor(self.executor, image_cache.put, key, file_path)
+        return file_path
+
+    async def _fetch(self, file_id, file_path, metadata):
+        # Un único segmento en descargas nuevas (la concurrencia ya la dan las demás
+        # cuentas), pero un estado de drive_download puede traer varios: cada segmento
+        # pendiente se completa con su propio rango
+        segments = drive_download.load_segments(file_path, metadata, 1, 0)
+        for i, (start, end) in enumerate(segments):
+            path = drive_download.part_path(file_path, i)
+            position = start + (os.path.getsize(path) if os.path.exists(path) else 0)
+            if end is not None and position > end:
+                continue
+            headers = dict(await self._headers(), Range=f"bytes={position}-{'' if end is None else end}")
+            async with self.http.get(f"{DRIVE_API}/{file_id}", params={'alt': 'media'}, headers=headers) as response:
+                if response.status == 416:
+                    # Rango fuera del fichero: el segmento ya estaba completo
+                    continue
+                response.raise_for_status()
+                if response.status != 206:
+                    # El servidor ignoró el rango y envía el fichero entero: solo sirve si el
+                    # segmento es el fichero completo; si no, se descarta lo descargado
+                    if len(segments) > 1:
+                        drive_download.remove_parts(file_path)
+                        raise ConnectionError(f"Drive ignoró el rango de {os.path.basename(file_path)}: "
+                                              "se descargará de nuevo desde el principio")
+                    open(path, 'wb').close()
+                with open(path, 'ab') as f:
+                    async for chunk in response.content.iter_chunked(app.config["DRIVE_CHUNK_SIZE"]):
+                        f.write(chunk)
+        return drive_download.assemble(file_path, len(segments), metadata.get('md5Checksum'))
+
+    async def rename(self, file_id, new_name):
+        try:
+            async with self.http.patch(f"{DRIVE_API}/{file_id}", json={'name': new_name}, headers=await self._headers()) as response:
+                response.raise_for_status()
+            return True
+        except Exception as e:
+            logging.error(f"Error al renombrar archivo: {str(e)}")
+            return False
+
+
+class ExecutorDrive:
+    """Misma interfaz que HttpDrive usando googleapiclient en el executor (sin aiohttp)"""
+
+    def __init__(self, credentials_path, executor):
+        self.executor = executor
+        self.service = instagram_publisher.authenticate_google_drive(credentials_path)
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def list_images(self, folder_id):
+        return await self._run(instagram_publisher.get_new_images, self.service, folder_id)
+
+    async def download(self, file_id, file_path):
+        return await self._run(instagram_publisher.download_image, self.service, file_id,
+                               os.path.basename(file_path), os.path.dirname(file_path))
+
+    async def rename(self, file_id, new_name):
+        return await self._run(instagram_publisher.rename_file, self.service, file_id, new_name)
+
+
+async def http_caption(http, image_path, api_key, prompt, model, timeout):
+    """Descripción de la imagen con la API REST de Gemini"""
+    with open(image_path, 'rb') as f:
+        image_data = base64.b64encode(f.read()).decode('ascii')
+    body = {'contents': [{'parts': [
+        {'text': prompt},
+        {'inline_data': {'mime_type': 'image/jpeg', 'data': image_data}},
+    ]}]}
+    url = GEMINI_API.format(model=model.removeprefix('models/'))
+    async with http.post(url, params={'key': api_key}, json=body,
+                         timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+        response.raise_for_status()
+        data = await response.json()
+    parts = data['candidates'][0]['content']['parts']
+    return ''.join(part.get('text', '') for part in parts)
+
+
+class AsyncPublisher:
+    """Publica varias cuentas concurrentemente en un event loop"""
+
+    def __init__(self, drive_concurrency=None, gemini_concurrency=None, instagram_concurrency=None):
+        self.drive_concurrency = drive_concurrency or app.config['ASYNC_DRIVE_CONCURRENCY']
+        self.gemini_concurrency = gemini_concurrency or app.config['ASYNC_GEMINI_CONCURRENCY']
+        self.instagram_concurrency = instagram_concurrency or app.config['ASYNC_INSTAGRAM_CONCURRENCY']
+        # Hilos para instagrapi y, sin aiohttp, para Drive/Gemini
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.instagram_concurrency + (0 if aiohttp else self.drive_concurrency + self.gemini_concurrency) + 1,
+            thread_name_prefix='publisher'
+        )
+        # Un único hilo para la base de datos, con su propio app context (y sesión)
+        self.db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='publisher-db',
+                                              initializer=lambda: app.app_context().push())
+        self.http = None
+        check_http_support()
+
+    async def _db(self, func, *args):
+        # Sin copy_context: el app context de este hilo también vive en contextvars
+        return await asyncio.get_running_loop().run_in_executor(self.db_executor, func, *args)
+
+    async def _blocking(self, func, *args):
+        # Con copy_context los registros de log del hilo conservan la cuenta y el run_id
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, contextvars.copy_context().run, func, *args)
+
+    def _download_lock(self, file_id):
+        return self.download_locks.setdefault(file_id, asyncio.Lock())
+
+    async def run(self, account_ids):
+        """Publica las cuentas indicadas y devuelve {account_id: resultado}"""
+        self.drive_limit = asyncio.Semaphore(self.drive_concurrency)
+        self.gemini_limit = asyncio.Semaphore(self.gemini_concurrency)
+        self.instagram_limit = asyncio.Semaphore(self.instagram_concurrency)
+        self.download_locks = {}
+
+        if aiohttp is not None:
+            self.http = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=300))
+        try:
+            results = await asyncio.gather(*(self.publish_account(account_id) for account_id in account_ids),
+                                           return_exceptions=True)
+        finally:
+            if self.http is not None:
+                await self.http.close()
+        return {account_id: (result if not isinstance(result, Exception) else {"status": "error", "message": str(result)})
+                for account_id, result in zip(account_ids, results)}
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.db_executor.shutdown(wait=True)
+
+    def _drive(self, credentials_path):
+        if self.http is not None:
+            return HttpDrive(self.http, credentials_path, self.executor)
+        return ExecutorDrive(credentials_path, self.executor)
+
+    async def _caption(self, image_path, account):
+        api_key = account['gemini_api_key']
+        async with self.gemini_limit:
+            if self.http is None:
+                return await self._blocking(instagram_publisher.get_gemini_image_description, image_path, api_key,
+                                            account['prompt'], True, account['gemini_model'], account['gemini_timeout'])
+            # Misma estadística por clave que las llamadas de gemini_pool
+            start = time.perf_counter()
+            try:
+                caption = await http_caption(self.http, image_path, api_key, account['prompt'],
+                                             account['gemini_model'], account['gemini_timeout'])
+            except Exception as e:
+                gemini_pool.record(api_key, (time.perf_counter() - start) * 1000, error=str(e))
+                raise
+            gemini_pool.record(api_key, (time.perf_counter() - start) * 1000)
+            return caption
+
+    async def publish_account(self, account_id):
+        account = await self._db(_load_account, account_id)
+        if account is None:
+            return {"status": "error", "message": f"Account with ID {account_id} not found"}
+
+        if account['recovery']:
+            # Hay una subida interrumpida: la recuperación (comprobar si llegó a
+            # publicarse) es la del motor síncrono, que se ejecuta en el executor
+            logging.info(f"Cuenta {account_id}: checkpoint pendiente, se usa el motor síncrono")
+            return await self._blocking(_publish_sync, account_id)
+
+        # Mismo cerrojo que la precarga y el motor síncrono. Se espera sin ocupar un hilo del executor
+        lock = instagram_publisher.account_lock(account_id)
+        if not lock.acquire(blocking=False):
+            logging.info(f"Cuenta {account_id}: la publicación espera a que termine la ejecución en curso")
+            while not lock.acquire(blocking=False):
+                await asyncio.sleep(ACCOUNT_LOCK_POLL_SECONDS)
+
+        trace = tracing.RunTrace(account_id, trigger='async')
+        # Cada cuenta es una tarea asyncio con su propia copia del contexto de log
+        log_token = structured_logging.bind(account_id=account_id, run_id=trace.run_id)
+        results = []
+        try:
+            if not account['folder_id'] or account['folder_id'].strip() == "":
+                trace.status = 'error'
+                return {"status": "error", "message": "Error: No se ha configurado un ID de carpeta válido"}
+
+            with trace.span('drive_auth'):
+                drive = await self._blocking(self._drive, account['credentials_path'])
+
+            with trace.span('listing'):
+                async with self.drive_limit:
+                    images = await drive.list_images(account['folder_id'])
+                batch = await self._db(_refill_and_take, account_id, images)
+
+            if not batch:
+                message = "No hay imágenes nuevas para procesar"
+                await self._db(_record_info, account_id, message, None, trace.run_id)
+                return {"status": "success", "message": message}
+
+            # Imágenes publicadas en este lote: se comparan con las siguientes
+            accepted = set()
+            while batch:
+                item = batch.pop(0)
+                outcome = await self._publish_item(account, drive, item, trace, results, accepted)
+                if outcome == 'skipped':
+                    # Las duplicadas no consumen cuota: se toma la siguiente de la cola
+                    batch.extend(await self._db(_next_item, account_id, [item['id']] + [i['id'] for i in batch]))
+
+            return {"status": "success", "results": results}
+
+        except Exception as e:
+            trace.status = 'error'
+            logging.error(f"Error in async publication process: {str(e)}", exc_info=True)
+            await self._db(_record_error, account_id, str(e), error_codes.classify(e), trace.run_id)
+            return {"status": "error", "message": str(e)}
+
+        finally:
+            try:
+                await self._db(_finish_run, trace, account['credentials_path'])
+            finally:
+                lock.release()
+                structured_logging.unbind(log_token)
+
+    async def _publish_item(self, account, drive, item, trace, results, accepted):
+        account_id = account['id']
+        file_name = item['file_name']
+        results.append(f"Procesando: {file_name}")
+
+        image_path = item['local_path']
+        if not image_path or not os.path.exists(image_path):
+            image_path = os.path.join(instagram_publisher.staging_dir(account_id), f"{item['file_id']}_{file_name}")
+            with trace.span('download', file_name) as download_span:
+                # Una sola descarga por fichero: las demás cuentas lo toman de image_cache
+                async with self._download_lock(item['file_id']), self.drive_limit:
+                    await drive.download(item['file_id'], image_path)
+                download_span['bytes'] = os.path.getsize(image_path)
+            item['caption'] = None
+            await self._db(_checkpoint, account_id, item['file_id'], 'downloaded', {'local_path': image_path, 'caption': None})
+
+        with trace.span('phash', file_name):
+            duplicate = await self._db(_check_duplicate, account_id, item, image_path, trace, accepted)
+        if duplicate == 'skipped':
+            results.append(f"Omitida por duplicada: {file_name}")
+            return 'skipped'
+
+        caption = item['caption']
+        if not caption:
+            try:
+                with trace.span('caption', file_name) as caption_span:
+                    caption = await self._caption(image_path, account)
+                    caption_span['bytes'] = len(caption.encode('utf-8'))
+                await self._db(_checkpoint, account_id, item['file_id'], 'captioned', {'caption': caption})
+            except Exception as e:
+                # Sin descripción no se publica (misma política de reintentos que publish_for_account)
+                logging.error(f"Error generating image description: {str(e)}")
+                trace.status = 'error'
+                message = f"Error al obtener la descripción: {str(e)}"
+                if await self._db(_record_result, account_id, item, False, message, None,
+                                  error_codes.classify_gemini(e), trace.run_id, 'downloaded'):
+                    results.append(f"Error (se reintentará): {message}")
+                    return 'failed'
+                await self._finish(drive, account_id, item, trace)
+                results.append(f"Error: {message}")
+                return 'failed'
+        results.append(f"Descripción: {caption}")
+
+        await self._db(_checkpoint, account_id, item['file_id'], 'uploading', {})
+        async with self.instagram_limit:
+            success, message, media_id, error_code = await self._blocking(
+                instagram_publisher.post_to_instagram, image_path, caption,
+                account['instagram_username'], account['instagram_password'], trace
+            )
+        if not success:
+            trace.status = 'error'
+        if await self._db(_record_result, account_id, item, success, message, media_id, error_code, trace.run_id):
+            results.append(f"Error (se reintentará): {message}")
+            return 'failed'
+        if success:
+            accepted.add(item['file_id'])
+
+        await self._finish(drive, account_id, item, trace)
+        results.append("Imagen procesada correctamente" if success else f"Error: {message}")
+        return 'posted' if success else 'failed'
+
+    async def _finish(self, drive, account_id, item, trace):
+        """Renombra el fichero en Drive y cierra el checkpoint"""
+        file_name = item['file_name']
+
+        with trace.span('rename', file_name):
+            async with self.drive_limit:
+                renamed = await drive.rename(item['file_id'], instagram_publisher.processed_name(file_name))
+        await self._db(_close_checkpoint, account_id, item['file_id'], renamed)
+
+
+# --- Operaciones de base de datos (se ejecutan siempre en el hilo de BD) ---
+
+def _item_dict(account_id, item):
+    prepared = PreparedPost.query.filter_by(account_id=account_id, file_id=item.file_id).first()
+    if prepared is None:
+        prepared = PreparedPost(account_id=account_id, file_id=item.file_id, file_name=item.file_name, stage='pending')
+        db.session.add(prepared)
+        db.session.commit()
+    return {'id': item.id, 'file_id': item.file_id, 'file_name': item.file_name,
+            'local_path': prepared.local_path, 'caption': prepared.caption}
+
+
+def _load_account(account_id):
+    account = Account.query.get(account_id)
+    if account is None:
+        return None
+    recovery = PreparedPost.query.filter(
+        PreparedPost.account_id == account_id,
+        PreparedPost.stage.not_in(instagram_publisher.PREPARED_STAGES)
+    ).count() > 0
+    return {
+        'id': account.id,
+        'instagram_username': account.instagram_username,
+        'instagram_password': account.instagram_password,
+        'folder_id': account.folder_id,
+        'gemini_api_key': account.gemini_api_key,
+        'prompt': account.gemini_prompt or instagram_publisher.DEFAULT_PROMPT,
+        'gemini_model': account.gemini_model or app.config['GEMINI_MODEL'],
+        'gemini_timeout': account.gemini_timeout or app.config['GEMINI_TIMEOUT_SECONDS'],
+        'credentials_path': write_credentials_file(account, suffix='_async') if not recovery else None,
+        'recovery': recovery,
+    }
+
+
+def _refill_and_take(account_id, images):
+    content_queue.refill(account_id, images)
+    return [_item_dict(account_id, item) for item in content_queue.next_batch(account_id)]
+
+
+def _next_item(account_id, exclude_ids):
+    return [_item_dict(account_id, item) for item in content_queue.next_batch(account_id, 1, exclude_ids=exclude_ids)]
+
+
+def _checkpoint(account_id, file_id, stage, fields):
+    prepared = PreparedPost.query.filter_by(account_id=account_id, file_id=file_id).first()
+    for name, value in fields.items():
+        setattr(prepared, name, value)
+    instagram_publisher.checkpoint(prepared, stage)
+
+
+def _check_duplicate(account_id, item, image_path, trace, accepted):
+    duplicate, distance = image_index.check_duplicate(account_id, item['file_id'], item['file_name'], image_path, accepted)
+    skip = duplicate is not None and app.config['DUPLICATE_ACTION'] == 'skip'
+    if duplicate is None:
+        return None
+    queue_item = QueueItem.query.get(item['id'])
+    instagram_publisher.record_duplicate(account_id, queue_item, duplicate, distance, trace, skipped=skip)
+    if skip:
+        prepared = PreparedPost.query.filter_by(account_id=account_id, file_id=item['file_id']).first()
+        instagram_publisher.discard_prepared_post(prepared)
+        return 'skipped'
+    return 'flagged'
+
+
+def _record_result(account_id, item, success, message, media_id, error_code, run_id, retry_stage='uploading'):
+    prepared = PreparedPost.query.filter_by(account_id=account_id, file_id=item['file_id']).first()
+    return instagram_publisher.record_post_result(account_id, QueueItem.query.get(item['id']), prepared,
+                                                  success, message, media_id, error_code, run_id, retry_stage)
+
+
+def _close_checkpoint(account_id, file_id, renamed):
+    prepared = PreparedPost.query.filter_by(account_id=account_id, file_id=file_id).first()
+    instagram_publisher.close_checkpoint(prepared, renamed)
+
+
+def _record_info(account_id, message, image_name, run_id):
+    db.session.add(PublicationHistory(account_id=account_id, timestamp=datetime.utcnow(), status='info',
+                                      details=message, image_name=image_name, run_id=run_id))
+    db.session.commit()
+
+
+def _record_error(account_id, message, error_code, run_id):
+    db.session.rollback()
+    db.session.add(PublicationHistory(account_id=account_id, timestamp=datetime.utcnow(), status='error',
+                                      run_id=run_id, **error_codes.error_fields(message, error_code)))
+    db.session.commit()
+
+
+def _finish_run(trace, credentials_path):
+    tracing.save_trace(trace)
+    if credentials_path and os.path.exists(credentials_path):
+        os.remove(credentials_path)
+
+
+def _publish_sync(account_id):
+    """Ejecuta el motor síncrono para una cuenta (con su propio app context)"""
+    from app import run_publication_for_account
+    result = run_publication_for_account(account_id)
+    if result is None:
+        return {"status": "error", "message": "El motor síncrono no devolvió ningún resultado"}
+    return result
+
+
+def publish_accounts(account_ids):
+    """Punto de entrada síncrono: publica las cuentas concurrentemente y devuelve sus resultados"""
+    publisher = AsyncPublisher()
+    try:
+        return asyncio.run(publisher.run(list(account_ids)))
+    finally:
+        publisher.close()
+
+
+if __name__ == '__main__':
+    ids = [int(arg) for arg in sys.argv[1:]]
+    if not ids:
+        with app.app_context():
+            ids = [account.id for account in Account.query.all()]
+    for account_id, result in publish_accounts(ids).items():
+        print(f"Cuenta {account_id}: {result}")
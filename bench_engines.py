@@ -0,0 +1,240 @@
+"""Compara el motor por hilos (publish_for_account, un hilo por cuenta) con el motor
+asíncrono (async_publisher) en memoria, hilos y rendimiento.
+
+Las llamadas externas (Drive, Gemini, Instagram) se sustituyen por esperas con la
+latencia indicada; todo lo demás (cola, checkpoints, hashes, trazas, historial)
+es el código real sobre una base SQLite temporal. Cada motor se mide en un proceso
+aparte para que la memoria de uno no cuente en el otro.
+
+Con muchas cuentas el motor por hilos agota el pool de conexiones de SQLAlchemy
+(cada hilo mantiene su sesión abierta durante las llamadas externas); esas
+ejecuciones aparecen en la columna de errores.
+
+Uso: python bench_engines.py [--accounts 50] [--images 2] [--latency-scale 1.0]
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+# Latencias simuladas (segundos) de cada llamada externa
+LATENCY = {
+    'list': 0.3,
+    'download': 0.4,
+    'caption': 2.0,
+    'post': 3.0,
+    'rename': 0.2,
+}
+
+
+def make_image(seed):
+    """JPEG pequeño con rectángulos aleatorios (hashes perceptuales distintos entre sí)"""
+    from PIL import Image, ImageDraw
+    rnd = random.Random(seed)
+    img = Image.new('RGB', (320, 240), tuple(rnd.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x0, y0 = rnd.randrange(300), rnd.randrange(220)
+        draw.rectangle([x0, y0, x0 + rnd.randrange(20, 160), y0 + rnd.randrange(20, 120)],
+                       fill=tuple(rnd.randrange(256) for _ in range(3)))
+    buffer = io.BytesIO()
+    img.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+def setup_database(accounts, images):
+    from app import app, db
+    from models import Account
+
+    credentials = base64.b64encode(json.dumps({'type': 'service_account'}).encode()).decode()
+    with app.app_context():
+        for i in range(accounts):
+            db.session.add(Account(
+                name=f"bench{i}",
+                instagram_username=f"bench{i}",
+                instagram_password="x",
+                google_credentials=credentials,
+                folder_id=f"folder{i}",
+                gemini_api_key="x",
+                posts_per_slot=images
+            ))
+        db.session.commit()
+        return [account.id for account in Account.query.order_by(Account.id)]
+
+
+def folder_listing(folder_id, images):
+    return [{'id': f"{folder_id}-{n}", 'name': f"{folder_id}-{n}.jpg", 'mimeType': 'image/jpeg',
+             'modifiedTime': '2024-01-01T00:00:00.000Z'} for n in range(images)]
+
+
+def patch_blocking(images, scale):
+    """Sustituye las llamadas bloqueantes de instagram_publisher"""
+    import instagram_publisher
+
+    class FakeService:
+        def files(self):
+            return self
+
+        def get(self, **kwargs):
+            return self
+
+        def execute(self):
+            return {'name': 'bench'}
+
+    def get_new_images(service, folder_id):
+        time.sleep(LATENCY['list'] * scale)
+        return folder_listing(folder_id, images)
+
+    def download_image(service, file_id, file_name, dest_dir='.'):
+        time.sleep(LATENCY['download'] * scale)
+        path = os.path.join(dest_dir, file_name)
+        with open(path, 'wb') as f:
+            f.write(make_image(file_id))
+        return path
+
+    def get_gemini_image_description(image_path, api_key, custom_prompt=None, raise_errors=False, model_name=None, timeout=None):
+        time.sleep(LATENCY['caption'] * scale)
+        return f"Descripción de {os.path.basename(image_path)}"
+
+    def post_to_instagram(image_path, caption, username, password, trace=None):
+        time.sleep(LATENCY['post'] * scale)
+        return True, "Publicado con éxito. ID de media: 1", "1", None
+
+    def rename_file(service, file_id, new_name):
+        time.sleep(LATENCY['rename'] * scale)
+        return True
+
+    instagram_publisher.authenticate_google_drive = lambda path: FakeService()
+    instagram_publisher.get_new_images = get_new_images
+    instagram_publisher.download_image = download_image
+    instagram_publisher.get_gemini_image_description = get_gemini_image_description
+    instagram_publisher.post_to_instagram = post_to_instagram
+    instagram_publisher.rename_file = rename_file
+
+
+def patch_async(images, scale):
+    """Sustituye los clientes HTTP asíncronos de async_publisher"""
+    import async_publisher
+
+    class FakeDrive:
+        async def list_images(self, folder_id):
+            await asyncio.sleep(LATENCY['list'] * scale)
+            return folder_listing(folder_id, images)
+
+        async def download(self, file_id, file_path):
+            await asyncio.sleep(LATENCY['download'] * scale)
+            with open(file_path, 'wb') as f:
+                f.write(make_image(file_id))
+            return file_path
+
+        async def rename(self, file_id, new_name):
+            await asyncio.sleep(LATENCY['rename'] * scale)
+            return True
+
+    async def http_caption(http, image_path, api_key, prompt, model, timeout):
+        await asyncio.sleep(LATENCY['caption'] * scale)
+        return f"Descripción de {os.path.basename(image_path)}"
+
+    async_publisher.AsyncPublisher._drive = lambda self, credentials_path: FakeDrive()
+    async_publisher.http_caption = http_caption
+
+
+def run_engine(engine, accounts, images, scale):
+    import app  # noqa: F401 (app antes que models e instagram_publisher, como en main.py)
+    patch_blocking(images, scale)
+    account_ids = setup_database(accounts, images)
+
+    peak_threads = threading.active_count()
+    stop = threading.Event()
+
+    def sample_threads():
+        nonlocal peak_threads
+        while not stop.wait(0.05):
+            peak_threads = max(peak_threads, threading.active_count())
+
+    sampler = threading.Thread(target=sample_threads, daemon=True)
+    sampler.start()
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    if engine == 'threaded':
+        from app import run_publication_for_account
+        threads = [threading.Thread(target=run_publication_for_account, args=(account_id,)) for account_id in account_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        patch_async(images, scale)
+        import async_publisher
+        async_publisher.publish_accounts(account_ids)
+
+    elapsed = time.perf_counter() - start
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stop.set()
+
+    from app import app
+    from models import PublicationHistory
+    with app.app_context():
+        published = PublicationHistory.query.filter_by(status='success').count()
+        errors = PublicationHistory.query.filter_by(status='error').count()
+
+    return {
+        'engine': engine,
+        'published': published,
+        'errors': errors,
+        'seconds': round(elapsed, 2),
+        'images_per_second': round(published / elapsed, 2) if elapsed else 0,
+        'peak_memory_mb': round(peak_memory / 1024 / 1024, 1),
+        'peak_threads': peak_threads,
+    }
+
+
+def run_in_subprocess(engine, args):
+    workdir = tempfile.mkdtemp(prefix=f"bench_{engine}_")
+    env = dict(os.environ,
+               DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+               DISABLE_SCHEDULER='1',
+               TRACE_SAMPLE_RATE='1')
+    command = [sys.executable, os.path.abspath(__file__), '--engine', engine,
+               '--accounts', str(args.accounts), '--images', str(args.images),
+               '--latency-scale', str(args.latency_scale)]
+    # Se ejecuta en un directorio temporal: staging/ y credenciales no tocan el proyecto
+    output = subprocess.run(command, cwd=workdir, env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--accounts', type=int, default=50)
+    parser.add_argument('--images', type=int, default=2, help="imágenes por cuenta")
+    parser.add_argument('--latency-scale', type=float, default=1.0)
+    parser.add_argument('--engine', choices=['threaded', 'async'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.engine:
+        # Proceso hijo: un solo motor, resultado en JSON en la última línea
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        print(json.dumps(run_engine(args.engine, args.accounts, args.images, args.latency_scale)))
+        return
+
+    print(f"{args.accounts} cuentas x {args.images} imágenes, latencias x{args.latency_scale}")
+    print(f"{'motor':<10}{'publicadas':>12}{'errores':>9}{'segundos':>10}{'img/s':>8}{'memoria MB':>12}{'hilos':>7}")
+    for engine in ('threaded', 'async'):
+        r = run_in_subprocess(engine, args)
+        print(f"{r['engine']:<10}{r['published']:>12}{r['errors']:>9}{r['seconds']:>10}{r['images_per_second']:>8}"
+              f"{r['peak_memory_mb']:>12}{r['peak_threads']:>7}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""Mide el coste del logging en el hilo que publica.
+
+Reproduce el patrón de log de una ejecución de publish_for_account (una línea por
+fichero de la carpeta más unas pocas por imagen publicada) desde varios hilos a la
+vez, como varias cuentas, y compara:
+
+  sync        StreamHandler síncrono con formato de texto (el antiguo basicConfig)
+  queue       structured_logging con JSON y sin límite de repeticiones
+  queue+rate  structured_logging con JSON y LOG_RATE_LIMIT (la configuración por defecto)
+
+La salida va a un fichero temporal; --sink-latency añade una espera por escritura
+para simular un stderr lento (tubería a journald o docker, disco de red...).
+Para cada caso informa del tiempo por llamada en el hilo que registra, del tiempo
+total de los hilos, de las líneas escritas y de lo que tarda en vaciarse la cola.
+
+Uso: python bench_logging.py [--threads 4] [--runs 20] [--files 500] [--sink-latency 0.05]
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+
+import structured_logging
+
+
+class Sink:
+    """Fichero de salida con una espera opcional (ms) en cada escritura"""
+
+    def __init__(self, path, latency_ms):
+        self.file = open(path, 'w', encoding='utf-8')
+        self.latency = latency_ms / 1000
+
+    def write(self, text):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.file.write(text)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def workload(account_id, runs, files, images, timings):
+    """Líneas de log de `runs` ejecuciones de una cuenta; anota el tiempo de cada ejecución"""
+    for _ in range(runs):
+        token = structured_logging.bind(account_id=account_id, run_id=uuid.uuid4().hex)
+        start = time.perf_counter()
+        logging.info(f"Starting publication process for account bench{account_id}")
+        logging.info(f"Buscando imágenes en carpeta: folder{account_id}")
+        logging.info(f"Total de archivos en la carpeta: {files}")
+        for n in range(files):
+            logging.info(f"Archivo encontrado: IMG_{n:05d}.jpg - Tipo: image/jpeg")
+        for n in range(images):
+            logging.info(f"Processing image: IMG_{n:05d}.jpg")
+            logging.info(f"Descripción generada para IMG_{n:05d}.jpg")
+            logging.info(f"Archivo renombrado exitosamente a IMG_{n:05d}_enviada.jpg")
+        timings.append(time.perf_counter() - start)
+        structured_logging.unbind(token)
+
+
+def configure(mode, sink):
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    if mode == 'sync':
+        if structured_logging._listener is not None:
+            structured_logging._listener.stop()
+            structured_logging._listener = None
+        handler = logging.StreamHandler(sink)
+        handler.setFormatter(logging.Formatter('%(levelname)s:%(name)s:%(message)s'))
+        root.addHandler(handler)
+        root.setLevel(logging.INFO)
+        return
+
+    stderr, sys.stderr = sys.stderr, sink
+    try:
+        structured_logging.init_app(SimpleNamespace(config={
+            'LOG_LEVEL': 'INFO',
+            'LOG_LEVELS': '',
+            'LOG_FORMAT': 'json',
+            'LOG_FILE': None,
+            'LOG_QUEUE_SIZE': 1_000_000,
+            'LOG_RATE_LIMIT': 20 if mode == 'queue+rate' else 0,
+            'LOG_RATE_WINDOW': 60,
+        }))
+    finally:
+        sys.stderr = stderr
+
+
+def run_case(mode, args):
+    fd, path = tempfile.mkstemp(prefix='bench_logging_', suffix='.log')
+    os.close(fd)
+    sink = Sink(path, args.sink_latency)
+    configure(mode, sink)
+
+    timings = []
+    calls_per_run = 3 + args.files + 3 * args.images
+    threads = [threading.Thread(target=workload, args=(i + 1, args.runs, args.files, args.images, timings))
+               for i in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    drain_start = time.perf_counter()
+    if mode != 'sync':
+        structured_logging._listener.stop()
+        structured_logging._listener = None
+    drain = time.perf_counter() - drain_start
+
+    sink.close()
+    with open(path, encoding='utf-8') as f:
+        lines = sum(1 for _ in f)
+    os.remove(path)
+
+    per_call_us = sorted(t / calls_per_run * 1e6 for t in timings)
+    return {
+        'mode': mode,
+        'us_per_call': round(sum(per_call_us) / len(per_call_us), 2),
+        'p99_run_us_per_call': round(per_call_us[int(len(per_call_us) * 0.99) - 1 if len(per_call_us) > 1 else 0], 2),
+        'threads_seconds': round(elapsed, 3),
+        'lines': lines,
+        'drain_seconds': round(drain, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=4, help="cuentas publicando a la vez")
+    parser.add_argument('--runs', type=int, default=20, help="ejecuciones por cuenta")
+    parser.add_argument('--files', type=int, default=500, help="ficheros en la carpeta de Drive")
+    parser.add_argument('--images', type=int, default=2, help="imágenes publicadas por ejecución")
+    parser.add_argument('--sink-latency', type=float, default=0.0, help="ms de espera por línea escrita")
+    parser.add_argument('--modes', nargs='+', default=['sync', 'queue', 'queue+rate'])
+    args = parser.parse_args()
+
+    calls = args.threads * args.runs * (3 + args.files + 3 * args.images)
+    print(f"{args.threads} hilos x {args.runs} ejecuciones, {calls} llamadas, "
+          f"latencia de escritura {args.sink_latency} ms")
+    print(f"{'modo':<12}{'µs/llamada':>12}{'p99 µs':>10}{'hilos s':>10}{'líneas':>10}{'vaciado s':>11}")
+    for mode in args.modes:
+        r = run_case(mode, args)
+        print(f"{r['mode']:<12}{r['us_per_call']:>12}{r['p99_run_us_per_call']:>10}{r['threads_seconds']:>10}"
+              f"{r['lines']:>10}{r['drain_seconds']:>11}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""Benchmark de carga de las páginas web sobre un servidor WSGI local.
+
+Arranca la aplicación con el servidor WSGI de Werkzeug (multihilo) en este mismo
+proceso, inicia sesión y lanza peticiones concurrentes a cada ruta. Para cada una
+informa de la latencia p50/p95/p99 y de las consultas SQL por petición (cabeceras
+X-SQL-Queries y X-SQL-Time de query_stats). La base se elige con DATABASE_URL,
+de modo que los resultados de SQLite y PostgreSQL son comparables; --json guarda
+el resultado para compararlo después.
+
+Uso:
+    DATABASE_URL=sqlite:////tmp/synthetic.db python bench_web.py --requests 200 --concurrency 8
+    DATABASE_URL=postgresql://... python bench_web.py --no-view-cache --json pg.json
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_ROUTES = ['/', '/dashboard', '/history', '/config']
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    k = (len(ordered) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
+
+
+class Client:
+    """Cliente HTTP con cookies (la sesión de Flask-Login se comparte entre hilos)"""
+
+    def __init__(self, base_url, timeout=60):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        start = time.perf_counter()
+        try:
+            with self.opener.open(self.base_url + path, data=body, timeout=self.timeout) as response:
+                response.read()
+                status, headers = response.status, response.headers
+        except urllib.error.HTTPError as e:
+            status, headers = e.code, e.headers
+        except (TimeoutError, urllib.error.URLError):
+            # Sin respuesta en --timeout segundos: cuenta como error
+            status, headers = 599, {}
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        return status, headers, elapsed_ms
+
+
+def start_server(host, port):
+    from werkzeug.serving import make_server
+    from app import app
+
+    server = make_server(host, port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_route(client, path, total, concurrency):
+    results = []
+    lock = threading.Lock()
+
+    def one(_):
+        status, headers, elapsed_ms = client.request(path)
+        with lock:
+            results.append((status, elapsed_ms, headers.get('X-SQL-Queries'), headers.get('X-SQL-Time')))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total)))
+    wall = time.perf_counter() - started
+
+    latencies = [r[1] for r in results]
+    queries = [int(r[2]) for r in results if r[2] is not None]
+    sql_ms = [float(r[3].rstrip('ms')) for r in results if r[3]]
+    errors = sum(1 for r in results if r[0] >= 400)
+    return {
+        'route': path,
+        'requests': len(results),
+        'errors': errors,
+        'rps': round(len(results) / wall, 1),
+        'p50_ms': round(percentile(latencies, 50), 1),
+        'p95_ms': round(percentile(latencies, 95), 1),
+        'p99_ms': round(percentile(latencies, 99), 1),
+        'max_ms': round(max(latencies), 1),
+        'queries_per_request': round(statistics.mean(queries), 1) if queries else None,
+        'sql_ms_per_request': round(statistics.mean(sql_ms), 1) if sql_ms else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de carga de las rutas web")
+    parser.add_argument('--routes', nargs='+', default=DEFAULT_ROUTES)
+    parser.add_argument('--requests', type=int, default=100, help="peticiones por ruta")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--warmup', type=int, default=3, help="peticiones previas por ruta (no se miden)")
+    parser.add_argument('--user', default='bench')
+    parser.add_argument('--password', default='benchmark')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--timeout', type=float, default=60, help="segundos máximos por petición")
+    parser.add_argument('--no-view-cache', action='store_true', help="mide las páginas sin la caché de vistas")
+    parser.add_argument('--json', help="guarda los resultados en este fichero")
+    args = parser.parse_args()
+
+    # Configuración antes de importar app: sin planificador, con cabeceras SQL y sin CSRF
+    os.environ.setdefault('DISABLE_SCHEDULER', '1')
+    os.environ['SQL_STATS_HEADER'] = '1'
+    if args.no_view_cache:
+        os.environ['VIEW_CACHE_TTL'] = '0'
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import logging
+    from app import app, db
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    with app.app_context():
+        database = db.engine.url.render_as_string(hide_password=True)
+        dialect = db.engine.dialect.name
+        from models import PublicationHistory
+        history_rows = PublicationHistory.query.count()
+
+    server = start_server(args.host, args.port)
+    client = Client(f"http://{args.host}:{args.port}", args.timeout)
+    client.request('/login', {'username': args.user, 'password': args.password})
+    if client.request('/dashboard')[0] != 200:
+        server.shutdown()
+        sys.exit(f"No se pudo iniciar sesión como '{args.user}' (¿se ejecutó generate_data.py?)")
+
+    print(f"Base de datos: {database} ({history_rows} filas de historial)")
+    print(f"{args.requests} peticiones por ruta, concurrencia {args.concurrency}, "
+          f"caché de vistas {'desactivada' if args.no_view_cache else 'activada'}")
+    print(f"{'ruta':<14}{'req/s':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'máx ms':>10}{'SQL/pet':>9}{'SQL ms':>9}{'errores':>9}")
+
+    results = []
+    for path in args.routes:
+        for _ in range(args.warmup):
+            client.request(path)
+        r = bench_route(client, path, args.requests, args.concurrency)
+        results.append(r)
+        print(f"{r['route']:<14}{r['rps']:>8}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}{r['max_ms']:>10}"
+              f"{r['queries_per_request'] if r['queries_per_request'] is not None else '-':>9}"
+              f"{r['sql_ms_per_request'] if r['sql_ms_per_request'] is not None else '-':>9}{r['errors']:>9}")
+
+    server.shutdown()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'database': database,
+                'dialect': dialect,
+                'history_rows': history_rows,
+                'requests': args.requests,
+                'concurrency': args.concurrency,
+                'view_cache': not args.no_view_cache,
+                'routes': results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
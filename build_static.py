@@ -0,0 +1,102 @@
+"""Genera los recursos estáticos para producción.
+
+Copia cada fichero de static/ a static/dist/ con el hash de su contenido en el
+nombre (css/custom.css -> css/custom.1a2b3c4d.css), crea variantes precomprimidas
+.gz y .br (brotli es dependencia del proyecto) y escribe
+static/dist/manifest.json, que app usa para generar las URLs en las plantillas.
+
+Uso: python build_static.py
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import brotli
+from PIL import Image
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASE_DIR, 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST_PATH = os.path.join(DIST_DIR, 'manifest.json')
+
+# Icono de la aplicación: el original (generated-icon.png) pesa casi 1 MB
+SOURCE_ICON = os.path.join(BASE_DIR, 'generated-icon.png')
+APP_ICON = os.path.join(STATIC_DIR, 'icons', 'app-icon.png')
+APP_ICON_SIZE = 192
+SOURCE_ICON_MAX_SIZE = 512
+
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.html')
+
+
+def optimize_icon():
+    """Genera el icono de la web (192 px, paleta de 256 colores) y reduce el original a 512 px"""
+    if not os.path.exists(SOURCE_ICON):
+        return
+
+    with Image.open(SOURCE_ICON) as img:
+        img = img.convert('RGB')
+        if not os.path.exists(APP_ICON):
+            icon = img.resize((APP_ICON_SIZE, APP_ICON_SIZE), Image.LANCZOS)
+            icon.quantize(256, method=Image.Quantize.MEDIANCUT).save(APP_ICON, 'PNG', optimize=True)
+            logging.info(f"Icono optimizado: {os.path.relpath(APP_ICON, BASE_DIR)} ({os.path.getsize(APP_ICON)} bytes)")
+
+        if max(img.size) > SOURCE_ICON_MAX_SIZE:
+            before = os.path.getsize(SOURCE_ICON)
+            small = img.resize((SOURCE_ICON_MAX_SIZE, SOURCE_ICON_MAX_SIZE), Image.LANCZOS)
+            small.quantize(256, method=Image.Quantize.MEDIANCUT).save(SOURCE_ICON, 'PNG', optimize=True)
+            logging.info(f"generated-icon.png: {before} -> {os.path.getsize(SOURCE_ICON)} bytes")
+
+
+def iter_sources():
+    for root, dirs, files in os.walk(STATIC_DIR):
+        if os.path.abspath(root).startswith(DIST_DIR):
+            continue
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            yield os.path.relpath(path, STATIC_DIR).replace(os.sep, '/'), path
+
+
+def fingerprint(rel_path, content):
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    stem, ext = os.path.splitext(rel_path)
+    return f"{stem}.{digest}{ext}"
+
+
+def build():
+    if os.path.isdir(DIST_DIR):
+        shutil.rmtree(DIST_DIR)
+    os.makedirs(DIST_DIR)
+
+    manifest = {}
+    for rel_path, path in iter_sources():
+        with open(path, 'rb') as f:
+            content = f.read()
+
+        hashed = fingerprint(rel_path, content)
+        target = os.path.join(DIST_DIR, hashed)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as f:
+            f.write(content)
+
+        if rel_path.endswith(COMPRESSIBLE):
+            # mtime=0 para que el .gz sea reproducible entre builds
+            with open(target + '.gz', 'wb') as f:
+                f.write(gzip.compress(content, compresslevel=9, mtime=0))
+            with open(target + '.br', 'wb') as f:
+                f.write(brotli.compress(content, quality=11))
+
+        manifest[rel_path] = hashed
+        logging.info(f"{rel_path} -> dist/{hashed}")
+
+    with open(MANIFEST_PATH, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    optimize_icon()
+    build()
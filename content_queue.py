@@ -0,0 +1,96 @@
+import hashlib
+import logging
+from datetime import datetime
+
+from app import db
+from models import Account, QueueItem
+
+
+def sort_key(account, file_id, file_name, modified_time):
+    """Clave de orden de un elemento según la configuración de la cuenta.
+
+    Es estable por fichero, así que los elementos nuevos se intercalan en la cola
+    sin tener que reordenar los que ya estaban.
+    """
+    if account.queue_order == 'modified':
+        return f"{modified_time or ''}|{file_id}"
+    if account.queue_order == 'random':
+        return hashlib.sha256(f"{account.queue_seed or 0}:{file_id}".encode('utf-8')).hexdigest()
+    return f"{(file_name or '').lower()}|{file_id}"[:255]
+
+
+def refill(account_id, images):
+    """Añade a la cola las imágenes nuevas del listado de Drive.
+
+    Solo se insertan los ficheros que aún no están en la cola; los pendientes que ya
+    no aparecen en Drive (borrados o renombrados fuera de la app) se marcan como retirados.
+    """
+    account = Account.query.get(account_id)
+    queued = {item.file_id: item for item in QueueItem.query.filter_by(account_id=account_id)}
+    listed_ids = set()
+    added = 0
+
+    for image in images:
+        listed_ids.add(image['id'])
+        item = queued.get(image['id'])
+        if item is None:
+            db.session.add(QueueItem(
+                account_id=account_id,
+                file_id=image['id'],
+                file_name=image['name'],
+                modified_time=image.get('modifiedTime'),
+                sort_key=sort_key(account, image['id'], image['name'], image.get('modifiedTime')),
+                status='pending'
+            ))
+            added += 1
+        elif item.status == 'removed':
+            item.status = 'pending'
+
+    removed = 0
+    for file_id, item in queued.items():
+        if item.status == 'pending' and file_id not in listed_ids:
+            item.status = 'removed'
+            removed += 1
+
+    db.session.commit()
+    if added or removed:
+        logging.info(f"Cola de la cuenta {account_id}: {added} imágenes añadidas, {removed} retiradas")
+    return added
+
+
+def next_batch(account_id, limit=None, exclude_ids=None):
+    """Siguientes elementos pendientes de la cola, hasta la cuota por slot de la cuenta"""
+    if limit is None:
+        account = Account.query.get(account_id)
+        limit = max(1, account.posts_per_slot or 1)
+    query = QueueItem.query.filter_by(account_id=account_id, status='pending')
+    if exclude_ids:
+        query = query.filter(QueueItem.id.not_in(exclude_ids))
+    return query.order_by(QueueItem.sort_key, QueueItem.id).limit(limit).all()
+
+
+def mark(item, status):
+    item.status = status
+    item.updated_at = datetime.utcnow()
+    db.session.commit()
+
+
+def retry_later(item):
+    """Deja la imagen pendiente tras un error transitorio para el siguiente horario"""
+    item.attempts = (item.attempts or 0) + 1
+    item.updated_at = datetime.utcnow()
+    db.session.commit()
+
+
+def reorder(account):
+    """Recalcula el orden de los elementos pendientes tras cambiar el criterio de la cuenta"""
+    for item in QueueItem.query.filter_by(account_id=account.id, status='pending'):
+        item.sort_key = sort_key(account, item.file_id, item.file_name, item.modified_time)
+    db.session.commit()
+
+
+def pending_counts():
+    """Número de elementos pendientes por cuenta ({account_id: n}) en una sola consulta"""
+    rows = db.session.query(QueueItem.account_id, db.func.count(QueueItem.id)) \
+        .filter(QueueItem.status == 'pending').group_by(QueueItem.account_id)
+    return dict(rows.all())
@@ -0,0 +1,176 @@
+"""Descargas de Drive por rangos, reanudables y verificadas con md5Checksum.
+
+El fichero se descarga en trozos de DRIVE_CHUNK_SIZE bytes con cabeceras Range
+sobre uno o varios segmentos (<destino>.part0, .part1, ...). Los segmentos se
+quedan en disco si la descarga falla, así que el siguiente intento (aunque sea
+en otro proceso) continúa desde el último byte recibido. Los ficheros grandes
+(>= DRIVE_PARALLEL_MIN_BYTES) se descargan en DRIVE_PARALLEL_RANGES segmentos a
+la vez. Al terminar se unen los segmentos y se comprueba el MD5 de Drive.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from app import app
+
+
+class ChecksumError(Exception):
+    """El MD5 del fichero descargado no coincide con el md5Checksum de Drive"""
+
+
+def part_path(file_path, index):
+    return f"{file_path}.part{index}"
+
+
+def state_path(file_path):
+    return f"{file_path}.part.json"
+
+
+def remove_parts(file_path):
+    """Borra los segmentos parciales y su estado"""
+    directory = os.path.dirname(file_path) or '.'
+    prefix = os.path.basename(file_path) + '.part'
+    for name in os.listdir(directory):
+        if name.startswith(prefix):
+            os.remove(os.path.join(directory, name))
+
+
+def plan_segments(size, parallel, min_parallel_bytes):
+    """Rangos [inicio, fin] (inclusivos) en que se divide la descarga; fin None = hasta el final"""
+    if not size:
+        return [[0, None]]
+    count = parallel if parallel > 1 and size >= min_parallel_bytes else 1
+    step = -(-size // count)
+    return [[start, min(start + step, size) - 1] for start in range(0, size, step)]
+
+
+def load_segments(file_path, metadata, parallel, min_parallel_bytes):
+    """Segmentos de una descarga anterior del mismo contenido, o un plan nuevo.
+
+    Si el fichero ha cambiado en Drive (otro md5 o tamaño) se descartan los parciales.
+    """
+    try:
+        with open(state_path(file_path)) as f:
+            state = json.load(f)
+        if state.get('md5') == metadata.get('md5Checksum') and state.get('size') == metadata.get('size'):
+            return state['segments']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    remove_parts(file_path)
+    segments = plan_segments(metadata.get('size'), parallel, min_parallel_bytes)
+    with open(state_path(file_path), 'w') as f:
+        json.dump({'md5': metadata.get('md5Checksum'), 'size': metadata.get('size'), 'segments': segments}, f)
+    return segments
+
+
+def _thread_http(service):
+    """Cliente HTTP propio para un hilo (httplib2 no es seguro entre hilos)"""
+    credentials = getattr(getattr(service, '_http', None), 'credentials', None)
+    if credentials is None:
+        return None
+    import google_auth_httplib2
+    return google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
+
+
+def _fetch_range(service, file_id, start, end, http=None):
+    request = service.files().get_media(fileId=file_id)
+    request.headers['Range'] = f"bytes={start}-{'' if end is None else end}"
+    try:
+        return request.execute(http=http)
+    except HttpError as e:
+        if e.resp.status == 416:
+            # Rango fuera del fichero: el segmento ya estaba completo
+            return b''
+        raise
+
+
+def download_segment(service, file_id, path, start, end, chunk_size, retries, http=None):
+    """Completa un segmento desde donde se quedó, reintentando con espera exponencial"""
+    attempt = 0
+    while True:
+        done = os.path.getsize(path) if os.path.exists(path) else 0
+        position = start + done
+        if end is not None and position > end:
+            return
+        chunk_end = position + chunk_size - 1
+        if end is not None:
+            chunk_end = min(chunk_end, end)
+
+        try:
+            data = _fetch_range(service, file_id, position, chunk_end, http=http)
+        except Exception as e:
+            attempt += 1
+            if attempt > retries:
+                raise
+            delay = min(30, 2 ** (attempt - 1))
+            logging.warning(f"Error al descargar {file_id} (bytes {position}-{chunk_end}), "
+                            f"reintento {attempt}/{retries} en {delay} s: {str(e)}")
+            time.sleep(delay)
+            continue
+
+        attempt = 0
+        with open(path, 'ab') as f:
+            f.write(data)
+        # Sin tamaño conocido, un trozo incompleto indica el final del fichero
+        if end is None and len(data) < chunk_end - position + 1:
+            return
+
+
+def download(service, file_id, file_path, metadata=None):
+    """Descarga un fichero de Drive en file_path y devuelve la ruta"""
+    chunk_size = app.config["DRIVE_CHUNK_SIZE"]
+    retries = app.config["DRIVE_DOWNLOAD_RETRIES"]
+    parallel = app.config["DRIVE_PARALLEL_RANGES"]
+
+    if metadata is None:
+        metadata = service.files().get(fileId=file_id, fields="size, md5Checksum").execute()
+    if metadata.get('size') is not None:
+        metadata = dict(metadata, size=int(metadata['size']))
+
+    segments = load_segments(file_path, metadata, parallel, app.config["DRIVE_PARALLEL_MIN_BYTES"])
+    resumed = sum(os.path.getsize(part_path(file_path, i)) for i in range(len(segments))
+                  if os.path.exists(part_path(file_path, i)))
+    if resumed:
+        logging.info(f"Reanudando la descarga de {os.path.basename(file_path)} desde {resumed} bytes")
+
+    if len(segments) > 1 and _thread_http(service) is not None:
+        with ThreadPoolExecutor(max_workers=len(segments)) as pool:
+            futures = [pool.submit(download_segment, service, file_id, part_path(file_path, i), start, end,
+                                   chunk_size, retries, _thread_http(service))
+                       for i, (start, end) in enumerate(segments)]
+            for future in futures:
+                future.result()
+    else:
+        for i, (start, end) in enumerate(segments):
+            download_segment(service, file_id, part_path(file_path, i), start, end, chunk_size, retries)
+
+    return assemble(file_path, len(segments), metadata.get('md5Checksum'))
+
+
+def assemble(file_path, segment_count, expected_md5):
+    """Une los segmentos en file_path comprobando el MD5 (si Drive lo proporciona)"""
+    digest = hashlib.md5()
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, 'wb') as out:
+        for i in range(segment_count):
+            with open(part_path(file_path, i), 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(block)
+                    out.write(block)
+
+    if expected_md5 and digest.hexdigest() != expected_md5:
+        os.remove(tmp_path)
+        remove_parts(file_path)
+        raise ChecksumError(f"MD5 de {os.path.basename(file_path)} no coincide con Drive "
+                            f"({digest.hexdigest()} != {expected_md5})")
+
+    os.replace(tmp_path, file_path)
+    remove_parts(file_path)
+    return file_path
@@ -1,42 +1,26 @@
-import os
+import logging
 import smtplib
+import threading
+import time
+from datetime import datetime, timedelta
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.header import Header
 from flask import url_for
 
+from app import app, db
+from models import EmailOutbox
+
 def send_reset_email(user, token, app):
     """
-    Envía un correo electrónico con un enlace para restablecer la contraseña
+    Encola un correo electrónico con un enlace para restablecer la contraseña.
+    El envío lo hace email_sender en segundo plano, sin bloquear la petición.
     """
     with app.app_context():
         reset_url = url_for('reset_password', token=token, user_id=user.id, _external=True)
-        
-        # Configuración del correo
-        try:
-            # Si no hay credenciales de correo electrónico, solo simulamos el envío
-            if not os.environ.get("EMAIL_USER") or not os.environ.get("EMAIL_PASSWORD"):
-                print(f"SIMULANDO ENVÍO DE CORREO: Usuario: {user.username}, Token: {token}")
-                print(f"URL de restablecimiento: {reset_url}")
-                return True
-                
-            # Configuración real de correo electrónico
-            sender_email = os.environ.get("EMAIL_USER")
-            sender_password = os.environ.get("EMAIL_PASSWORD")
-            
-            if not sender_email or not sender_password:
-                print(f"SIMULANDO ENVÍO DE CORREO (credenciales inválidas): Usuario: {user.username}, Token: {token}")
-                print(f"URL de restablecimiento: {reset_url}")
-                return True
-            
-            # Crear mensaje
-            msg = MIMEMultipart()
-            msg['From'] = sender_email
-            msg['To'] = user.email
-            msg['Subject'] = Header('Restablecimiento de contraseña - Instagram Auto Publisher', 'utf-8')
-            
-            # Contenido del correo
-            html = f"""
+
+        # Contenido del correo
+        html = f"""
             <html>
               <body>
                 <h2>Restablecimiento de Contraseña</h2>
@@ -49,24 +33,195 @@ def send_reset_email(user, token, app):
               </body>
             </html>
             """
-            
-            msg.attach(MIMEText(html, 'html', 'utf-8'))
-            
-            # Enviar correo
-            try:
-                with smtplib.SMTP_SSL('smtp.gmail.com', 465) as server:
-                    server.login(sender_email, sender_password)
-                    server.sendmail(sender_email, user.email, msg.as_string())
-            except Exception as e:
-                print(f"Error al enviar correo: {str(e)}")
-                print(f"URL de restablecimiento: {reset_url}")
-                # En modo desarrollo, seguimos devolviendo True para facilitar pruebas
-                return True
-                
-            return True
-            
+
+        try:
+            enqueue_email(user.email, 'Restablecimiento de contraseña - Instagram Auto Publisher', html)
         except Exception as e:
-            print(f"Error al enviar correo: {str(e)}")
+            db.session.rollback()
+            logging.error(f"Error al encolar el correo: {str(e)}")
             # En desarrollo, aún devolvemos la URL para facilitar las pruebas
-            print(f"URL de restablecimiento: {reset_url}")
-            return False
\ No newline at end of file
+            logging.info(f"URL de restablecimiento: {reset_url}")
+            return False
+
+        if app.config["EMAIL_SIMULATE"]:
+            # Sin credenciales de correo solo se simula el envío
+            logging.info(f"SIMULANDO ENVÍO DE CORREO: Usuario: {user.username}, Token: {token}")
+            logging.info(f"URL de restablecimiento: {reset_url}")
+        return True
+
+def enqueue_email(recipient, subject, html):
+    """Guarda el correo en la bandeja de salida y despierta al remitente en segundo plano"""
+    db.session.add(EmailOutbox(recipient=recipient, subject=subject, html=html))
+    db.session.commit()
+    email_sender.start()
+    email_sender.wake()
+
+
+def permanent_error(error):
+    """El servidor rechazó el correo con un 5xx (destinatario o remitente inválidos, mensaje
+    rechazado): reintentarlo no cambia nada. Los 4xx y los errores de conexión son transitorios,
+    y un fallo de autenticación se reintenta hasta que se corrijan las credenciales
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        return False
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+
+class EmailSender:
+    """Envía los correos de email_outbox desde un hilo propio.
+
+    Mantiene abierta la conexión SMTP autenticada entre lotes (comprobándola con
+    NOOP antes de reutilizarla) y la cierra tras SMTP_IDLE_SECONDS sin correos.
+    Un envío fallido se reintenta con espera exponencial hasta EMAIL_MAX_ATTEMPTS,
+    salvo que el servidor lo rechace definitivamente (5xx, ver permanent_error).
+    """
+
+    def __init__(self):
+        self._thread = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._server = None
+        self._last_used = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='email-sender', daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def _run(self):
+        try:
+            with app.app_context():
+                self.release_stale()
+        except Exception as e:
+            logging.error(f"Error al recuperar los correos a medio enviar: {str(e)}")
+        while True:
+            # Ninguna excepción debe terminar el hilo: los reintentos dependen de él. La
+            # sesión la retira el teardown del app context
+            try:
+                self._wakeup.clear()
+                try:
+                    with app.app_context():
+                        sent = self.send_pending()
+                        wait = 0 if sent else self._idle_wait()
+                except Exception as e:
+                    logging.error(f"Error en el envío de correos: {str(e)}")
+                    wait = 30
+                if wait:
+                    self._wakeup.wait(wait)
+                if self._server is not None and time.monotonic() - self._last_used > app.config["SMTP_IDLE_SECONDS"]:
+                    self._disconnect()
+            except Exception as e:
+                logging.error(f"Error en el hilo de envío de correos: {str(e)}")
+                time.sleep(30)
+
+    def _idle_wait(self):
+        """Segundos hasta el próximo reintento programado (como mucho un minuto)"""
+        next_attempt = db.session.query(db.func.min(EmailOutbox.next_attempt_at)).filter(
+            EmailOutbox.status == 'pending').scalar()
+        if next_attempt is None:
+            return 60
+        return min(60, max(1, (next_attempt - datetime.utcnow()).total_seconds()))
+
+    def release_stale(self):
+        """Devuelve a 'pending' los correos que quedaron a medio enviar en un proceso anterior"""
+        cutoff = datetime.utcnow() - timedelta(minutes=5)
+        EmailOutbox.query.filter(EmailOutbox.status == 'sending', EmailOutbox.next_attempt_at < cutoff).update(
+            {'status': 'pending'}, synchronize_session=False)
+        db.session.commit()
+
+    def send_pending(self):
+        """Envía un lote de correos vencidos y devuelve cuántos se han procesado"""
+        now = datetime.utcnow()
+        batch = EmailOutbox.query.filter(
+            EmailOutbox.status == 'pending', EmailOutbox.next_attempt_at <= now
+        ).order_by(EmailOutbox.next_attempt_at).limit(app.config["EMAIL_BATCH_SIZE"]).all()
+
+        processed = 0
+        for message in batch:
+            # Reclamar el correo: con varios procesos solo uno lo envía
+            claimed = EmailOutbox.query.filter_by(id=message.id, status='pending').update(
+                {'status': 'sending', 'next_attempt_at': now}, synchronize_session=False)
+            db.session.commit()
+            if not claimed:
+                continue
+
+            db.session.refresh(message)
+            try:
+                self._deliver(message)
+                message.status = 'sent'
+                message.sent_at = datetime.utcnow()
+                message.last_error = None
+            except Exception as e:
+                self._disconnect()
+                message.attempts += 1
+                message.last_error = str(e)
+                if permanent_error(e) or message.attempts >= app.config["EMAIL_MAX_ATTEMPTS"]:
+                    message.status = 'failed'
+                    logging.error(f"Correo a {message.recipient} descartado tras {message.attempts} intentos: {str(e)}")
+                else:
+                    delay = app.config["EMAIL_RETRY_BASE_SECONDS"] * 2 ** (message.attempts - 1)
+                    message.status = 'pending'
+                    message.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+                    logging.warning(f"Error al enviar correo a {message.recipient} (intento {message.attempts}), "
+                                    f"se reintenta en {delay} s: {str(e)}")
+            db.session.commit()
+            processed += 1
+        return processed
+
+    def _deliver(self, message):
+        if app.config["EMAIL_SIMULATE"]:
+            logging.info(f"SIMULANDO ENVÍO DE CORREO a {message.recipient}: {message.subject}")
+            return
+
+        sender_email = app.config["EMAIL_FROM"]
+        msg = MIMEMultipart()
+        msg['From'] = sender_email
+        msg['To'] = message.recipient
+        msg['Subject'] = Header(message.subject, 'utf-8')
+        msg.attach(MIMEText(message.html, 'html', 'utf-8'))
+
+        self._connection().sendmail(sender_email, message.recipient, msg.as_string())
+        self._last_used = time.monotonic()
+        logging.info(f"Correo enviado a {message.recipient}")
+
+    def _connection(self):
+        """Conexión SMTP autenticada, reutilizada mientras siga respondiendo"""
+        if self._server is not None:
+            try:
+                if self._server.noop()[0] == 250:
+                    return self._server
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._disconnect()
+
+        host, port, timeout = app.config["SMTP_HOST"], app.config["SMTP_PORT"], app.config["SMTP_TIMEOUT"]
+        if app.config["SMTP_SSL"]:
+            server = smtplib.SMTP_SSL(host, port, timeout=timeout)
+        else:
+            server = smtplib.SMTP(host, port, timeout=timeout)
+            if app.config["SMTP_STARTTLS"]:
+                server.starttls()
+        if app.config["EMAIL_USER"] and app.config["EMAIL_PASSWORD"]:
+            server.login(app.config["EMAIL_USER"], app.config["EMAIL_PASSWORD"])
+        logging.info(f"Conexión SMTP abierta con {host}:{port}")
+        self._server = server
+        return server
+
+    def _disconnect(self):
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except Exception:
+            pass
+        self._server = None
+
+
+email_sender = EmailSender()
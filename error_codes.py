@@ -0,0 +1,200 @@
+"""Clasificación de los errores de publicación en códigos.
+
+Cada fallo se guarda en publication_history con un código corto (columna indexada
+error_code) y su texto completo, una sola vez, en la tabla error_message. La
+política de reintentos y los resúmenes del dashboard trabajan con los códigos en
+lugar de buscar fragmentos en los mensajes.
+"""
+import enum
+import hashlib
+import logging
+import re
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app import db
+from models import ErrorMessage, PublicationHistory
+
+
+class ErrorCode(str, enum.Enum):
+    IG_LOGIN_REQUIRED = 'ig_login_required'
+    IG_BAD_CREDENTIALS = 'ig_bad_credentials'
+    IG_CHALLENGE = 'ig_challenge'
+    IG_RATE_LIMITED = 'ig_rate_limited'
+    IG_UPLOAD = 'ig_upload'
+    DRIVE_NOT_FOUND = 'drive_not_found'
+    DRIVE_FORBIDDEN = 'drive_forbidden'
+    DRIVE_RATE_LIMITED = 'drive_rate_limited'
+    CHECKSUM = 'checksum'
+    GEMINI_QUOTA = 'gemini_quota'
+    TIMEOUT = 'timeout'
+    NETWORK = 'network'
+    CONFIG = 'config'
+    UNKNOWN = 'unknown'
+
+
+LABELS = {
+    ErrorCode.IG_LOGIN_REQUIRED: "Sesión de Instagram caducada",
+    ErrorCode.IG_BAD_CREDENTIALS: "Credenciales de Instagram incorrectas",
+    ErrorCode.IG_CHALLENGE: "Instagram pide verificación manual",
+    ErrorCode.IG_RATE_LIMITED: "Instagram limita la frecuencia",
+    ErrorCode.IG_UPLOAD: "Subida rechazada por Instagram",
+    ErrorCode.DRIVE_NOT_FOUND: "Carpeta o fichero de Drive no encontrado",
+    ErrorCode.DRIVE_FORBIDDEN: "Sin permiso en Drive",
+    ErrorCode.DRIVE_RATE_LIMITED: "Drive limita la frecuencia",
+    ErrorCode.CHECKSUM: "Descarga corrupta (MD5)",
+    ErrorCode.GEMINI_QUOTA: "Cuota de Gemini agotada",
+    ErrorCode.TIMEOUT: "Tiempo de espera agotado",
+    ErrorCode.NETWORK: "Error de red",
+    ErrorCode.CONFIG: "Configuración incompleta",
+    ErrorCode.UNKNOWN: "Otros errores",
+}
+
+# Errores transitorios: la imagen vuelve a la cola y se reintenta en el siguiente horario
+RETRYABLE = frozenset({
+    ErrorCode.IG_LOGIN_REQUIRED,
+    ErrorCode.IG_RATE_LIMITED,
+    ErrorCode.DRIVE_RATE_LIMITED,
+    ErrorCode.CHECKSUM,
+    ErrorCode.GEMINI_QUOTA,
+    ErrorCode.TIMEOUT,
+    ErrorCode.NETWORK,
+})
+
+# (código, nombres de clases de excepción, fragmentos del mensaje en minúsculas), por
+# orden de prioridad. Se comparan nombres de clase para no importar instagrapi y
+# google-api-core aquí; el texto sirve para los mensajes ya guardados
+_RULES = [
+    (ErrorCode.IG_CHALLENGE, ('ChallengeRequired', 'ChallengeError', 'RecaptchaChallengeForm'),
+     ('challenge_required', "unexpected token '<'", 'requiere verificación manual',
+      'check the code we sent you')),
+    # instagrapi da BadPassword con este texto cuando Instagram bloquea el inicio de sesión
+    (ErrorCode.IG_BAD_CREDENTIALS, ('BadPassword', 'BadCredentials'),
+     ('bad_password', 'password you entered is incorrect', 'linked facebook account')),
+    (ErrorCode.IG_LOGIN_REQUIRED, ('LoginRequired', 'ReloginAttemptExceeded'),
+     ('login_required',)),
+    (ErrorCode.IG_RATE_LIMITED, ('PleaseWaitFewMinutes', 'RateLimitError', 'FeedbackRequired'),
+     ('please wait a few minutes', 'feedback_required')),
+    # Drive responde 403 (no 429) cuando se supera la cuota por usuario
+    (ErrorCode.DRIVE_RATE_LIMITED, (),
+     ('ratelimitexceeded',)),
+    (ErrorCode.GEMINI_QUOTA, ('ResourceExhausted', 'TooManyRequests'),
+     ('resource has been exhausted', 'resource_exhausted')),
+    (ErrorCode.CHECKSUM, ('ChecksumError',),
+     ('md5 de',)),
+    (ErrorCode.TIMEOUT, ('TimeoutError', 'Timeout', 'DeadlineExceeded'),
+     ('timed out', 'timeout', 'deadline exceeded')),
+    (ErrorCode.NETWORK, ('ConnectionError', 'ProtocolError', 'ServiceUnavailable'),
+     ('connection aborted', 'connection reset', 'max retries exceeded', 'temporarily unavailable')),
+    (ErrorCode.DRIVE_NOT_FOUND, (),
+     ('file not found', 'no existe o no es accesible')),
+    (ErrorCode.CONFIG, (),
+     ('no se ha configurado',)),
+]
+
+# INSERT ... ON CONFLICT DO NOTHING de cada base
+_INSERT_IGNORE = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+# Estado HTTP de los HttpError de googleapiclient (de la excepción o de su texto guardado)
+_HTTP_STATUS = {404: ErrorCode.DRIVE_NOT_FOUND, 403: ErrorCode.DRIVE_FORBIDDEN, 429: ErrorCode.DRIVE_RATE_LIMITED}
+_HTTP_ERROR_TEXT = re.compile(r'httperror (\d{3})')
+
+
+def classify(error, default=ErrorCode.UNKNOWN):
+    """Código de una excepción o de un mensaje de error"""
+    if isinstance(error, BaseException):
+        names = {cls.__name__ for cls in type(error).__mro__}
+        for code, classes, _ in _RULES:
+            if names.intersection(classes):
+                return code
+
+    text = str(error).lower()
+    for code, _, fragments in _RULES:
+        if any(fragment in text for fragment in fragments):
+            return code
+
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    if status is None:
+        match = _HTTP_ERROR_TEXT.search(text)
+        status = int(match.group(1)) if match else None
+    return _HTTP_STATUS.get(int(status), default) if status is not None else default
+
+
+def classify_gemini(error):
+    """Código de un error al pedir la descripción a Gemini (un 429 es la cuota, no Drive).
+
+    El estado sale de la excepción: .status en aiohttp y .code en google-api-core
+    (ResourceExhausted/TooManyRequests ya se reconocen por la clase). No se busca
+    '429' en el texto, que puede aparecer en cualquier mensaje.
+    """
+    if isinstance(error, BaseException):
+        for attribute in ('status', 'code'):
+            status = getattr(error, attribute, None)
+            if isinstance(status, int) and status == 429:
+                return ErrorCode.GEMINI_QUOTA
+    return classify(error)
+
+
+def retryable(code):
+    return code in RETRYABLE
+
+
+def label(code):
+    try:
+        return LABELS[ErrorCode(code)]
+    except ValueError:
+        return code
+
+
+def message_id(text):
+    """Id de error_message para el texto (se inserta si no existía)"""
+    digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    existing = db.session.query(ErrorMessage.id).filter_by(digest=digest).scalar()
+    if existing is not None:
+        return existing
+
+    # Inserción que ignora el duplicado si otra ejecución guardó el mismo texto a la vez
+    insert = _INSERT_IGNORE.get(db.session.get_bind().dialect.name)
+    if insert is not None:
+        db.session.execute(insert(ErrorMessage.__table__).values(digest=digest, text=text).on_conflict_do_nothing())
+    else:
+        db.session.add(ErrorMessage(digest=digest, text=text))
+        db.session.flush()
+    return db.session.query(ErrorMessage.id).filter_by(digest=digest).scalar()
+
+
+def error_fields(message, code):
+    """Columnas de publication_history para un error: código y texto deduplicado"""
+    return {
+        'details': None,
+        'error_code': ErrorCode(code).value,
+        'error_message_id': message_id(message) if message else None,
+    }
+
+
+def backfill(batch_size=5000):
+    """Clasifica los errores guardados antes de existir error_code y mueve su texto a error_message"""
+    table = PublicationHistory.__table__
+    update = table.update().where(table.c.id == db.bindparam('row_id')).values(
+        error_code=db.bindparam('code'), error_message_id=db.bindparam('message'), details=None)
+    last_id = 0
+    total = 0
+    while True:
+        rows = db.session.query(PublicationHistory.id, PublicationHistory.details).filter(
+            PublicationHistory.status == 'error', PublicationHistory.id > last_id
+        ).order_by(PublicationHistory.id).limit(batch_size).all()
+        if not rows:
+            break
+        ids = {}
+        params = []
+        for row_id, details in rows:
+            if details and details not in ids:
+                ids[details] = message_id(details)
+            params.append({'row_id': row_id, 'code': classify(details or '').value,
+                           'message': ids.get(details)})
+        db.session.execute(update, params)
+        db.session.commit()
+        last_id = rows[-1][0]
+        total += len(rows)
+    if total:
+        logging.info(f"Migración completada: {total} errores del historial clasificados")
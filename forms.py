@@ -1,6 +1,8 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, BooleanField, TextAreaField, SubmitField, TimeField
-from wtforms.validators import DataRequired, Email, EqualTo, Length, Optional, ValidationError
+from wtforms import StringField, PasswordField, BooleanField, TextAreaField, SubmitField, TimeField, IntegerField, SelectField, SelectMultipleField
+from wtforms.widgets import ListWidget, CheckboxInput
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from wtforms.validators import DataRequired, Email, EqualTo, Length, Optional, ValidationError, NumberRange
 from models import User
 
 class LoginForm(FlaskForm):
@@ -16,6 +18,16 @@ class AdminForm(FlaskForm):
     password2 = PasswordField('Confirmar Contraseña', validators=[DataRequired(), EqualTo('password')])
     submit = SubmitField('Crear Cuenta')
 
+WEEKDAY_CHOICES = [(0, 'Lun'), (1, 'Mar'), (2, 'Mié'), (3, 'Jue'), (4, 'Vie'), (5, 'Sáb'), (6, 'Dom')]
+
+class WeekdaysField(SelectMultipleField):
+    """Días de la semana como casillas; el valor es una lista de 0 (lunes) a 6 (domingo)"""
+    widget = ListWidget(prefix_label=False)
+    option_widget = CheckboxInput()
+
+    def __init__(self, label=None, **kwargs):
+        super().__init__(label, choices=WEEKDAY_CHOICES, coerce=int, default=list(range(7)), **kwargs)
+
 class AccountForm(FlaskForm):
     name = StringField('Nombre de la Cuenta', validators=[DataRequired()])
     instagram_username = StringField('Usuario de Instagram', validators=[DataRequired()])
@@ -23,6 +35,8 @@ class AccountForm(FlaskForm):
     google_credentials = TextAreaField('Credenciales de Google (Base64)', validators=[Optional()])
     folder_id = StringField('ID de Carpeta de Google Drive', validators=[DataRequired()])
     gemini_api_key = StringField('Clave API de Gemini', validators=[DataRequired()])
+    gemini_model = StringField('Modelo de Gemini', validators=[Optional(), Length(max=64)])
+    gemini_timeout = IntegerField('Tiempo máximo por descripción (segundos)', validators=[Optional(), NumberRange(min=5, max=600)])
     
     # Gemini Prompt settings
     gemini_prompt = TextAreaField('Prompt para Gemini (generación de descripciones)', validators=[Optional()], 
@@ -37,8 +51,28 @@ class AccountForm(FlaskForm):
     
     evening_post = BooleanField('Publicar en la noche', default=True)
     evening_time = StringField('Hora (noche)', default="22:00", validators=[Optional()])
+
+    morning_days = WeekdaysField('Días (mañana)')
+    afternoon_days = WeekdaysField('Días (tarde)')
+    evening_days = WeekdaysField('Días (noche)')
+    timezone = StringField('Zona horaria (p. ej. Europe/Madrid)', validators=[Optional(), Length(max=64)])
+    
+    # Content queue settings
+    posts_per_slot = IntegerField('Imágenes por publicación', default=1, validators=[DataRequired(), NumberRange(min=1, max=20)])
+    queue_order = SelectField('Orden de la cola', default="name", choices=[
+        ('name', 'Por nombre'),
+        ('modified', 'Por fecha de modificación'),
+        ('random', 'Aleatorio (con semilla)'),
+    ])
+    queue_seed = IntegerField('Semilla (orden aleatorio)', default=0, validators=[Optional()])
     
     submit = SubmitField('Guardar')
+
+    def validate_timezone(self, timezone):
+        try:
+            ZoneInfo(timezone.data)
+        except (ZoneInfoNotFoundError, ValueError):
+            raise ValidationError('Zona horaria desconocida.')
     
 class RequestResetForm(FlaskForm):
     email = StringField('Email', validators=[DataRequired(), Email()])
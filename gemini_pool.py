@@ -0,0 +1,114 @@
+"""Clientes de Gemini reutilizables, uno por clave de API.
+
+genai.configure() cambia la configuración global del paquete: con dos cuentas de
+claves distintas publicando a la vez, una podía llamar a Gemini con la clave de la
+otra, y cada descripción volvía a crear el cliente y su transporte. GeminiPool crea
+un GenerativeServiceClient por clave y un GenerativeModel por clave y modelo, y los
+comparte entre llamadas y entre hilos (los clientes de google-api-core son seguros
+entre hilos). También guarda la latencia de las llamadas de cada clave.
+"""
+import hashlib
+import statistics
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+import google.generativeai as genai
+from google.ai import generativelanguage as glm
+
+# Latencias recientes que se guardan por clave para los percentiles
+LATENCY_SAMPLES = 200
+
+
+def fingerprint(api_key):
+    """Identificador de la clave que se puede mostrar o registrar sin revelarla"""
+    return hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:10]
+
+
+class KeyStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.last_call_at = None
+        self.last_error = None
+
+    def as_dict(self):
+        latencies = sorted(self.latencies)
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'last_call_at': self.last_call_at.isoformat() + 'Z' if self.last_call_at else None,
+            'last_error': self.last_error,
+            'mean_ms': round(statistics.mean(latencies)) if latencies else None,
+            'p50_ms': latencies[len(latencies) // 2] if latencies else None,
+            'p95_ms': latencies[int(len(latencies) * 0.95)] if latencies else None,
+            'max_ms': latencies[-1] if latencies else None,
+        }
+
+
+class GeminiPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._models = {}
+        self._stats = {}
+
+    def _client(self, api_key):
+        client = self._clients.get(api_key)
+        if client is None:
+            client = self._clients[api_key] = glm.GenerativeServiceClient(client_options={'api_key': api_key})
+        return client
+
+    def model(self, api_key, model_name):
+        """GenerativeModel de la clave; se crea la primera vez y luego se reutiliza"""
+        with self._lock:
+            model = self._models.get((api_key, model_name))
+            if model is None:
+                model = genai.GenerativeModel(model_name)
+                # GenerativeModel no admite un cliente propio en el constructor: sin esto
+                # usaría el cliente global de genai.configure()
+                model._client = self._client(api_key)
+                self._models[(api_key, model_name)] = model
+            return model
+
+    def generate(self, api_key, model_name, contents, timeout=None):
+        """generate_content con el modelo de la clave, anotando la latencia"""
+        model = self.model(api_key, model_name)
+        request_options = {'timeout': timeout} if timeout else None
+        start = time.perf_counter()
+        try:
+            response = model.generate_content(contents, request_options=request_options)
+            text = response.text
+        except Exception as e:
+            self.record(api_key, (time.perf_counter() - start) * 1000, error=str(e))
+            raise
+        self.record(api_key, (time.perf_counter() - start) * 1000)
+        return text
+
+    def record(self, api_key, duration_ms, error=None):
+        """Anota una llamada (también las del cliente REST del motor asíncrono)"""
+        with self._lock:
+            stats = self._stats.setdefault(fingerprint(api_key), KeyStats())
+            stats.calls += 1
+            stats.latencies.append(int(duration_ms))
+            stats.last_call_at = datetime.utcnow()
+            if error is not None:
+                stats.errors += 1
+                stats.last_error = error[:200]
+
+    def discard(self, api_key):
+        """Olvida el cliente y los modelos de una clave que ya no se usa"""
+        with self._lock:
+            self._clients.pop(api_key, None)
+            for key in [key for key in self._models if key[0] == api_key]:
+                del self._models[key]
+
+    def stats(self):
+        """{huella de la clave: latencias y errores}"""
+        with self._lock:
+            return {key: stats.as_dict() for key, stats in self._stats.items()}
+
+
+gemini_pool = GeminiPool()
@@ -0,0 +1,183 @@
+"""Genera datos sintéticos para reproducir una base con años de historial.
+
+Crea cuentas (con sus horarios y cola de contenido), un usuario administrador y
+millones de filas de publication_history con una mezcla realista de estados:
+la mayoría de ejecuciones programadas no encuentran imágenes y solo dejan una
+fila 'info' ("No hay imágenes nuevas para procesar"), algunas publican y una
+pequeña parte falla. Usa DATABASE_URL, así que sirve igual para SQLite y PostgreSQL.
+
+Uso:
+    DISABLE_SCHEDULER=1 DATABASE_URL=sqlite:////tmp/synthetic.db \\
+        python generate_data.py --accounts 4 --rows 2000000 --years 3
+"""
+import argparse
+import logging
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from app import app, db
+from models import User, Account, PublicationHistory, QueueItem
+import error_codes
+import scheduling
+
+ERROR_MESSAGES = [
+    "Error al publicar en Instagram: Please wait a few minutes before you try again.",
+    "Error al publicar en Instagram: login_required",
+    "Error al obtener la descripción: 429 Resource has been exhausted (e.g. check quota).",
+    "<HttpError 404 when requesting https://www.googleapis.com/drive/v3/files?alt=json returned \"File not found\">",
+    "Error al publicar en Instagram: ChallengeRequired",
+    "HTTPSConnectionPool(host='i.instagram.com', port=443): Read timed out. (read timeout=30)",
+]
+
+INFO_MESSAGE = "No hay imágenes nuevas para procesar"
+
+
+def create_user(username, password):
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        user = User(username=username, email=f"{username}@example.com")
+        db.session.add(user)
+    user.set_password(password)
+    db.session.commit()
+    return user
+
+
+def create_accounts(count, queue_items, rnd):
+    accounts = []
+    for i in range(count):
+        account = Account(
+            name=f"Cuenta sintética {i + 1}",
+            instagram_username=f"synthetic_{i + 1}",
+            instagram_password="synthetic",
+            google_credentials="",
+            folder_id=f"synthetic-folder-{i + 1}",
+            gemini_api_key="synthetic",
+            posts_per_slot=1
+        )
+        db.session.add(account)
+        scheduling.sync_account_slots(account, {
+            label: (True, default_time, scheduling.ALL_DAYS, '')
+            for label, _, default_time in scheduling.FORM_SLOTS
+        })
+        accounts.append(account)
+    db.session.commit()
+
+    for account in accounts:
+        rows = []
+        for n in range(queue_items):
+            name = f"IMG_{rnd.randrange(10000):04d}_{n}.jpg"
+            rows.append({
+                'account_id': account.id,
+                'file_id': uuid.uuid4().hex,
+                'file_name': name,
+                'sort_key': name.lower(),
+                'status': 'pending',
+                'enqueued_at': datetime.utcnow(),
+                'updated_at': datetime.utcnow(),
+            })
+        if rows:
+            db.session.execute(QueueItem.__table__.insert(), rows)
+    db.session.commit()
+    return accounts
+
+
+def history_rows(accounts, total, years, info_ratio, error_ratio, rnd, message_ids):
+    """Filas de historial repartidas por ejecuciones (3 al día por cuenta) hasta `total`.
+
+    Los errores se guardan como la aplicación: código y texto en error_message (message_ids).
+    """
+    end = datetime.utcnow()
+    start = end - timedelta(days=365 * years)
+    span_seconds = (end - start).total_seconds()
+
+    produced = 0
+    while produced < total:
+        account = rnd.choice(accounts)
+        timestamp = start + timedelta(seconds=rnd.random() * span_seconds)
+        run_id = uuid.uuid4().hex
+        roll = rnd.random()
+
+        if roll < info_ratio:
+            rows = [(timestamp, 'info', INFO_MESSAGE, None)]
+        elif roll < info_ratio + error_ratio:
+            rows = [(timestamp, 'error', rnd.choice(ERROR_MESSAGES), f"IMG_{rnd.randrange(10000):04d}.jpg")]
+        else:
+            image = f"IMG_{rnd.randrange(10000):04d}.jpg"
+            rows = [(timestamp, 'success', f"Publicado con éxito. ID de media: {rnd.randrange(10**18)}_{rnd.randrange(10**10)}", image)]
+            # De vez en cuando, aviso de posible duplicado en la misma ejecución
+            if rnd.random() < 0.03:
+                rows.append((timestamp, 'info', f"Posible duplicado de IMG_{rnd.randrange(10000):04d}.jpg (distancia 2), se publica igualmente", image))
+
+        for ts, status, details, image_name in rows:
+            error = status == 'error'
+            yield {
+                'account_id': account.id,
+                'timestamp': ts,
+                'status': status,
+                'details': None if error else details,
+                'image_name': image_name,
+                'run_id': run_id,
+                'error_code': error_codes.classify(details).value if error else None,
+                'error_message_id': message_ids[details] if error else None,
+            }
+            produced += 1
+
+
+def insert_history(rows, batch_size):
+    table = PublicationHistory.__table__
+    batch = []
+    inserted = 0
+    started = time.perf_counter()
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            db.session.execute(table.insert(), batch)
+            db.session.commit()
+            inserted += len(batch)
+            batch = []
+            if inserted % (batch_size * 20) == 0:
+                rate = inserted / (time.perf_counter() - started)
+                logging.info(f"{inserted} filas de historial insertadas ({rate:.0f} filas/s)")
+    if batch:
+        db.session.execute(table.insert(), batch)
+        db.session.commit()
+        inserted += len(batch)
+    return inserted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Genera cuentas e historial sintéticos")
+    parser.add_argument('--accounts', type=int, default=4)
+    parser.add_argument('--rows', type=int, default=1_000_000, help="filas de publication_history")
+    parser.add_argument('--years', type=float, default=3)
+    parser.add_argument('--info-ratio', type=float, default=0.7, help="ejecuciones sin imágenes nuevas")
+    parser.add_argument('--error-ratio', type=float, default=0.05)
+    parser.add_argument('--queue-items', type=int, default=200, help="imágenes pendientes por cuenta")
+    parser.add_argument('--batch-size', type=int, default=10_000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--user', default='bench')
+    parser.add_argument('--password', default='benchmark')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    rnd = random.Random(args.seed)
+
+    with app.app_context():
+        logging.info(f"Base de datos: {db.engine.url.render_as_string(hide_password=True)}")
+        create_user(args.user, args.password)
+        accounts = create_accounts(args.accounts, args.queue_items, rnd)
+        message_ids = {message: error_codes.message_id(message) for message in ERROR_MESSAGES}
+        db.session.commit()
+        started = time.perf_counter()
+        inserted = insert_history(
+            history_rows(accounts, args.rows, args.years, args.info_ratio, args.error_ratio, rnd, message_ids),
+            args.batch_size
+        )
+        logging.info(f"{len(accounts)} cuentas y {inserted} filas de historial generadas "
+                     f"en {time.perf_counter() - started:.1f} s (usuario '{args.user}')")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+"""Caché en disco de imágenes de Drive compartida entre cuentas.
+
+Varias cuentas pueden apuntar a la misma carpeta de Drive (o a carpetas con
+ficheros en común) y cada una descargaba su propia copia de cada imagen. La caché
+guarda cada imagen una vez, con clave sha256(file_id + md5Checksum) (modifiedTime
+si Drive no da MD5), así que una versión modificada del fichero es otra entrada.
+
+Las entradas se enlazan (hard link, o copia si no se puede) en el directorio de
+staging de cada cuenta: borrar el fichero de staging no toca la caché y expulsar
+una entrada no rompe las copias que ya usan las cuentas. Cuando el tamaño total
+supera IMAGE_CACHE_MAX_BYTES se expulsan las entradas usadas hace más tiempo (la
+fecha de modificación de la entrada se actualiza en cada acierto). Las entradas se
+publican con os.replace, así que nunca se lee un fichero a medio escribir.
+"""
+import contextlib
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from app import app
+
+# Ficheros temporales de inserciones interrumpidas que se pueden borrar al expulsar
+STALE_TMP_SECONDS = 3600
+
+
+class ImageCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._evict_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+
+    @property
+    def directory(self):
+        return app.config["IMAGE_CACHE_DIR"]
+
+    @property
+    def max_bytes(self):
+        return app.config["IMAGE_CACHE_MAX_BYTES"]
+
+    def key(self, file_id, metadata):
+        """Clave del contenido de un fichero de Drive; None si no se puede cachear"""
+        version = metadata.get('md5Checksum') or metadata.get('modifiedTime')
+        if not self.max_bytes or not version:
+            return None
+        return hashlib.sha256(f"{file_id}:{version}".encode('utf-8')).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """Exclusión por clave dentro del proceso: una sola descarga de cada imagen a la vez"""
+        if key is None:
+            yield
+            return
+        with self._lock:
+            key_lock, users = self._key_locks.get(key, (threading.Lock(), 0))
+            self._key_locks[key] = (key_lock, users + 1)
+        try:
+            with key_lock:
+                yield
+        finally:
+            with self._lock:
+                key_lock, users = self._key_locks[key]
+                if users == 1:
+                    del self._key_locks[key]
+                else:
+                    self._key_locks[key] = (key_lock, users - 1)
+
+    def get(self, key, dest_path):
+        """Copia la entrada en dest_path si está en la caché; devuelve si hubo acierto"""
+        if key is None:
+            return False
+        entry = self.entry_path(key)
+        try:
+            _link_or_copy(entry, dest_path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return False
+        # La entrada ya está enlazada: aunque se expulse ahora, dest_path sigue completo
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(entry)
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += os.path.getsize(dest_path)
+        logging.info(f"Imagen {os.path.basename(dest_path)} tomada de la caché compartida")
+        return True
+
+    def put(self, key, path):
+        """Añade a la caché un fichero ya descargado y verificado"""
+        if key is None:
+            return
+        entry = self.entry_path(key)
+        if os.path.exists(entry):
+            os.utime(entry)
+            return
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp_path = f"{entry}.{uuid.uuid4().hex}.tmp"
+        try:
+            _link_or_copy(path, tmp_path)
+            os.replace(tmp_path, entry)
+        except OSError as e:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            logging.warning(f"No se pudo guardar {os.path.basename(path)} en la caché de imágenes: {str(e)}")
+            return
+        self.evict()
+
+    def evict(self):
+        """Expulsa las entradas menos usadas hasta quedar por debajo de IMAGE_CACHE_MAX_BYTES"""
+        if not self._evict_lock.acquire(blocking=False):
+            # Ya hay otro hilo expulsando
+            return
+        try:
+            entries, total = self._scan()
+            removed = 0
+            for mtime, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+                total -= size
+                removed += 1
+            if removed:
+                with self._lock:
+                    self.evictions += removed
+                logging.info(f"Caché de imágenes: {removed} entradas expulsadas, {total} bytes en uso")
+        finally:
+            self._evict_lock.release()
+
+    def _scan(self):
+        """(mtime, tamaño, ruta) de las entradas y su tamaño total; borra temporales abandonados"""
+        entries = []
+        total = 0
+        now = time.time()
+        if not os.path.isdir(self.directory):
+            return entries, total
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name.endswith('.tmp'):
+                    if now - stat.st_mtime > STALE_TMP_SECONDS:
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(entry.path)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        return entries, total
+
+    def stats(self):
+        entries, total = self._scan()
+        with self._lock:
+            return {
+                'directory': self.directory,
+                'max_bytes': self.max_bytes,
+                'entries': len(entries),
+                'bytes': total,
+                'hits': self.hits,
+                'misses': self.misses,
+                'bytes_saved': self.bytes_saved,
+                'evictions': self.evictions,
+            }
+
+
+def _link_or_copy(source, dest):
+    """Enlaza source en dest (sustituyendo dest); copia si el sistema de ficheros no admite enlaces"""
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(dest)
+    try:
+        os.link(source, dest)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        # Otro sistema de ficheros (EXDEV) o sin soporte de enlaces
+        shutil.copyfile(source, dest)
+
+
+image_cache = ImageCache()
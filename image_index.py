@@ -0,0 +1,126 @@
+import logging
+
+from PIL import Image
+
+from app import app, db
+from models import ImageHash
+
+# El hash de 64 bits se divide en 4 bandas de 16 bits indexadas (multi-index hashing):
+# si dos hashes difieren en 3 bits o menos, al menos una banda coincide exactamente.
+BANDS = 4
+BAND_BITS = 64 // BANDS
+BAND_MASK = (1 << BAND_BITS) - 1
+
+
+def dhash(image_path, hash_size=8):
+    """Difference hash de 64 bits: compara la luminosidad de píxeles vecinos en una miniatura 9x8"""
+    with Image.open(image_path) as img:
+        small = img.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS)
+        pixels = list(small.getdata())
+
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+def bands(value):
+    return [(value >> (BAND_BITS * i)) & BAND_MASK for i in range(BANDS)]
+
+
+def to_signed(value):
+    """SQLite y PostgreSQL guardan enteros de 64 bits con signo"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def get_or_compute(account_id, file_id, file_name, image_path):
+    """Devuelve el hash de la imagen, calculándolo y guardándolo solo la primera vez"""
+    entry = ImageHash.query.filter_by(account_id=account_id, file_id=file_id).first()
+    if entry is not None:
+        return to_unsigned(entry.phash)
+
+    value = dhash(image_path)
+    band_values = bands(value)
+    db.session.add(ImageHash(
+        account_id=account_id,
+        file_id=file_id,
+        file_name=file_name,
+        phash=to_signed(value),
+        band0=band_values[0],
+        band1=band_values[1],
+        band2=band_values[2],
+        band3=band_values[3]
+    ))
+    db.session.commit()
+    return value
+
+
+def find_duplicate(account_id, file_id, value, threshold=None, accepted=()):
+    """Busca una imagen ya publicada de la cuenta a distancia de Hamming <= threshold.
+
+    accepted son los file_id publicados en el lote en curso (una subida fallida no
+    entra: esa imagen sigue sin publicar). Devuelve (ImageHash, distancia) del
+    vecino más cercano o (None, None).
+    """
+    if threshold is None:
+        threshold = app.config['DUPLICATE_HAMMING_THRESHOLD']
+
+    published = ImageHash.posted.is_(True)
+    if accepted:
+        published = db.or_(published, ImageHash.file_id.in_(list(accepted)))
+    query = ImageHash.query.filter(
+        ImageHash.account_id == account_id,
+        published,
+        ImageHash.file_id != file_id
+    )
+    if threshold < BANDS:
+        # Solo los candidatos que comparten alguna banda exacta (consultas por índice)
+        band_values = bands(value)
+        query = query.filter(db.or_(
+            ImageHash.band0 == band_values[0],
+            ImageHash.band1 == band_values[1],
+            ImageHash.band2 == band_values[2],
+            ImageHash.band3 == band_values[3]
+        ))
+
+    best, best_distance = None, None
+    for candidate in query:
+        distance = hamming(value, to_unsigned(candidate.phash))
+        if distance <= threshold and (best_distance is None or distance < best_distance):
+            best, best_distance = candidate, distance
+    return best, best_distance
+
+
+def check_duplicate(account_id, file_id, file_name, image_path, accepted=()):
+    """Calcula (o reutiliza) el hash de la imagen y busca duplicados ya publicados
+    o publicados antes en el mismo lote (accepted, ver find_duplicate).
+
+    Devuelve (ImageHash, distancia) o (None, None). Un error al leer la imagen no
+    debe impedir la publicación, así que se registra y se trata como no duplicada.
+    """
+    try:
+        value = get_or_compute(account_id, file_id, file_name, image_path)
+        duplicate, distance = find_duplicate(account_id, file_id, value, accepted=accepted)
+        if duplicate is not None:
+            logging.info(f"Posible duplicado: {file_name} ~ {duplicate.file_name} (distancia {distance})")
+        return duplicate, distance
+    except Exception as e:
+        db.session.rollback()
+        logging.warning(f"No se pudo calcular el hash perceptual de {file_name}: {str(e)}")
+        return None, None
+
+
+def mark_posted(account_id, file_id):
+    ImageHash.query.filter_by(account_id=account_id, file_id=file_id).update({'posted': True})
+    db.session.commit()
@@ -1,14 +1,24 @@
+import contextlib
 import logging
 import os
-from googleapiclient.http import MediaIoBaseDownload
-import google.generativeai as genai
-from datetime import datetime
+import threading
+import time
+from datetime import datetime, timezone
 from instagrapi import Client
-from models import PublicationHistory, Account
+from models import PublicationHistory, Account, PreparedPost
+import content_queue
+import drive_download
+import image_index
 from app import db, app #Modified line to include app
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 import json
+import tracing
+import error_codes
+from error_codes import ErrorCode
+from gemini_pool import gemini_pool
+from image_cache import image_cache
+import structured_logging
 
 def authenticate_google_drive(credentials_path):
     """Authenticate with Google Drive API"""
@@ -33,13 +43,24 @@ def get_new_images(service, folder_id):
     logging.info(f"Buscando imágenes en carpeta: {folder_id}")
 
     try:
-        results = service.files().list(q=query, fields="files(id, name, mimeType)").execute()
-        all_images = results.get('files', [])
+        all_images = []
+        page_token = None
+        while True:
+            results = service.files().list(
+                q=query,
+                fields="nextPageToken, files(id, name, mimeType, modifiedTime)",
+                pageSize=1000,
+                pageToken=page_token
+            ).execute()
+            all_images.extend(results.get('files', []))
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
 
         logging.info(f"Total de archivos en la carpeta: {len(all_images)}")
 
         for img in all_images:
-            logging.info(f"Archivo encontrado: {img['name']} - Tipo: {img.get('mimeType', 'desconocido')}")
+            logging.debug(f"Archivo encontrado: {img['name']} - Tipo: {img.get('mimeType', 'desconocido')}")
 
         # Filtrar solo las imágenes que no han sido procesadas
         new_images = [img for img in all_images if "_enviada" not in img['name']]
@@ -51,41 +72,45 @@ def get_new_images(service, folder_id):
         logging.error(f"Error al buscar imágenes: {str(e)}")
         return []
 
-def download_image(service, file_id, file_name):
-    """Download an image from Google Drive"""
-    request = service.files().get_media(fileId=file_id)
-    file_path = f'./{file_name}'
-
-    with open(file_path, 'wb') as f:
-        downloader = MediaIoBaseDownload(f, request)
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
+def download_image(service, file_id, file_name, dest_dir='.'):
+    """Download an image from Google Drive (reanudable y verificada, ver drive_download).
 
+    Si otra cuenta ya descargó la misma versión del fichero se toma de image_cache.
+    """
+    file_path = os.path.join(dest_dir, file_name)
+    metadata = service.files().get(fileId=file_id, fields="size, md5Checksum, modifiedTime").execute()
+    key = image_cache.key(file_id, metadata)
+    with image_cache.lock(key):
+        if image_cache.get(key, file_path):
+            return file_path
+        drive_download.download(service, file_id, file_path, metadata)
+        image_cache.put(key, file_path)
     return file_path
 
-def get_gemini_image_description(image_path, api_key, custom_prompt=None):
-    """Generate image description using Gemini AI"""
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel("gemini-1.5-flash")
+DEFAULT_PROMPT = "Describe la imagen que te envío con un texto continuo ideal para un pie de foto en Instagram. Identifica la especie del ave y proporciona detalles sobre su aspecto, hábitat y distribución, manteniendo un tono natural, atractivo y animado. Incluye emojis y hashtags adecuados para resaltar la belleza de la naturaleza y la fotografía de aves. Con enfoque en la fotografía. Responde únicamente con el texto solicitado, sin añadir introducciones ni comentarios adicionales."
 
+def get_gemini_image_description(image_path, api_key, custom_prompt=None, raise_errors=False, model_name=None, timeout=None):
+    """Generate image description using Gemini AI (cliente reutilizado de gemini_pool por clave)"""
     with open(image_path, "rb") as image_file:
         image_data = image_file.read()
 
     # Usar prompt personalizado si está disponible, sino usar uno predeterminado
-    default_prompt = "Describe la imagen que te envío con un texto continuo ideal para un pie de foto en Instagram. Identifica la especie del ave y proporciona detalles sobre su aspecto, hábitat y distribución, manteniendo un tono natural, atractivo y animado. Incluye emojis y hashtags adecuados para resaltar la belleza de la naturaleza y la fotografía de aves. Con enfoque en la fotografía. Responde únicamente con el texto solicitado, sin añadir introducciones ni comentarios adicionales."
-    prompt = custom_prompt if custom_prompt else default_prompt
+    prompt = custom_prompt if custom_prompt else DEFAULT_PROMPT
 
     try:
-        response = model.generate_content(
+        return gemini_pool.generate(
+            api_key,
+            model_name or app.config["GEMINI_MODEL"],
             [prompt, {
                 "mime_type": "image/jpeg",
                 "data": image_data
-            }]
+            }],
+            timeout=timeout or app.config["GEMINI_TIMEOUT_SECONDS"]
         )
-        return response.text
     except Exception as e:
         logging.error(f"Error generating image description: {str(e)}")
+        if raise_errors:
+            raise
         return f"Error al obtener la descripción: {str(e)}"
 
 def rename_file(service, file_id, new_name):
@@ -94,96 +119,433 @@ def rename_file(service, file_id, new_name):
         file_metadata = {'name': new_name}
         service.files().update(fileId=file_id, body=file_metadata).execute()
         logging.info(f"Archivo renombrado exitosamente a {new_name}")
+        return True
     except Exception as e:
         logging.error(f"Error al renombrar archivo: {str(e)}")
         # Continuar con la ejecución aunque falle el renombrado
         # La imagen ya se publicó en Instagram, así que esto es secundario
-
-def post_to_instagram(image_path, caption, username, password):
-    """Publica una imagen en Instagram usando instagrapi con persistencia de sesión"""
+        return False
+
+# Clientes de Instagram ya validados por usuario: {username: (cliente, momento de la validación)}.
+# Permite que la precarga deje la sesión lista y que la publicación no repita la validación.
+_instagram_clients = {}
+_instagram_clients_lock = threading.Lock()
+INSTAGRAM_SESSION_MAX_AGE = 30 * 60
+
+def _session_file(username):
+    sessions_dir = './instagram_sessions'
+    os.makedirs(sessions_dir, exist_ok=True)
+    return f"{sessions_dir}/{username}_session.json"
+
+def _new_instagram_client():
+    cl = Client()
+    # Configurar manualmente el "device"
+    cl.set_device({
+        "app_version": "123.0.0.21.114",
+        "android_version": 29,
+        "android_release": "10",
+        "dpi": "420dpi",
+        "resolution": "1080x1920",
+        "manufacturer": "Xiaomi",
+        "model": "Mi 9T",
+        "device": "davinci"
+    })
+    return cl
+
+def _instagram_login(cl, username, password):
+    """Login completo y persistencia de la sesión. Devuelve (éxito, mensaje de error)"""
+    session_file = _session_file(username)
     try:
-        sessions_dir = './instagram_sessions'
-        os.makedirs(sessions_dir, exist_ok=True)
-
-        session_file = f"{sessions_dir}/{username}_session.json"
-        cl = Client()
-        # Configurar manualmente el "device"
-        cl.set_device({
-            "app_version": "123.0.0.21.114",
-            "android_version": 29,
-            "android_release": "10",
-            "dpi": "420dpi",
-            "resolution": "1080x1920",
-            "manufacturer": "Xiaomi",
-            "model": "Mi 9T",
-            "device": "davinci"
-        })
-        login_success = False
-        login_message = "No se pudo iniciar sesión"
-
-        def try_login():
-            nonlocal login_success, login_message
-            try:
-                cl.login(username, password)
-                login_success = True
-                logging.info(f"Login exitoso para {username}")
-                cl.dump_settings(session_file)
-                # Persistencia extendida (si fuera necesario para el cliente)
-                with open(session_file, 'r+') as f:
-                    settings = json.load(f)
-                    f.seek(0)
-                    json.dump(settings, f)
-                    f.truncate()
-            except Exception as le:
-                logging.error(f"Error en login para {username}: {str(le)}")
-                login_message = f"Error en login: {str(le)}"
-
-        # Intentar cargar configuración y sesión
-        if os.path.exists(session_file):
-            try:
-                cl.load_settings(session_file)
-                logging.info(f"Sesión cargada para {username}")
-                cl.get_timeline_feed()  # Verifica si la sesión aún es válida
-                login_success = True
-                logging.info(f"Sesión válida para {username}")
-            except Exception as ve:
-                logging.warning(f"Sesión inválida, intentando login completo: {str(ve)}")
-                try_login()
-        else:
-            try_login()
+        cl.login(username, password)
+        logging.info(f"Login exitoso para {username}")
+        cl.dump_settings(session_file)
+        # Persistencia extendida (si fuera necesario para el cliente)
+        with open(session_file, 'r+') as f:
+            settings = json.load(f)
+            f.seek(0)
+            json.dump(settings, f)
+            f.truncate()
+        with _instagram_clients_lock:
+            _instagram_clients[username] = (cl, time.time())
+        return True, None
+    except Exception as le:
+        logging.error(f"Error en login para {username}: {str(le)}")
+        return False, f"Error en login: {str(le)}"
+
+def get_instagram_client(username, password):
+    """Devuelve (cliente, éxito, mensaje) reutilizando la sesión si se validó hace poco"""
+    with _instagram_clients_lock:
+        cached = _instagram_clients.get(username)
+    if cached and time.time() - cached[1] < INSTAGRAM_SESSION_MAX_AGE:
+        logging.info(f"Reutilizando sesión validada para {username}")
+        return cached[0], True, None
+
+    cl = _new_instagram_client()
+    session_file = _session_file(username)
+
+    # Intentar cargar configuración y sesión
+    if os.path.exists(session_file):
+        try:
+            cl.load_settings(session_file)
+            logging.info(f"Sesión cargada para {username}")
+            cl.get_timeline_feed()  # Verifica si la sesión aún es válida
+            logging.info(f"Sesión válida para {username}")
+            with _instagram_clients_lock:
+                _instagram_clients[username] = (cl, time.time())
+            return cl, True, None
+        except Exception as ve:
+            logging.warning(f"Sesión inválida, intentando login completo: {str(ve)}")
+
+    login_success, login_message = _instagram_login(cl, username, password)
+    return cl, login_success, login_message or "No se pudo iniciar sesión"
+
+def forget_instagram_client(username):
+    """Descarta la sesión en memoria (p. ej. tras un login_required)"""
+    with _instagram_clients_lock:
+        _instagram_clients.pop(username, None)
+
+def post_to_instagram(image_path, caption, username, password, trace=None):
+    """Publica una imagen en Instagram usando instagrapi con persistencia de sesión.
+
+    Devuelve (éxito, mensaje, media ID, código de error o None).
+    """
+    try:
+        with tracing.span(trace, 'instagram_session', os.path.basename(image_path)):
+            cl, login_success, login_message = get_instagram_client(username, password)
 
         if login_success:
             try:
-                media = cl.photo_upload(image_path, caption)
-                return True, f"Publicado con éxito. ID de media: {media.id}"
+                with tracing.span(trace, 'upload', os.path.basename(image_path)) as upload_span:
+                    upload_span['bytes'] = os.path.getsize(image_path)
+                    media = cl.photo_upload(image_path, caption)
+                return True, f"Publicado con éxito. ID de media: {media.id}", media.id, None
             except Exception as e:
                 logging.error(f"Primer intento fallido: {str(e)}")
-                if "login_required" in str(e):
+                code = error_codes.classify(e, default=ErrorCode.IG_UPLOAD)
+                if code is ErrorCode.IG_LOGIN_REQUIRED:
                     logging.warning("Sesión inválida al publicar, intentando nuevo login y reintento...")
-                    try_login()
+                    forget_instagram_client(username)
+                    login_success, login_message = _instagram_login(cl, username, password)
                     if login_success:
                         try:
-                            media = cl.photo_upload(image_path, caption)
-                            return True, f"Publicado tras reintento. ID de media: {media.id}"
+                            with tracing.span(trace, 'upload_retry', os.path.basename(image_path)) as upload_span:
+                                upload_span['bytes'] = os.path.getsize(image_path)
+                                media = cl.photo_upload(image_path, caption)
+                            return True, f"Publicado tras reintento. ID de media: {media.id}", media.id, None
                         except Exception as e2:
                             logging.error(f"Reintento fallido: {str(e2)}")
-                            return False, f"Error tras reintento: {str(e2)}"
-                return False, f"Error al publicar la foto: {str(e)}"
+                            return False, f"Error tras reintento: {str(e2)}", None, error_codes.classify(e2, default=ErrorCode.IG_UPLOAD)
+                    code = error_codes.classify(login_message, default=ErrorCode.IG_LOGIN_REQUIRED)
+                return False, f"Error al publicar la foto: {str(e)}", None, code
         else: 
-            return False, f"No se pudo autenticar con Instagram. {login_message}"
+            return (False, f"No se pudo autenticar con Instagram. {login_message}", None,
+                    error_codes.classify(login_message, default=ErrorCode.IG_LOGIN_REQUIRED))
 
     except Exception as e:
         error_msg = str(e)
         logging.error(f"Instagram posting error: {error_msg}")
 
-        if "challenge_required" in error_msg or "Unexpected token '<'" in error_msg:
-            return False, "La cuenta de Instagram requiere verificación manual. Inicia sesión en un navegador y completa los desafíos de seguridad."
+        code = error_codes.classify(e, default=ErrorCode.IG_UPLOAD)
+        if code is ErrorCode.IG_CHALLENGE:
+            return False, "La cuenta de Instagram requiere verificación manual. Inicia sesión en un navegador y completa los desafíos de seguridad.", None, code
+
+        return False, f"Error posting to Instagram: {error_msg}", None, code
+
+def get_custom_prompt(account_id):
+    """Prompt personalizado de la cuenta, o None para usar el predeterminado"""
+    with app.app_context(): #Using app context here
+        account = Account.query.get(account_id)
+        if account and account.gemini_prompt:
+            logging.info(f"Usando prompt personalizado para la cuenta {account.name}")
+            return account.gemini_prompt
+    return None
+
+def get_gemini_options(account_id):
+    """Modelo y tiempo máximo de Gemini de la cuenta (None = valores por defecto)"""
+    account = Account.query.get(account_id)
+    if account is None:
+        return {}
+    return {'model_name': account.gemini_model, 'timeout': account.gemini_timeout}
+
+# Pasos de un checkpoint anteriores a la subida: se pueden descartar y repetir sin riesgo
+PREPARED_STAGES = ('pending', 'downloaded', 'captioned')
+
+def staging_dir(account_id):
+    """Directorio de trabajo de la cuenta; sobrevive a reinicios junto con los checkpoints"""
+    path = os.path.join('.', 'staging', str(account_id))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def discard_prepared_post(prepared):
+    """Elimina una imagen precargada (registro y fichero local)"""
+    if prepared.local_path and os.path.exists(prepared.local_path):
+        os.remove(prepared.local_path)
+    # Segmentos de una descarga que no llegó a completarse
+    drive_download.remove_parts(os.path.join(staging_dir(prepared.account_id), f"{prepared.file_id}_{prepared.file_name}"))
+    db.session.delete(prepared)
+    db.session.commit()
+
+def checkpoint(prepared, stage):
+    """Guarda el último paso completado de una imagen"""
+    prepared.stage = stage
+    prepared.updated_at = datetime.utcnow()
+    db.session.commit()
+
+def finish_checkpoint(service, prepared, trace=None):
+    """Renombra el fichero en Drive y cierra el checkpoint.
+
+    Si el renombrado falla tras una publicación correcta, el checkpoint se queda en
+    'posted' con su media ID y solo se reintenta el renombrado en la siguiente ejecución.
+    """
+    with tracing.span(trace, 'rename', prepared.file_name):
+        renamed = rename_file(service, prepared.file_id, processed_name(prepared.file_name))
+    close_checkpoint(prepared, renamed)
+
+def processed_name(file_name):
+    """Nombre con el que se marca en Drive una imagen ya procesada"""
+    name_without_extension, extension = os.path.splitext(file_name)
+    return f"{name_without_extension}_enviada{extension}"
+
+def close_checkpoint(prepared, renamed):
+    """Elimina el checkpoint, salvo si la imagen está publicada y falta renombrarla"""
+    if renamed or prepared.stage != 'posted':
+        discard_prepared_post(prepared)
+    else:
+        # La imagen local ya no hace falta para reintentar el renombrado
+        if prepared.local_path and os.path.exists(prepared.local_path):
+            os.remove(prepared.local_path)
+        prepared.local_path = None
+        db.session.commit()
+
+def retry_pending_renames(service, account_id, trace=None):
+    """Reintenta los renombrados de imágenes ya publicadas (checkpoint en 'posted')"""
+    for prepared in PreparedPost.query.filter_by(account_id=account_id, stage='posted').all():
+        logging.info(f"Reintentando el renombrado de {prepared.file_name} (media {prepared.media_id})")
+        finish_checkpoint(service, prepared, trace)
+
+class MediaLookupError(Exception):
+    """No se pudo consultar Instagram para saber si una subida interrumpida llegó a publicarse"""
 
-        return False, f"Error posting to Instagram: {error_msg}"
 
-def publish_for_account(account_id, instagram_username, instagram_password, folder_id, gemini_api_key, credentials_path):
-    """Main function to publish images for a specific account."""
+def find_posted_media(username, password, caption, since=None, limit=10):
+    """Busca entre las últimas publicaciones de la cuenta una con la misma descripción.
+
+    Sin descripción (checkpoints antiguos) se toma la primera publicada desde `since`
+    (UTC), el momento en que empezó la subida. Devuelve None si no está publicada y
+    lanza MediaLookupError si no se pudo comprobar (inicio de sesión o consulta
+    fallidos): en ese caso no se sabe y no se debe repetir la subida.
+    """
+    if not caption and since is None:
+        return None
+    try:
+        cl, login_success, login_message = get_instagram_client(username, password)
+    except Exception as e:
+        raise MediaLookupError(str(e)) from e
+    if not login_success:
+        raise MediaLookupError(login_message)
+    try:
+        for media in cl.user_medias(cl.user_id, limit):
+            if caption:
+                if (media.caption_text or '').strip() == caption.strip():
+                    return media.id
+            elif media.taken_at and _utc_naive(media.taken_at) >= since:
+                logging.warning(f"Checkpoint sin descripción: se toma la publicación {media.id} "
+                                f"posterior a {since} como la imagen interrumpida")
+                return media.id
+    except Exception as e:
+        raise MediaLookupError(str(e)) from e
+    return None
+
+# Un cerrojo por cuenta, compartido por la precarga y la publicación (de ambos motores):
+# las dos trabajan sobre los mismos checkpoints y la misma cola y no deben solaparse
+_account_locks = {}
+_account_locks_lock = threading.Lock()
+
+def account_lock(account_id):
+    with _account_locks_lock:
+        return _account_locks.setdefault(account_id, threading.Lock())
+
+@contextlib.contextmanager
+def exclusive_account(account_id, task):
+    """Espera a que termine cualquier otra precarga o publicación de la cuenta"""
+    lock = account_lock(account_id)
+    if not lock.acquire(blocking=False):
+        logging.info(f"Cuenta {account_id}: la {task} espera a que termine la ejecución en curso")
+        lock.acquire()
+    try:
+        yield
+    finally:
+        lock.release()
+
+def _utc_naive(moment):
+    """datetime en UTC sin zona horaria, como los de la base de datos"""
+    if moment.tzinfo is None:
+        return moment
+    return moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+def prefetch_for_account(account_id, instagram_username, instagram_password, folder_id, gemini_api_key, credentials_path):
+    """Prepara la siguiente publicación antes de la hora programada.
+
+    Descarga las próximas imágenes de la cola (hasta la cuota por slot), genera y
+    guarda sus descripciones y deja validada la sesión de Instagram, de modo que a
+    la hora del slot solo queda la subida. Si la cuenta está publicando, espera a
+    que termine (exclusive_account).
+    """
+    with exclusive_account(account_id, 'precarga'):
+        return _prefetch_for_account(account_id, instagram_username, instagram_password, folder_id,
+                                     gemini_api_key, credentials_path)
+
+def _prefetch_for_account(account_id, instagram_username, instagram_password, folder_id, gemini_api_key, credentials_path):
+    trace = tracing.RunTrace(account_id, trigger='prefetch')
+    log_token = structured_logging.bind(account_id=account_id, run_id=trace.run_id)
+
+    try:
+        if not folder_id or folder_id.strip() == "":
+            trace.status = 'error'
+            return {"status": "error", "message": "Error: No se ha configurado un ID de carpeta válido"}
+
+        with trace.span('drive_auth'):
+            service = authenticate_google_drive(credentials_path)
+
+        with trace.span('listing'):
+            images = get_new_images(service, folder_id)
+            content_queue.refill(account_id, images)
+            batch = content_queue.next_batch(account_id)
+
+        # Descartar precargas de imágenes que ya no están en el próximo lote (nunca los
+        # checkpoints de imágenes que pueden haberse subido ya)
+        batch_ids = {item.file_id for item in batch}
+        for prepared in PreparedPost.query.filter_by(account_id=account_id).all():
+            if prepared.file_id not in batch_ids and prepared.stage in PREPARED_STAGES:
+                discard_prepared_post(prepared)
+
+        for item in batch:
+            file_id = item.file_id
+            file_name = item.file_name
+
+            prepared = PreparedPost.query.filter_by(account_id=account_id, file_id=file_id).first()
+            if prepared is None:
+                prepared = PreparedPost(account_id=account_id, file_id=file_id, file_name=file_name, stage='pending')
+                db.session.add(prepared)
+            elif prepared.stage not in PREPARED_STAGES:
+                # Publicación en curso o interrumpida: la retoma publish_for_account
+                continue
+
+            if not prepared.local_path or not os.path.exists(prepared.local_path):
+                with trace.span('download', file_name) as download_span:
+                    prepared.local_path = download_image(service, file_id, f"{file_id}_{file_name}", dest_dir=staging_dir(account_id))
+                    download_span['bytes'] = os.path.getsize(prepared.local_path)
+                prepared.caption = None
+                prepared.stage = 'downloaded'
+            db.session.commit()
+
+            # Las imágenes duplicadas se retiran de la cola antes de llamar a Gemini. Solo
+            # se compara con lo ya publicado: las del mismo lote las compara
+            # publish_for_account cuando se publican
+            with trace.span('phash', file_name):
+                duplicate, distance = image_index.check_duplicate(account_id, file_id, file_name, prepared.local_path)
+            if duplicate is not None and app.config['DUPLICATE_ACTION'] == 'skip':
+                record_duplicate(account_id, item, duplicate, distance, trace, skipped=True)
+                discard_prepared_post(prepared)
+                batch.extend(content_queue.next_batch(account_id, 1, exclude_ids=[i.id for i in batch]))
+                continue
+
+            if not prepared.caption:
+                try:
+                    with trace.span('caption', file_name) as caption_span:
+                        prepared.caption = get_gemini_image_description(
+                            prepared.local_path, gemini_api_key, get_custom_prompt(account_id), raise_errors=True,
+                            **get_gemini_options(account_id))
+                        caption_span['bytes'] = len(prepared.caption.encode('utf-8'))
+                    prepared.stage = 'captioned'
+                except Exception as e:
+                    # Se reintentará a la hora de publicar
+                    logging.warning(f"No se pudo precargar la descripción de {file_name}: {str(e)}")
+
+            prepared.prepared_at = datetime.utcnow()
+            db.session.commit()
+            logging.info(f"Imagen precargada para {instagram_username}: {file_name}")
+
+        with trace.span('instagram_session'):
+            session_ok, session_message = get_instagram_client(instagram_username, instagram_password)[1:]
+        if not session_ok:
+            logging.warning(f"No se pudo preparar la sesión de Instagram de {instagram_username}: {session_message}")
+
+        return {"status": "success", "prepared": [p.file_name for p in PreparedPost.query.filter_by(account_id=account_id)]}
+
+    except Exception as e:
+        db.session.rollback()
+        trace.status = 'error'
+        logging.error(f"Error en la precarga: {str(e)}", exc_info=True)
+        return {"status": "error", "message": str(e)}
+
+    finally:
+        tracing.save_trace(trace)
+        structured_logging.unbind(log_token)
+
+def record_duplicate(account_id, item, duplicate, distance, trace, skipped):
+    """Deja constancia en el historial de una imagen casi idéntica a otra ya publicada"""
+    if skipped:
+        content_queue.mark(item, 'duplicate')
+        details = f"Imagen omitida: es casi idéntica a {duplicate.file_name} (distancia {distance})"
+    else:
+        details = f"Posible duplicado de {duplicate.file_name} (distancia {distance}), se publica igualmente"
+    db.session.add(PublicationHistory(
+        account_id=account_id,
+        timestamp=datetime.utcnow(),
+        status='info',
+        details=details,
+        image_name=item.file_name,
+        run_id=trace.run_id
+    ))
+    db.session.commit()
+
+def record_post_result(account_id, item, prepared, success, message, media_id, error_code, run_id, retry_stage='uploading'):
+    """Guarda el resultado de una subida en el historial, el checkpoint y la cola.
+
+    Devuelve True si la imagen se reintentará en el siguiente horario (error
+    transitorio y quedan intentos): el fichero no se renombra y el checkpoint se
+    queda en retry_stage. Tras un fallo de la subida es 'uploading', así que la
+    próxima ejecución comprueba antes si llegó a publicarse; tras un fallo de la
+    descripción es 'downloaded', porque no se llegó a subir nada.
+    """
+    error_code = error_code or ErrorCode.UNKNOWN
+    retry = (not success and error_codes.retryable(error_code)
+             and (item.attempts or 0) + 1 < app.config['ERROR_RETRY_MAX_ATTEMPTS'])
+    prepared.media_id = media_id
+    prepared.stage = 'posted' if success else (retry_stage if retry else 'failed')
+    prepared.updated_at = datetime.utcnow()
+    fields = {'details': message} if success else error_codes.error_fields(message, error_code)
+    db.session.add(PublicationHistory(
+        account_id=account_id,
+        timestamp=datetime.utcnow(),
+        status='success' if success else 'error',
+        image_name=item.file_name,
+        run_id=run_id,
+        **fields
+    ))
+    if retry:
+        logging.warning(f"Error transitorio ({error_code.value}) al publicar {item.file_name}: se reintentará")
+        content_queue.retry_later(item)
+    else:
+        content_queue.mark(item, 'published' if success else 'failed')
+    if success:
+        image_index.mark_posted(account_id, item.file_id)
+    return retry
+
+def publish_for_account(account_id, instagram_username, instagram_password, folder_id, gemini_api_key, credentials_path, trigger='manual'):
+    """Main function to publish images for a specific account.
+
+    Si hay una precarga de la cuenta en curso, espera a que termine (exclusive_account).
+    """
+    with exclusive_account(account_id, 'publicación'):
+        return _publish_for_account(account_id, instagram_username, instagram_password, folder_id,
+                                    gemini_api_key, credentials_path, trigger)
+
+def _publish_for_account(account_id, instagram_username, instagram_password, folder_id, gemini_api_key, credentials_path, trigger):
     results = []
+    trace = tracing.RunTrace(account_id, trigger=trigger)
+    log_token = structured_logging.bind(account_id=account_id, run_id=trace.run_id)
 
     try:
         logging.info(f"Starting publication process for account {instagram_username}")
@@ -192,32 +554,38 @@ def publish_for_account(account_id, instagram_username, instagram_password, fold
         if not folder_id or folder_id.strip() == "":
             message = "Error: No se ha configurado un ID de carpeta válido"
             logging.error(message)
+            trace.status = 'error'
             return {"status": "error", "message": message}
 
         # Obtener el prompt personalizado de la cuenta si existe
-        custom_prompt = None
-        with app.app_context(): #Using app context here
-            account = Account.query.get(account_id)
-            if account and account.gemini_prompt:
-                custom_prompt = account.gemini_prompt
-                logging.info(f"Usando prompt personalizado para la cuenta {account.name}")
+        custom_prompt = get_custom_prompt(account_id)
+        gemini_options = get_gemini_options(account_id)
 
         # Authenticate with Google Drive
-        service = authenticate_google_drive(credentials_path)
+        with trace.span('drive_auth'):
+            service = authenticate_google_drive(credentials_path)
 
         # Verificar que el ID de carpeta existe
         try:
-            folder_info = service.files().get(fileId=folder_id, fields="name").execute()
+            with trace.span('folder_check'):
+                folder_info = service.files().get(fileId=folder_id, fields="name").execute()
             logging.info(f"Carpeta encontrada: {folder_info.get('name', 'Nombre desconocido')}")
         except Exception as e:
             logging.error(f"Error al verificar la carpeta {folder_id}: {str(e)}")
-            if "File not found" in str(e):
+            if error_codes.classify(e) is ErrorCode.DRIVE_NOT_FOUND:
+                trace.status = 'error'
                 return {"status": "error", "message": f"La carpeta con ID {folder_id} no existe o no es accesible"}
 
-        # Get new images from the folder
-        images = get_new_images(service, folder_id)
+        # Completar los renombrados pendientes de ejecuciones anteriores
+        retry_pending_renames(service, account_id, trace)
 
-        if not images:
+        # Get new images from the folder and take this slot's quota from the queue
+        with trace.span('listing'):
+            images = get_new_images(service, folder_id)
+            content_queue.refill(account_id, images)
+            batch = content_queue.next_batch(account_id)
+
+        if not batch:
             message = "No hay imágenes nuevas para procesar"
             logging.info(message)
 
@@ -226,7 +594,8 @@ def publish_for_account(account_id, instagram_username, instagram_password, fold
                 account_id=account_id,
                 timestamp=datetime.utcnow(),
                 status='info',
-                details=message
+                details=message,
+                run_id=trace.run_id
             )
             db.session.add(history)
             db.session.commit()
@@ -236,47 +605,127 @@ def publish_for_account(account_id, instagram_username, instagram_password, fold
                 "message": message
             }
 
-        for image in images:
-            file_id = image['id']
-            file_name = image['name']
+        # Imágenes publicadas en este lote: se comparan con las siguientes
+        accepted = set()
+        for item in batch:
+            file_id = item.file_id
+            file_name = item.file_name
 
             results.append(f"Procesando: {file_name}")
             logging.info(f"Processing image: {file_name}")
 
-            # Download the image
-            image_path = download_image(service, file_id, file_name)
+            # Checkpoint de la imagen: si una ejecución anterior se interrumpió se
+            # continúa desde el último paso completado (descarga, descripción o subida)
+            prepared = PreparedPost.query.filter_by(account_id=account_id, file_id=file_id).first()
+            if prepared is None:
+                prepared = PreparedPost(account_id=account_id, file_id=file_id, file_name=file_name, stage='pending')
+                db.session.add(prepared)
+                db.session.commit()
+            elif prepared.stage != 'pending':
+                logging.info(f"Reanudando {file_name} desde el paso '{prepared.stage}'")
+
+            if prepared.stage == 'uploading':
+                # La subida se interrumpió: comprobar si llegó a publicarse antes de repetirla
+                try:
+                    with trace.span('resume_check', file_name):
+                        prepared.media_id = find_posted_media(instagram_username, instagram_password,
+                                                              prepared.caption, since=prepared.updated_at)
+                except MediaLookupError as e:
+                    # Sin saber si se publicó no se repite la subida: el checkpoint sigue en
+                    # 'uploading' y la imagen en la cola, se comprueba de nuevo en el siguiente horario
+                    logging.warning(f"No se pudo comprobar si {file_name} ya estaba publicada: {str(e)}")
+                    results.append(f"No se pudo comprobar si ya estaba publicada (se reintentará): {str(e)}")
+                    continue
+                if prepared.media_id:
+                    logging.info(f"La imagen {file_name} ya estaba publicada (media {prepared.media_id})")
+                    prepared.stage = 'posted'
+                    prepared.updated_at = datetime.utcnow()
+                    db.session.add(PublicationHistory(
+                        account_id=account_id,
+                        timestamp=datetime.utcnow(),
+                        status='success',
+                        details=f"Publicado con éxito. ID de media: {prepared.media_id}",
+                        image_name=file_name,
+                        run_id=trace.run_id
+                    ))
+                    content_queue.mark(item, 'published')
+                    image_index.mark_posted(account_id, file_id)
+                    finish_checkpoint(service, prepared, trace)
+                    results.append("Imagen ya publicada en una ejecución anterior")
+                    continue
+
+            # Usar la imagen y la descripción precargadas si existen
+            if prepared.local_path and os.path.exists(prepared.local_path):
+                image_path = prepared.local_path
+                logging.info(f"Usando imagen precargada: {image_path}")
+            else:
+                # Download the image
+                with trace.span('download', file_name) as download_span:
+                    image_path = download_image(service, file_id, f"{file_id}_{file_name}", dest_dir=staging_dir(account_id))
+                    download_span['bytes'] = os.path.getsize(image_path)
+                prepared.local_path = image_path
+                prepared.caption = None
+                checkpoint(prepared, 'downloaded')
+
+            # Detectar duplicados antes de llamar a Gemini o Instagram
+            with trace.span('phash', file_name):
+                duplicate, distance = image_index.check_duplicate(account_id, file_id, file_name, image_path, accepted)
+            if duplicate is not None:
+                skip = app.config['DUPLICATE_ACTION'] == 'skip'
+                record_duplicate(account_id, item, duplicate, distance, trace, skipped=skip)
+                if skip:
+                    results.append(f"Omitida por duplicada: {file_name} ~ {duplicate.file_name}")
+                    discard_prepared_post(prepared)
+                    # La imagen no consume la cuota del slot: se toma la siguiente de la cola
+                    batch.extend(content_queue.next_batch(account_id, 1, exclude_ids=[i.id for i in batch]))
+                    continue
 
             # Generate image description
-            image_description = get_gemini_image_description(image_path, gemini_api_key, custom_prompt)
+            if prepared.caption:
+                image_description = prepared.caption
+            else:
+                try:
+                    with trace.span('caption', file_name) as caption_span:
+                        image_description = get_gemini_image_description(image_path, gemini_api_key, custom_prompt, raise_errors=True, **gemini_options)
+                        caption_span['bytes'] = len(image_description.encode('utf-8'))
+                    prepared.caption = image_description
+                    checkpoint(prepared, 'captioned')
+                except Exception as e:
+                    # Sin descripción no se publica: el error sigue la misma política de
+                    # reintentos que los de Drive e Instagram (p. ej. la cuota de Gemini)
+                    trace.status = 'error'
+                    message = f"Error al obtener la descripción: {str(e)}"
+                    if record_post_result(account_id, item, prepared, False, message, None,
+                                          error_codes.classify_gemini(e), trace.run_id, retry_stage='downloaded'):
+                        results.append(f"Error (se reintentará): {message}")
+                        continue
+                    finish_checkpoint(service, prepared, trace)
+                    results.append(f"Error: {message}")
+                    continue
             results.append(f"Descripción: {image_description}")
 
             # Post to Instagram
-            success, message = post_to_instagram(
+            checkpoint(prepared, 'uploading')
+            success, message, media_id, error_code = post_to_instagram(
                 image_path, 
                 image_description, 
                 instagram_username, 
-                instagram_password
+                instagram_password,
+                trace=trace
             )
+            if not success:
+                trace.status = 'error'
 
-            # Record in publication history
-            history = PublicationHistory(
-                account_id=account_id,
-                timestamp=datetime.utcnow(),
-                status='success' if success else 'error',
-                details=message,
-                image_name=file_name
-            )
-            db.session.add(history)
-            db.session.commit()
+            # Record in publication history (en la misma transacción que el checkpoint)
+            if record_post_result(account_id, item, prepared, success, message, media_id, error_code, trace.run_id):
+                results.append(f"Error (se reintentará): {message}")
+                continue
+            if success:
+                # Solo una imagen publicada hace duplicadas a las siguientes del lote
+                accepted.add(file_id)
 
-            # Rename file to mark as processed
-            name_without_extension, extension = os.path.splitext(file_name)
-            new_name = f"{name_without_extension}_enviada{extension}"
-            rename_file(service, file_id, new_name)
-
-            # Clean up local file
-            if os.path.exists(image_path):
-                os.remove(image_path)
+            # Rename file to mark as processed and clean up local file
+            finish_checkpoint(service, prepared, trace)
 
             results.append("Imagen procesada correctamente" if success else f"Error: {message}")
 
@@ -285,15 +734,21 @@ def publish_for_account(account_id, instagram_username, instagram_password, fold
     except Exception as e:
         error_message = str(e)
         logging.error(f"Error in publication process: {error_message}", exc_info=True)
+        trace.status = 'error'
 
         # Record error in history
         history = PublicationHistory(
             account_id=account_id,
             timestamp=datetime.utcnow(),
             status='error',
-            details=error_message
+            run_id=trace.run_id,
+            **error_codes.error_fields(error_message, error_codes.classify(e))
         )
         db.session.add(history)
         db.session.commit()
 
-        return {"status": "error", "message": error_message}
\ No newline at end of file
+        return {"status": "error", "message": error_message}
+
+    finally:
+        tracing.save_trace(trace)
+        structured_logging.unbind(log_token)
\ No newline at end of file
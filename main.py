@@ -29,7 +29,6 @@ def start_scheduler():
     scheduler_running = False  # Reseteamos cuando termine el proceso
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.DEBUG)
     logging.info("Arrancando servidor Flask...")
     
     with app.app_context():
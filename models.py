@@ -47,6 +47,9 @@ class Account(db.Model):
     google_credentials = db.Column(db.Text)
     folder_id = db.Column(db.String(100))
     gemini_api_key = db.Column(db.String(100))
+    # Modelo de Gemini y tiempo máximo (s) de cada llamada; vacíos = GEMINI_MODEL / GEMINI_TIMEOUT_SECONDS
+    gemini_model = db.Column(db.String(64), nullable=True)
+    gemini_timeout = db.Column(db.Integer, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     # Relationship with publication history
@@ -55,18 +58,163 @@ class Account(db.Model):
     # Gemini prompt settings
     gemini_prompt = db.Column(db.Text, default="Describe la imagen que te envío con un texto continuo ideal para un pie de foto en Instagram. Identifica la especie del ave y proporciona detalles sobre su aspecto, hábitat y distribución, manteniendo un tono natural, atractivo y animado. Incluye emojis y hashtags adecuados para resaltar la belleza de la naturaleza y la fotografía de aves. Con enfoque en la fotografía. Responde únicamente con el texto solicitado, sin añadir introducciones ni comentarios adicionales.")
     
-    # Schedule settings
-    morning_post = db.Column(db.Boolean, default=True)
-    morning_time = db.Column(db.String(5), default="08:00")
-    afternoon_post = db.Column(db.Boolean, default=True)
-    afternoon_time = db.Column(db.String(5), default="15:00")
-    evening_post = db.Column(db.Boolean, default=True)
-    evening_time = db.Column(db.String(5), default="22:00")
+    # Horarios de publicación (tabla publication_slot)
+    slots = db.relationship('PublicationSlot', backref='account', lazy=True,
+                            order_by='PublicationSlot.time_of_day', cascade='all, delete-orphan')
+
+    # Cola de contenido: imágenes publicadas por slot y orden de publicación
+    posts_per_slot = db.Column(db.Integer, default=1)
+    queue_order = db.Column(db.String(20), default="name")
+    queue_seed = db.Column(db.Integer, default=0)
 
 class PublicationHistory(db.Model):
+    __table_args__ = (
+        # Resúmenes de errores por código y periodo (cubre también account_id)
+        db.Index('ix_history_error_code', 'error_code', 'timestamp', 'account_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     account_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     status = db.Column(db.String(20))
     details = db.Column(db.Text)
     image_name = db.Column(db.String(255), nullable=True)
+    # Ejecución (traza) a la que pertenece este registro
+    run_id = db.Column(db.String(32), nullable=True, index=True)
+    # Errores: código de error_codes.ErrorCode y texto deduplicado en error_message
+    # (details queda vacío)
+    error_code = db.Column(db.String(32), nullable=True)
+    error_message_id = db.Column(db.Integer, db.ForeignKey('error_message.id'), nullable=True)
+    error_message = db.relationship('ErrorMessage')
+
+    @property
+    def message(self):
+        """Texto del registro: details o, en los errores, el mensaje deduplicado"""
+        if self.details is not None:
+            return self.details
+        return self.error_message.text if self.error_message else None
+
+class ErrorMessage(db.Model):
+    """Texto completo de un error, guardado una sola vez aunque se repita"""
+    __tablename__ = 'error_message'
+
+    id = db.Column(db.Integer, primary_key=True)
+    # sha1 del texto
+    digest = db.Column(db.String(40), unique=True, nullable=False)
+    text = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class PublicationTrace(db.Model):
+    """Traza estructurada de una ejecución de publicación (spans comprimidos)"""
+    id = db.Column(db.Integer, primary_key=True)
+    run_id = db.Column(db.String(32), unique=True, nullable=False)
+    account_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False, index=True)
+    trigger = db.Column(db.String(20))
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    duration_ms = db.Column(db.Integer)
+    status = db.Column(db.String(20))
+    span_count = db.Column(db.Integer)
+    spans = db.Column(db.LargeBinary)
+
+    account = db.relationship('Account')
+
+
+class PreparedPost(db.Model):
+    """Checkpoint de una imagen en preparación o publicación.
+
+    Lo crean la precarga y la publicación y guarda el último paso completado, para
+    que una ejecución interrumpida continúe sin repetir descarga, descripción ni subida.
+    """
+    __table_args__ = (db.UniqueConstraint('account_id', 'file_id'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    account_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False, index=True)
+    file_id = db.Column(db.String(100), nullable=False)
+    file_name = db.Column(db.String(255))
+    local_path = db.Column(db.String(500))
+    caption = db.Column(db.Text)
+    prepared_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # pending, downloaded, captioned, uploading, posted, failed
+    stage = db.Column(db.String(20), default='pending', nullable=False)
+    media_id = db.Column(db.String(64))
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class QueueItem(db.Model):
+    """Imagen de Drive en la cola de publicación ordenada de una cuenta"""
+    __tablename__ = 'content_queue'
+    __table_args__ = (
+        db.UniqueConstraint('account_id', 'file_id'),
+        db.Index('ix_content_queue_next', 'account_id', 'status', 'sort_key'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    account_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
+    file_id = db.Column(db.String(100), nullable=False)
+    file_name = db.Column(db.String(255))
+    modified_time = db.Column(db.String(40))
+    sort_key = db.Column(db.String(255), nullable=False)
+    # pending, published, failed, removed, duplicate
+    status = db.Column(db.String(20), default='pending', nullable=False)
+    # Publicaciones fallidas con error transitorio (se reintentan hasta ERROR_RETRY_MAX_ATTEMPTS)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    enqueued_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ImageHash(db.Model):
+    """Hash perceptual (dHash de 64 bits) de una imagen de Drive, para detectar duplicados"""
+    __table_args__ = (
+        db.UniqueConstraint('account_id', 'file_id'),
+        db.Index('ix_image_hash_band0', 'account_id', 'band0'),
+        db.Index('ix_image_hash_band1', 'account_id', 'band1'),
+        db.Index('ix_image_hash_band2', 'account_id', 'band2'),
+        db.Index('ix_image_hash_band3', 'account_id', 'band3'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    account_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
+    file_id = db.Column(db.String(100), nullable=False)
+    file_name = db.Column(db.String(255))
+    phash = db.Column(db.BigInteger, nullable=False)
+    band0 = db.Column(db.Integer, nullable=False)
+    band1 = db.Column(db.Integer, nullable=False)
+    band2 = db.Column(db.Integer, nullable=False)
+    band3 = db.Column(db.Integer, nullable=False)
+    posted = db.Column(db.Boolean, default=False, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class PublicationSlot(db.Model):
+    """Horario de publicación de una cuenta.
+
+    next_run_at (UTC) se precalcula al guardar el horario y al ejecutarlo, de modo
+    que el planificador solo consulta por índice los horarios vencidos.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    account_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False, index=True)
+    # morning, afternoon, evening (horarios del formulario) o cualquier otro nombre
+    label = db.Column(db.String(20))
+    time_of_day = db.Column(db.String(5), nullable=False)
+    # Días de la semana: bit 0 = lunes ... bit 6 = domingo
+    weekdays = db.Column(db.Integer, default=127, nullable=False)
+    # Zona horaria IANA; vacía = hora local del servidor
+    timezone = db.Column(db.String(64))
+    enabled = db.Column(db.Boolean, default=True, nullable=False)
+    next_run_at = db.Column(db.DateTime, index=True)
+    # Precarga pendiente del próximo horario (None si ya se hizo o está desactivada)
+    prefetch_at = db.Column(db.DateTime, index=True)
+    last_run_at = db.Column(db.DateTime)
+
+class EmailOutbox(db.Model):
+    """Correo pendiente de envío; lo envía en segundo plano email_utils.EmailSender"""
+    __table_args__ = (db.Index('ix_email_outbox_next', 'status', 'next_attempt_at'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    html = db.Column(db.Text, nullable=False)
+    # pending, sending, sent, failed
+    status = db.Column(db.String(20), default='pending', nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
@@ -0,0 +1,149 @@
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Contadores activos en el contexto actual (la petición en curso y/o un count_queries())
+_active = ContextVar('query_stats_active', default=())
+
+# Configuración leída de la app en init_app (los eventos del engine no tienen acceso a ella)
+_config = {}
+
+
+class QueryStats:
+    """Número de consultas y tiempo total de SQL de una petición o de un bloque de código"""
+
+    def __init__(self, keep_statements=False):
+        self.count = 0
+        self.total_ms = 0.0
+        self.keep_statements = keep_statements
+        self.statements = []
+
+    def add(self, statement, duration_ms):
+        self.count += 1
+        self.total_ms += duration_ms
+        if self.keep_statements:
+            self.statements.append(statement)
+
+
+def _push(stats):
+    return _active.set(_active.get() + (stats,))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration_ms = (time.perf_counter() - conn.info['query_start'].pop()) * 1000
+    for stats in _active.get():
+        stats.add(statement, duration_ms)
+
+    slow_ms = _config.get('SLOW_QUERY_MS', 0)
+    if slow_ms and duration_ms >= slow_ms:
+        plan = explain(conn, statement, parameters) if not executemany else None
+        # En inserciones masivas solo se indica el número de filas, no todos los parámetros
+        shown = f"[{len(parameters)} filas]" if executemany else repr(parameters)
+        logging.warning(f"Consulta lenta ({duration_ms:.1f} ms): {statement} {shown}"
+                        + (f"\nPlan:\n{plan}" if plan else ""))
+
+
+def explain(conn, statement, parameters):
+    """Plan de ejecución de una SELECT en SQLite o PostgreSQL (None en otros casos)"""
+    if not statement.lstrip().upper().startswith('SELECT'):
+        return None
+    dialect = conn.dialect.name
+    if dialect == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    elif dialect == 'postgresql':
+        prefix = 'EXPLAIN '
+    else:
+        return None
+
+    # Cursor DBAPI directo para que el EXPLAIN no vuelva a pasar por estos eventos
+    try:
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute(prefix + statement, parameters)
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+    except Exception as e:
+        return f"(no se pudo obtener el plan: {e})"
+
+    if dialect == 'sqlite':
+        return "\n".join(f"  {row[-1]}" for row in rows)
+    return "\n".join(f"  {row[0]}" for row in rows)
+
+
+def init_app(app):
+    """Instrumenta todas las consultas y las resume por petición.
+
+    - SQL_QUERY_BUDGET: peticiones con más consultas se registran como aviso.
+    - SLOW_QUERY_MS: consultas más lentas se registran con su plan (EXPLAIN).
+    - En modo debug (o con SQL_STATS_HEADER) se añaden las cabeceras X-SQL-Queries y X-SQL-Time.
+    """
+    _config['SLOW_QUERY_MS'] = app.config.get('SLOW_QUERY_MS', 0)
+
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats()
+        g.query_stats_token = _push(g.query_stats)
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = g.get('query_stats')
+        if stats is None:
+            return response
+
+        budget = app.config.get('SQL_QUERY_BUDGET', 0)
+        if budget and stats.count > budget:
+            logging.warning(f"{request.method} {request.path}: {stats.count} consultas SQL "
+                            f"({stats.total_ms:.1f} ms), supera el presupuesto de {budget}")
+
+        if app.debug or app.config.get('SQL_STATS_HEADER'):
+            response.headers['X-SQL-Queries'] = str(stats.count)
+            response.headers['X-SQL-Time'] = f"{stats.total_ms:.2f}ms"
+        return response
+
+    @app.teardown_request
+    def stop_query_stats(exc):
+        token = g.pop('query_stats_token', None)
+        if token is not None:
+            _active.reset(token)
+
+
+@contextmanager
+def count_queries():
+    """Cuenta las consultas ejecutadas dentro del bloque (en este hilo)"""
+    stats = QueryStats(keep_statements=True)
+    token = _push(stats)
+    try:
+        yield stats
+    finally:
+        _active.reset(token)
+
+
+@contextmanager
+def assert_max_queries(limit):
+    """Falla si el bloque ejecuta más de `limit` consultas, listándolas en el mensaje"""
+    with count_queries() as stats:
+        yield stats
+    if stats.count > limit:
+        listing = "\n".join(f"  {i + 1}. {s}" for i, s in enumerate(stats.statements))
+        raise AssertionError(f"Se esperaban como mucho {limit} consultas y se ejecutaron {stats.count}:\n{listing}")
+
+
+def assert_route_queries(client, url, limit, **kwargs):
+    """Hace un GET con el cliente de pruebas de Flask y comprueba el número de consultas de la ruta"""
+    with assert_max_queries(limit):
+        response = client.get(url, **kwargs)
+    return response
@@ -0,0 +1,136 @@
+import threading
+import time
+from datetime import datetime
+
+# Sin latido del planificador durante este tiempo se considera detenido (el bucle
+# se despierta como mucho cada 60 s)
+STALE_AFTER_SECONDS = 150
+
+
+class SchedulerState:
+    """Estado en memoria del planificador de este proceso.
+
+    Lo actualiza el propio planificador (al arrancar, en cada vuelta del bucle, al
+    lanzar y terminar una publicación) y las vistas que editan horarios, de modo
+    que /api/scheduler, el dashboard y la sonda de disponibilidad lo leen sin
+    consultar la base de datos.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self.thread = None
+        self.started_at = None
+        self.last_tick_at = None
+        self._last_tick_monotonic = None
+        self.ticks = 0
+        self.last_dispatch_lag = None
+        self.last_error = None
+
+    def started(self, thread):
+        with self._lock:
+            self.thread = thread
+            self.started_at = datetime.utcnow()
+
+    def _job(self, slot, account_name=None):
+        previous = self._jobs.get(slot.id, {})
+        return {
+            'slot_id': slot.id,
+            'account_id': slot.account_id,
+            'account_name': account_name or previous.get('account_name'),
+            'label': slot.label,
+            'time_of_day': slot.time_of_day,
+            'weekdays': slot.weekdays,
+            'timezone': slot.timezone,
+            'next_run': slot.next_run_at,
+            'last_run': previous.get('last_run', slot.last_run_at),
+            'last_duration_ms': previous.get('last_duration_ms'),
+            'last_outcome': previous.get('last_outcome'),
+            'running': previous.get('running', False),
+        }
+
+    def load(self, slots):
+        """Sustituye la lista de trabajos (slots con su cuenta ya cargada)"""
+        with self._lock:
+            self._jobs = {slot.id: self._job(slot, slot.account.name) for slot in slots if slot.next_run_at}
+
+    def update_account(self, account):
+        """Refleja los horarios de una cuenta recién creada o editada"""
+        with self._lock:
+            for slot_id in [k for k, job in self._jobs.items() if job['account_id'] == account.id]:
+                del self._jobs[slot_id]
+            for slot in account.slots:
+                if slot.next_run_at:
+                    self._jobs[slot.id] = self._job(slot, account.name)
+
+    def remove_account(self, account_id):
+        with self._lock:
+            self._jobs = {k: job for k, job in self._jobs.items() if job['account_id'] != account_id}
+
+    def update_slot(self, slot):
+        """Horario recién ejecutado o reprogramado por el planificador"""
+        with self._lock:
+            if slot.next_run_at:
+                self._jobs[slot.id] = self._job(slot)
+            else:
+                self._jobs.pop(slot.id, None)
+
+    def tick(self, dispatch_lag=None, error=None):
+        """Latido del bucle del planificador"""
+        with self._lock:
+            self.ticks += 1
+            self.last_tick_at = datetime.utcnow()
+            self._last_tick_monotonic = time.monotonic()
+            if dispatch_lag is not None:
+                self.last_dispatch_lag = round(dispatch_lag, 1)
+            self.last_error = error
+
+    def run_started(self, slot_ids):
+        with self._lock:
+            for slot_id in slot_ids:
+                if slot_id in self._jobs:
+                    self._jobs[slot_id]['running'] = True
+
+    def run_finished(self, slot_ids, outcome, started_at, duration_ms):
+        with self._lock:
+            for slot_id in slot_ids:
+                job = self._jobs.get(slot_id)
+                if job is not None:
+                    job.update(running=False, last_run=started_at, last_duration_ms=duration_ms, last_outcome=outcome)
+
+    def alive(self):
+        """El hilo del planificador existe y ha dado señales de vida recientemente"""
+        if self.thread is None or not self.thread.is_alive() or self._last_tick_monotonic is None:
+            return False
+        return time.monotonic() - self._last_tick_monotonic < STALE_AFTER_SECONDS
+
+    def snapshot(self, limit=None):
+        """Estado serializable en JSON: trabajos ordenados por próxima ejecución"""
+        now = datetime.utcnow()
+        with self._lock:
+            jobs = sorted((dict(job) for job in self._jobs.values()), key=lambda job: job['next_run'])
+            state = {
+                'running': self.thread is not None,
+                'alive': self.alive(),
+                'started_at': _iso(self.started_at),
+                'last_tick_at': _iso(self.last_tick_at),
+                'ticks': self.ticks,
+                'last_error': self.last_error,
+                'last_dispatch_lag_seconds': self.last_dispatch_lag,
+            }
+        # Retraso actual: cuánto lleva vencido el trabajo más atrasado sin lanzarse
+        overdue = [(now - job['next_run']).total_seconds() for job in jobs if job['next_run'] <= now]
+        state['lag_seconds'] = round(max(overdue), 1) if overdue else 0.0
+        state['job_count'] = len(jobs)
+        for job in jobs:
+            job['next_run'] = _iso(job['next_run'])
+            job['last_run'] = _iso(job['last_run'])
+        state['jobs'] = jobs[:limit] if limit else jobs
+        return state
+
+
+def _iso(value):
+    return value.isoformat() + 'Z' if value else None
+
+
+scheduler_state = SchedulerState()
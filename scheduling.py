@@ -0,0 +1,161 @@
+import logging
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from app import app, db
+from models import PublicationSlot
+
+ALL_DAYS = 127
+WEEKDAY_NAMES = ['Lun', 'Mar', 'Mié', 'Jue', 'Vie', 'Sáb', 'Dom']
+
+# Horarios fijos del formulario de cuenta: (label, nombre, hora por defecto)
+FORM_SLOTS = [
+    ('morning', 'Mañana', '08:00'),
+    ('afternoon', 'Tarde', '15:00'),
+    ('evening', 'Noche', '22:00'),
+]
+
+
+def valid_timezone(name):
+    if not name:
+        return True
+    try:
+        ZoneInfo(name)
+        return True
+    except (ZoneInfoNotFoundError, ValueError):
+        return False
+
+
+def compute_next_run(time_of_day, weekdays, tz_name, after=None):
+    """Próxima ejecución (UTC, sin tzinfo) estrictamente posterior a `after` (UTC).
+
+    La hora se interpreta en la zona tz_name o, si está vacía, en la hora local
+    del servidor (como hacía el planificador con schedule).
+    """
+    if not weekdays:
+        return None
+    after = after or datetime.utcnow()
+    hour, minute = (int(part) for part in time_of_day.split(':'))
+    tzinfo = ZoneInfo(tz_name) if tz_name else None
+    local_now = after.replace(tzinfo=timezone.utc).astimezone(tzinfo)
+
+    for offset in range(8):
+        day = local_now.date() + timedelta(days=offset)
+        if not weekdays & (1 << day.weekday()):
+            continue
+        # Sin tzinfo, astimezone() interpreta la fecha como hora local del servidor
+        candidate = datetime(day.year, day.month, day.day, hour, minute, tzinfo=tzinfo).astimezone(timezone.utc)
+        candidate = candidate.replace(tzinfo=None)
+        if candidate > after:
+            return candidate
+    return None
+
+
+def prefetch_at(next_run_at, now=None):
+    """Hora de precarga de una ejecución, o None si no hay precarga o ya no da tiempo"""
+    lead_minutes = app.config["PREFETCH_LEAD_MINUTES"]
+    if next_run_at is None or lead_minutes <= 0:
+        return None
+    return max(next_run_at - timedelta(minutes=lead_minutes), now or datetime.utcnow())
+
+
+def reschedule(slot, now=None):
+    """Recalcula next_run_at y prefetch_at de un horario"""
+    now = now or datetime.utcnow()
+    if slot.enabled and slot.time_of_day:
+        slot.next_run_at = compute_next_run(slot.time_of_day, slot.weekdays, slot.timezone, now)
+    else:
+        slot.next_run_at = None
+    slot.prefetch_at = prefetch_at(slot.next_run_at, now)
+
+
+def sync_account_slots(account, values):
+    """Aplica los horarios del formulario a la cuenta.
+
+    values: {label: (enabled, time_of_day, weekdays, timezone)}. Solo se recalculan
+    (y se escriben) los horarios que han cambiado; devuelve cuántos son.
+    """
+    existing = {slot.label: slot for slot in account.slots}
+    changed = 0
+    for label, (enabled, time_of_day, weekdays, tz_name) in values.items():
+        slot = existing.get(label)
+        if slot is None:
+            slot = PublicationSlot(account=account, label=label)
+            db.session.add(slot)
+        elif (slot.enabled, slot.time_of_day, slot.weekdays, slot.timezone or '') == \
+                (enabled, time_of_day, weekdays, tz_name or ''):
+            continue
+        slot.enabled = enabled
+        slot.time_of_day = time_of_day
+        slot.weekdays = weekdays
+        slot.timezone = tz_name or None
+        reschedule(slot)
+        changed += 1
+    return changed
+
+
+def due_slots(now=None):
+    """Horarios cuya ejecución ha vencido (consulta por el índice de next_run_at)"""
+    now = now or datetime.utcnow()
+    return PublicationSlot.query.filter(PublicationSlot.next_run_at <= now).order_by(PublicationSlot.next_run_at).all()
+
+
+def due_prefetches(now=None):
+    now = now or datetime.utcnow()
+    return PublicationSlot.query.filter(PublicationSlot.prefetch_at <= now).all()
+
+
+def next_wakeup():
+    """Próximo instante (UTC) en que vence una ejecución o una precarga"""
+    candidates = [
+        db.session.query(db.func.min(PublicationSlot.next_run_at)).scalar(),
+        db.session.query(db.func.min(PublicationSlot.prefetch_at)).scalar(),
+    ]
+    candidates = [c for c in candidates if c is not None]
+    return min(candidates) if candidates else None
+
+
+def advance(slot, now=None):
+    """Marca un horario como ejecutado y calcula su siguiente ejecución"""
+    now = now or datetime.utcnow()
+    slot.last_run_at = now
+    reschedule(slot, now)
+
+
+def rebuild_all():
+    """Recalcula todos los horarios (p. ej. tras un cambio de hora del servidor)"""
+    now = datetime.utcnow()
+    for slot in PublicationSlot.query.all():
+        reschedule(slot, now)
+    db.session.commit()
+
+
+def weekday_labels(weekdays):
+    if weekdays == ALL_DAYS:
+        return 'todos los días'
+    return ', '.join(name for i, name in enumerate(WEEKDAY_NAMES) if weekdays & (1 << i))
+
+
+def migrate_fixed_slots():
+    """Crea los horarios a partir de las antiguas columnas morning/afternoon/evening de account"""
+    inspector = db.inspect(db.engine)
+    columns = {col['name'] for col in inspector.get_columns('account')}
+    if 'morning_time' not in columns or PublicationSlot.query.first() is not None:
+        return
+
+    rows = db.session.execute(db.text(
+        "SELECT id, morning_post, morning_time, afternoon_post, afternoon_time, evening_post, evening_time FROM account"
+    )).fetchall()
+    now = datetime.utcnow()
+    created = 0
+    for row in rows:
+        for index, (label, _, default_time) in enumerate(FORM_SLOTS):
+            enabled, time_of_day = row[1 + index * 2], row[2 + index * 2]
+            slot = PublicationSlot(account_id=row[0], label=label, time_of_day=time_of_day or default_time,
+                                   weekdays=ALL_DAYS, enabled=bool(enabled) and bool(time_of_day))
+            reschedule(slot, now)
+            db.session.add(slot)
+            created += 1
+    db.session.commit()
+    if created:
+        logging.info(f"Migración completada: {created} horarios creados a partir de las columnas de account")
@@ -178,4 +178,21 @@ document.addEventListener('DOMContentLoaded', function() {
             }
         });
     }
+
+    // Estado del planificador en el dashboard (la página puede venir de la caché de vistas)
+    const schedulerStatus = document.getElementById('scheduler-status');
+    if (schedulerStatus) {
+        const refreshScheduler = function() {
+            fetch('/api/scheduler')
+                .then(response => response.json())
+                .then(state => {
+                    schedulerStatus.textContent = state.alive ? 'Planificador activo' : 'Planificador detenido';
+                    schedulerStatus.classList.toggle('bg-success', state.alive);
+                    schedulerStatus.classList.toggle('bg-secondary', !state.alive);
+                    schedulerStatus.title = `Último latido: ${state.last_tick_at || '-'}`;
+                })
+                .catch(() => {});
+        };
+        setInterval(refreshScheduler, 30000);
+    }
 });
@@ -0,0 +1,66 @@
+import json
+import logging
+import mimetypes
+import os
+
+from flask import abort, request, send_file, url_for
+
+DIST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'dist')
+MANIFEST_PATH = os.path.join(DIST_DIR, 'manifest.json')
+
+# Los ficheros con hash en el nombre nunca cambian: se pueden cachear un año
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+class StaticAssets:
+    """Sirve los recursos generados por build_static.py (nombre con hash y precomprimidos).
+
+    Si no hay manifest (entorno de desarrollo sin build) asset_url() devuelve la URL
+    normal de /static, así que las plantillas funcionan en ambos casos.
+    """
+
+    def __init__(self):
+        self.manifest = {}
+        self.hashed_files = set()
+
+    def init_app(self, app):
+        if os.path.exists(MANIFEST_PATH) and not app.debug:
+            with open(MANIFEST_PATH) as f:
+                self.manifest = json.load(f)
+            self.hashed_files = set(self.manifest.values())
+            logging.info(f"Recursos estáticos con hash cargados: {len(self.manifest)}")
+
+        app.add_url_rule('/assets/<path:filename>', 'assets', self.serve)
+        app.jinja_env.globals['asset_url'] = self.asset_url
+
+    def asset_url(self, filename):
+        hashed = self.manifest.get(filename)
+        if hashed is None:
+            return url_for('static', filename=filename)
+        return url_for('assets', filename=hashed)
+
+    def serve(self, filename):
+        if filename not in self.hashed_files:
+            abort(404)
+
+        path = os.path.join(DIST_DIR, filename)
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+        # Elegir la variante precomprimida que acepte el cliente
+        encoding = None
+        for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if request.accept_encodings[candidate] and os.path.exists(path + suffix):
+                encoding = candidate
+                path += suffix
+                break
+
+        response = send_file(path, mimetype=mimetype, conditional=True, etag=True, max_age=IMMUTABLE_MAX_AGE)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+
+static_assets = StaticAssets()
@@ -0,0 +1,185 @@
+"""Logging de la aplicación: cola no bloqueante, registros estructurados y límite de repeticiones.
+
+Los módulos siguen usando logging.info(...) como siempre. init_app sustituye los
+manejadores del logger raíz por un QueueHandler: el hilo que registra solo formatea
+el mensaje y lo deja en una cola acotada, y un QueueListener en su propio hilo lo
+escribe (en JSON o texto) en stderr y, opcionalmente, en LOG_FILE. Si la cola se
+llena, los registros se descartan en lugar de bloquear la publicación o la petición.
+
+Cada registro lleva el contexto activo (account_id, run_id) fijado con bind() o
+log_context(). Las líneas de nivel INFO/DEBUG que se repiten desde el mismo punto
+del código (p. ej. una por fichero de la carpeta) se limitan a LOG_RATE_LIMIT cada
+LOG_RATE_WINDOW segundos; el siguiente registro que pasa indica cuántas se omitieron.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+_context = contextvars.ContextVar('log_context', default={})
+
+_listener = None
+
+
+def bind(**fields):
+    """Añade campos al contexto de log del hilo (o tarea asyncio) actual; devuelve el token para unbind"""
+    return _context.set({**_context.get(), **fields})
+
+
+def unbind(token):
+    _context.reset(token)
+
+
+@contextmanager
+def log_context(**fields):
+    token = bind(**fields)
+    try:
+        yield
+    finally:
+        unbind(token)
+
+
+class RateLimitFilter(logging.Filter):
+    """Deja pasar como mucho `limit` registros por línea de código cada `window` segundos.
+
+    Los avisos y errores no se limitan nunca.
+    """
+
+    def __init__(self, limit, window):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self._lock = threading.Lock()
+        self._sites = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.limit <= 0:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None or now - site[0] >= self.window:
+                if site is not None and site[2]:
+                    record.suppressed = site[2]
+                site = self._sites[key] = [now, 0, 0]
+            if site[1] >= self.limit:
+                site[2] += 1
+                return False
+            site[1] += 1
+        return True
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler que añade el contexto y descarta (contando) si la cola está llena"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # En el hilo que registra se resuelve lo que no puede cruzar la cola (args y traceback)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.context = _context.get()
+        return record
+
+    def enqueue(self, record):
+        if self.dropped:
+            # Recuento aproximado: no se protege con un lock para no añadir coste
+            record.dropped, self.dropped = self.dropped, 0
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """Una línea JSON por registro"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'msg': record.getMessage(),
+        }
+        entry.update(getattr(record, 'context', {}))
+        for key in ('suppressed', 'dropped'):
+            if getattr(record, key, None):
+                entry[key] = getattr(record, key)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Formato de texto legible con el contexto entre corchetes"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s%(context_text)s %(message)s')
+
+    def format(self, record):
+        context = dict(getattr(record, 'context', {}))
+        for key in ('suppressed', 'dropped'):
+            if getattr(record, key, None):
+                context[key] = getattr(record, key)
+        record.context_text = ' [' + ' '.join(f"{k}={v}" for k, v in context.items()) + ']' if context else ''
+        return super().format(record)
+
+
+def parse_levels(value):
+    """'werkzeug=WARNING,urllib3=ERROR' -> {'werkzeug': 'WARNING', 'urllib3': 'ERROR'}"""
+    levels = {}
+    for item in (value or '').split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def init_app(app):
+    """Configura el logger raíz según LOG_* de app.config"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    formatter = JsonFormatter() if app.config["LOG_FORMAT"] == 'json' else TextFormatter()
+    outputs = [logging.StreamHandler(sys.stderr)]
+    if app.config["LOG_FILE"]:
+        outputs.append(logging.FileHandler(app.config["LOG_FILE"], encoding='utf-8'))
+    for output in outputs:
+        output.setFormatter(formatter)
+
+    handler = ContextQueueHandler(queue.Queue(app.config["LOG_QUEUE_SIZE"]))
+    handler.addFilter(RateLimitFilter(app.config["LOG_RATE_LIMIT"], app.config["LOG_RATE_WINDOW"]))
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(app.config["LOG_LEVEL"].upper())
+    for name, level in parse_levels(app.config["LOG_LEVELS"]).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(handler.queue, *outputs)
+    _listener.start()
+    return handler
+
+
+@atexit.register
+def _stop_listener():
+    # Vacía la cola antes de salir para no perder los últimos registros
+    if _listener is not None:
+        _listener.stop()
@@ -0,0 +1,13 @@
+"""Entorno de los tests: base de datos temporal y sin planificador.
+
+La configuración se lee de las variables de entorno al importar app, así que se
+fija aquí, antes de que cualquier test lo importe.
+"""
+import os
+import tempfile
+
+_db_dir = tempfile.mkdtemp(prefix='test_app_')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_db_dir, 'test.db')}"
+os.environ['DISABLE_SCHEDULER'] = '1'
+# Sin caché de vistas: se miden las consultas de la página, no las de la caché
+os.environ['VIEW_CACHE_TTL'] = '0'
@@ -0,0 +1,46 @@
+"""La precarga y la publicación de una misma cuenta no se solapan."""
+import threading
+
+from app import app  # noqa: F401  instagram_publisher importa app
+import instagram_publisher
+
+
+def test_publish_waits_for_prefetch_of_same_account(monkeypatch):
+    events = []
+    prefetch_started = threading.Event()
+    release_prefetch = threading.Event()
+
+    def prefetch(account_id, *args):
+        events.append(('prefetch', account_id, 'start'))
+        prefetch_started.set()
+        release_prefetch.wait(5)
+        events.append(('prefetch', account_id, 'end'))
+
+    def publish(account_id, *args):
+        events.append(('publish', account_id, 'start'))
+        events.append(('publish', account_id, 'end'))
+        return {"status": "success"}
+
+    monkeypatch.setattr(instagram_publisher, '_prefetch_for_account', prefetch)
+    monkeypatch.setattr(instagram_publisher, '_publish_for_account', publish)
+
+    prefetch_thread = threading.Thread(target=instagram_publisher.prefetch_for_account,
+                                       args=(1, 'user', 'x', 'folder', 'x', 'creds'))
+    prefetch_thread.start()
+    assert prefetch_started.wait(5)
+
+    publish_thread = threading.Thread(target=instagram_publisher.publish_for_account,
+                                      args=(1, 'user', 'x', 'folder', 'x', 'creds'))
+    publish_thread.start()
+    # Otra cuenta no espera
+    instagram_publisher.publish_for_account(2, 'other', 'x', 'folder', 'x', 'creds')
+    publish_thread.join(0.2)
+    assert publish_thread.is_alive()
+
+    release_prefetch.set()
+    prefetch_thread.join(5)
+    publish_thread.join(5)
+
+    assert [e for e in events if e[1] == 1] == [
+        ('prefetch', 1, 'start'), ('prefetch', 1, 'end'), ('publish', 1, 'start'), ('publish', 1, 'end')]
+    assert ('publish', 2, 'end') in events
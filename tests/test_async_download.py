@@ -0,0 +1,90 @@
+"""Descarga reanudable de HttpDrive contra un servidor HTTP local.
+
+Un estado de drive_download puede tener varios segmentos (DRIVE_PARALLEL_RANGES):
+HttpDrive debe completar cada uno con su propio rango, no añadirlo todo al primero.
+"""
+import asyncio
+import hashlib
+import json
+import os
+
+import pytest
+from aiohttp import web
+
+from app import app  # noqa: F401  async_publisher importa app
+import async_publisher
+import drive_download
+
+CONTENT = bytes(range(256)) * 40
+
+
+async def _drive_handler(request):
+    """Sirve CONTENT respetando Range (o ignorándolo si la app lo pide)"""
+    request.app['ranges'].append(request.headers.get('Range'))
+    if request.app['ignore_range']:
+        return web.Response(body=CONTENT)
+    start, _, end = request.headers['Range'].removeprefix('bytes=').partition('-')
+    start, end = int(start), int(end) if end else len(CONTENT) - 1
+    if start >= len(CONTENT):
+        return web.Response(status=416)
+    return web.Response(status=206, body=CONTENT[start:end + 1],
+                        headers={'Content-Range': f"bytes {start}-{end}/{len(CONTENT)}"})
+
+
+def _fetch(tmp_path, monkeypatch, ignore_range=False):
+    """Prepara un estado de dos segmentos a medias y ejecuta HttpDrive._fetch"""
+    file_path = str(tmp_path / 'image.jpg')
+    half = len(CONTENT) // 2
+    metadata = {'size': len(CONTENT), 'md5Checksum': hashlib.md5(CONTENT).hexdigest()}
+    with open(drive_download.state_path(file_path), 'w') as f:
+        json.dump({'md5': metadata['md5Checksum'], 'size': metadata['size'],
+                   'segments': [[0, half - 1], [half, len(CONTENT) - 1]]}, f)
+    with open(drive_download.part_path(file_path, 0), 'wb') as f:
+        f.write(CONTENT[:100])
+    with open(drive_download.part_path(file_path, 1), 'wb') as f:
+        f.write(CONTENT[half:half + 50])
+
+    async def run():
+        server_app = web.Application()
+        server_app['ranges'] = []
+        server_app['ignore_range'] = ignore_range
+        server_app.router.add_get('/files/{file_id}', _drive_handler)
+        runner = web.AppRunner(server_app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        drive = async_publisher.HttpDrive.__new__(async_publisher.HttpDrive)
+        drive._headers = lambda: asyncio.sleep(0, {})
+        monkeypatch.setattr(async_publisher, 'DRIVE_API', f"http://127.0.0.1:{port}/files")
+        try:
+            async with async_publisher.aiohttp.ClientSession() as drive.http:
+                try:
+                    await drive._fetch('file', file_path, metadata)
+                    return server_app['ranges'], None
+                except Exception as e:
+                    return server_app['ranges'], e
+        finally:
+            await runner.cleanup()
+
+    return file_path, asyncio.run(run())
+
+
+def test_resumes_each_segment_with_its_own_range(tmp_path, monkeypatch):
+    half = len(CONTENT) // 2
+    file_path, (ranges, error) = _fetch(tmp_path, monkeypatch)
+
+    assert error is None
+    assert ranges == [f"bytes=100-{half - 1}", f"bytes={half + 50}-{len(CONTENT) - 1}"]
+    with open(file_path, 'rb') as f:
+        assert f.read() == CONTENT
+    assert not [name for name in os.listdir(tmp_path) if '.part' in name]
+
+
+def test_ignored_range_discards_partial_segments(tmp_path, monkeypatch):
+    file_path, (ranges, error) = _fetch(tmp_path, monkeypatch, ignore_range=True)
+
+    assert isinstance(error, ConnectionError)
+    # La siguiente descarga empieza con un plan nuevo
+    assert os.listdir(tmp_path) == []
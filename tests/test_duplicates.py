@@ -0,0 +1,94 @@
+"""Duplicados dentro del mismo lote.
+
+Una imagen solo hace duplicadas a las siguientes del lote cuando llega a
+publicarse: si su subida falla, una copia casi idéntica del mismo lote se sigue
+publicando.
+"""
+import io
+import os
+
+import pytest
+from PIL import Image, ImageDraw
+
+from app import app, db
+import instagram_publisher
+from error_codes import ErrorCode
+from models import Account, QueueItem
+
+
+def _image_bytes():
+    img = Image.new('RGB', (320, 240), (30, 90, 160))
+    ImageDraw.Draw(img).rectangle([40, 40, 200, 180], fill=(240, 200, 20))
+    buffer = io.BytesIO()
+    img.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+class FakeService:
+    def files(self):
+        return self
+
+    def get(self, **kwargs):
+        return self
+
+    def execute(self):
+        return {'name': 'test'}
+
+
+@pytest.fixture
+def publisher(monkeypatch, tmp_path):
+    """Cuenta con dos copias de la misma imagen en Drive; las llamadas externas se sustituyen"""
+    monkeypatch.chdir(tmp_path)
+    content = _image_bytes()
+    posted = []
+
+    def download_image(service, file_id, file_name, dest_dir='.'):
+        path = os.path.join(dest_dir, file_name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    monkeypatch.setattr(instagram_publisher, 'authenticate_google_drive', lambda path: FakeService())
+    monkeypatch.setattr(instagram_publisher, 'get_new_images', lambda service, folder_id: [
+        {'id': f"{folder_id}-{n}", 'name': f"{folder_id}-{n}.jpg", 'mimeType': 'image/jpeg',
+         'modifiedTime': '2024-01-01T00:00:00.000Z'} for n in range(2)])
+    monkeypatch.setattr(instagram_publisher, 'download_image', download_image)
+    monkeypatch.setattr(instagram_publisher, 'get_gemini_image_description', lambda *args, **kwargs: "Descripción")
+    monkeypatch.setattr(instagram_publisher, 'rename_file', lambda service, file_id, new_name: True)
+    monkeypatch.setitem(app.config, 'DUPLICATE_ACTION', 'skip')
+
+    with app.app_context():
+        account = Account(name=f"dup-{tmp_path.name}", instagram_username='dup',
+                          instagram_password='x', folder_id=f"dup-{tmp_path.name}", gemini_api_key='x',
+                          posts_per_slot=2)
+        db.session.add(account)
+        db.session.commit()
+        account_id, folder_id = account.id, account.folder_id
+
+    def run(first_error):
+        def post_to_instagram(image_path, caption, username, password, trace=None):
+            posted.append(os.path.basename(image_path))
+            if len(posted) == 1:
+                return False, "Error al publicar", None, first_error
+            return True, "Publicado con éxito. ID de media: 1", "1", None
+
+        monkeypatch.setattr(instagram_publisher, 'post_to_instagram', post_to_instagram)
+        with app.app_context():
+            result = instagram_publisher.publish_for_account(account_id, 'dup', 'x', folder_id, 'x', 'unused')
+            statuses = {item.file_id: item.status for item in QueueItem.query.filter_by(account_id=account_id)}
+        return result, statuses
+
+    return folder_id, posted, run
+
+
+@pytest.mark.parametrize('first_error', [ErrorCode.IG_RATE_LIMITED, ErrorCode.IG_UPLOAD])
+def test_failed_upload_does_not_mark_same_batch_copy_as_duplicate(publisher, first_error):
+    folder_id, posted, run = publisher
+
+    result, statuses = run(first_error)
+
+    assert result['status'] == 'success', result
+    # La segunda copia se sube aunque sea casi idéntica a la primera, que no se publicó
+    assert len(posted) == 2, result
+    assert statuses[f"{folder_id}-1"] == 'published'
+    assert 'duplicate' not in statuses.values()
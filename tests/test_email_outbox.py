@@ -0,0 +1,143 @@
+"""Envío de la bandeja de salida contra un servidor SMTP local.
+
+El servidor es un stub en un hilo (socketserver) que responde a cada destinatario
+con los códigos que indique el test: así se comprueban la entrega, los reintentos
+con espera exponencial tras un 4xx y el descarte inmediato tras un 5xx.
+"""
+import socketserver
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import app, db
+from email_utils import EmailSender
+from models import EmailOutbox
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode('ascii'))
+
+    def handle(self):
+        server = self.server
+        recipient = None
+        self.reply("220 localhost ESMTP stub")
+        for raw in self.rfile:
+            command = raw.decode('ascii').strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.reply("250 localhost")
+            elif verb == 'MAIL':
+                self.reply("250 OK")
+            elif verb == 'RCPT':
+                recipient = command.split(':', 1)[1].strip().strip('<>')
+                responses = server.rcpt_responses.get(recipient, [])
+                self.reply(responses.pop(0) if responses else "250 OK")
+            elif verb == 'DATA':
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                lines = []
+                for data in self.rfile:
+                    if data in (b'.\r\n', b'.\n'):
+                        break
+                    lines.append(data.decode('ascii'))
+                server.messages.append((recipient, ''.join(lines)))
+                self.reply("250 OK queued")
+            elif verb in ('NOOP', 'RSET'):
+                self.reply("250 OK")
+            elif verb == 'QUIT':
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+@pytest.fixture
+def smtp_server(monkeypatch):
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPHandler)
+    server.daemon_threads = True
+    server.rcpt_responses = {}
+    server.messages = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    for key, value in {'EMAIL_SIMULATE': False, 'SMTP_HOST': '127.0.0.1', 'SMTP_PORT': server.server_address[1],
+                       'SMTP_SSL': False, 'SMTP_STARTTLS': False, 'SMTP_TIMEOUT': 5, 'EMAIL_USER': None,
+                       'EMAIL_PASSWORD': None, 'EMAIL_MAX_ATTEMPTS': 6, 'EMAIL_RETRY_BASE_SECONDS': 30}.items():
+        monkeypatch.setitem(app.config, key, value)
+    with app.app_context():
+        EmailOutbox.query.delete()
+        db.session.commit()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def sender():
+    sender = EmailSender()
+    yield sender
+    sender._disconnect()
+
+
+def _enqueue(recipient):
+    message = EmailOutbox(recipient=recipient, subject='Prueba', html='<p>Hola</p>')
+    db.session.add(message)
+    db.session.commit()
+    return message.id
+
+
+def test_delivers_pending_email(smtp_server, sender):
+    with app.app_context():
+        message_id = _enqueue('user@example.com')
+
+        assert sender.send_pending() == 1
+
+        message = db.session.get(EmailOutbox, message_id)
+        assert message.status == 'sent'
+        assert message.sent_at is not None
+        assert message.attempts == 0
+    assert [recipient for recipient, _ in smtp_server.messages] == ['user@example.com']
+    assert 'To: user@example.com' in smtp_server.messages[0][1]
+
+
+def test_transient_failure_is_retried_with_backoff(smtp_server, sender):
+    smtp_server.rcpt_responses['busy@example.com'] = ["451 Try again later", "451 Try again later"]
+    with app.app_context():
+        message_id = _enqueue('busy@example.com')
+
+        for attempt, delay in ((1, 30), (2, 60)):
+            before = datetime.utcnow()
+            assert sender.send_pending() == 1
+            message = db.session.get(EmailOutbox, message_id)
+            assert message.status == 'pending'
+            assert message.attempts == attempt
+            assert '451' in message.last_error
+            # Espera exponencial: EMAIL_RETRY_BASE_SECONDS * 2 ** (intentos - 1)
+            assert before + timedelta(seconds=delay - 1) <= message.next_attempt_at
+            assert message.next_attempt_at <= datetime.utcnow() + timedelta(seconds=delay)
+
+            # Antes de la hora del reintento no se vuelve a enviar
+            assert sender.send_pending() == 0
+            message.next_attempt_at = datetime.utcnow() - timedelta(seconds=1)
+            db.session.commit()
+
+        assert sender.send_pending() == 1
+        message = db.session.get(EmailOutbox, message_id)
+        assert message.status == 'sent'
+        assert message.attempts == 2
+    assert [recipient for recipient, _ in smtp_server.messages] == ['busy@example.com']
+
+
+def test_permanent_failure_is_marked_failed(smtp_server, sender):
+    smtp_server.rcpt_responses['nobody@example.com'] = ["550 No such user"]
+    with app.app_context():
+        message_id = _enqueue('nobody@example.com')
+
+        assert sender.send_pending() == 1
+
+        message = db.session.get(EmailOutbox, message_id)
+        assert message.status == 'failed'
+        assert message.attempts == 1
+        assert '550' in message.last_error
+        assert sender.send_pending() == 0
+    assert smtp_server.messages == []
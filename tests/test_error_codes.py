@@ -0,0 +1,37 @@
+"""Clasificación de los errores de Gemini por tipo y estado HTTP, no por el texto."""
+import aiohttp
+import pytest
+from yarl import URL
+
+from app import app  # noqa: F401  app importa error_codes
+from error_codes import ErrorCode, classify_gemini
+
+
+class ResourceExhausted(Exception):
+    """Mismo nombre que la excepción de google-api-core"""
+    code = 429
+
+
+def _client_response_error(status):
+    url = URL('https://generativelanguage.googleapis.com/v1beta/models/gemini:generateContent')
+    request_info = aiohttp.RequestInfo(url, 'POST', {}, url)
+    return aiohttp.ClientResponseError(request_info, (), status=status, message='error')
+
+
+@pytest.mark.parametrize('error', [
+    _client_response_error(429),
+    ResourceExhausted('Resource has been exhausted'),
+])
+def test_quota_errors(error):
+    assert classify_gemini(error) == ErrorCode.GEMINI_QUOTA
+
+
+@pytest.mark.parametrize('error, expected', [
+    # '429' en el texto no es un 429 de Gemini
+    (ValueError('La imagen IMG_4290.jpg no es válida'), ErrorCode.UNKNOWN),
+    (_client_response_error(500), ErrorCode.UNKNOWN),
+    (TimeoutError('read timed out after 429 ms'), ErrorCode.TIMEOUT),
+    ('gemini respondió 429', ErrorCode.UNKNOWN),
+])
+def test_non_quota_errors(error, expected):
+    assert classify_gemini(error) == expected
@@ -0,0 +1,48 @@
+"""Número de consultas SQL de las páginas principales.
+
+Con varias cuentas y historial, cada ruta debe ejecutar un número fijo de
+consultas: una consulta por cuenta o por fila (N+1) supera el límite y el test
+falla con la lista de sentencias ejecutadas (query_stats.assert_route_queries).
+"""
+import random
+
+import pytest
+
+from app import app, db
+import error_codes
+import generate_data
+from query_stats import assert_route_queries
+
+ACCOUNTS = 10
+HISTORY_ROWS = 500
+
+# Consultas esperadas por ruta, incluida la del usuario de la sesión
+ROUTE_LIMITS = {
+    '/': 4,
+    '/dashboard': 8,
+    '/history': 4,
+    '/history?account_id=1': 5,
+}
+
+
+@pytest.fixture(scope='module')
+def client():
+    rnd = random.Random(1)
+    with app.app_context():
+        generate_data.create_user('test', 'test')
+        accounts = generate_data.create_accounts(ACCOUNTS, 5, rnd)
+        message_ids = {message: error_codes.message_id(message) for message in generate_data.ERROR_MESSAGES}
+        db.session.commit()
+        generate_data.insert_history(
+            generate_data.history_rows(accounts, HISTORY_ROWS, 0.01, 0.5, 0.2, rnd, message_ids), 1000)
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    client = app.test_client()
+    client.post('/login', data={'username': 'test', 'password': 'test'})
+    return client
+
+
+@pytest.mark.parametrize('url,limit', ROUTE_LIMITS.items())
+def test_route_queries(client, url, limit):
+    response = assert_route_queries(client, url, limit)
+    assert response.status_code == 200
@@ -0,0 +1,89 @@
+"""Reanudación de una subida interrumpida (checkpoint en 'uploading').
+
+Si no se puede consultar Instagram para saber si la imagen llegó a publicarse,
+no se repite la subida: el checkpoint y la cola quedan como estaban y se vuelve
+a comprobar en el siguiente horario.
+"""
+import types
+
+import pytest
+
+from app import app, db
+import instagram_publisher
+from models import Account, PreparedPost, QueueItem
+
+CAPTION = "Descripción de la imagen interrumpida"
+
+
+class FakeService:
+    def files(self):
+        return self
+
+    def get(self, **kwargs):
+        return self
+
+    def execute(self):
+        return {'name': 'test'}
+
+
+class FakeClient:
+    user_id = 1
+
+    def user_medias(self, user_id, amount):
+        return [types.SimpleNamespace(id='42', caption_text=CAPTION, taken_at=None)]
+
+
+@pytest.fixture
+def interrupted(monkeypatch, tmp_path):
+    """Cuenta con una imagen cuya subida se interrumpió"""
+    monkeypatch.chdir(tmp_path)
+    posted = []
+    monkeypatch.setattr(instagram_publisher, 'authenticate_google_drive', lambda path: FakeService())
+    monkeypatch.setattr(instagram_publisher, 'get_new_images', lambda service, folder_id: [
+        {'id': f"{folder_id}-0", 'name': f"{folder_id}-0.jpg", 'mimeType': 'image/jpeg',
+         'modifiedTime': '2024-01-01T00:00:00.000Z'}])
+    monkeypatch.setattr(instagram_publisher, 'rename_file', lambda service, file_id, new_name: True)
+    monkeypatch.setattr(instagram_publisher, 'post_to_instagram',
+                        lambda *args, **kwargs: posted.append(args) or (True, "Publicado", "1", None))
+
+    with app.app_context():
+        account = Account(name=f"resume-{tmp_path.name}", instagram_username='resume', instagram_password='x',
+                          folder_id=f"resume-{tmp_path.name}", gemini_api_key='x', posts_per_slot=1)
+        db.session.add(account)
+        db.session.commit()
+        db.session.add(PreparedPost(account_id=account.id, file_id=f"{account.folder_id}-0",
+                                    file_name=f"{account.folder_id}-0.jpg", caption=CAPTION, stage='uploading'))
+        db.session.commit()
+        account_id, folder_id = account.id, account.folder_id
+
+    def run():
+        with app.app_context():
+            result = instagram_publisher.publish_for_account(account_id, 'resume', 'x', folder_id, 'x', 'unused')
+            prepared = PreparedPost.query.filter_by(account_id=account_id).first()
+            item = QueueItem.query.filter_by(account_id=account_id).one()
+            return result, prepared.stage if prepared else None, item.status
+
+    return posted, run
+
+
+def test_lookup_failure_keeps_checkpoint_and_skips_upload(interrupted, monkeypatch):
+    posted, run = interrupted
+    monkeypatch.setattr(instagram_publisher, 'get_instagram_client',
+                        lambda username, password: (None, False, "login_required"))
+
+    result, stage, status = run()
+
+    assert result['status'] == 'success', result
+    assert posted == []
+    assert stage == 'uploading'
+    assert status == 'pending'
+
+    # En el siguiente horario la consulta funciona y la imagen ya estaba publicada
+    monkeypatch.setattr(instagram_publisher, 'get_instagram_client',
+                        lambda username, password: (FakeClient(), True, "ok"))
+
+    result, stage, status = run()
+
+    assert posted == []
+    assert stage is None
+    assert status == 'published'
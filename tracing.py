@@ -0,0 +1,132 @@
+import json
+import logging
+import random
+import time
+import uuid
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+
+from app import app, db
+from models import PublicationTrace
+
+
+class RunTrace:
+    """Traza de una ejecución de publicación: un run_id y una lista de spans"""
+
+    def __init__(self, account_id, trigger='manual'):
+        self.run_id = uuid.uuid4().hex
+        self.account_id = account_id
+        self.trigger = trigger
+        self.started_at = datetime.utcnow()
+        self.status = 'success'
+        self.spans = []
+        self._t0 = time.perf_counter()
+
+    @contextmanager
+    def span(self, name, image=None):
+        """Mide un paso de la ejecución. El bloque puede rellenar span['bytes']"""
+        span = {'name': name, 'image': image, 'bytes': None, 'error': False}
+        start = time.perf_counter()
+        try:
+            yield span
+        except Exception:
+            span['error'] = True
+            raise
+        finally:
+            span['start_ms'] = int((start - self._t0) * 1000)
+            span['duration_ms'] = int((time.perf_counter() - start) * 1000)
+            self.spans.append(span)
+
+    @property
+    def duration_ms(self):
+        return int((time.perf_counter() - self._t0) * 1000)
+
+
+@contextmanager
+def span(trace, name, image=None):
+    """Igual que RunTrace.span pero tolera trace=None (funciones llamadas sin traza)"""
+    if trace is None:
+        yield {}
+        return
+    with trace.span(name, image) as s:
+        yield s
+
+
+def encode_spans(spans):
+    """Codifica los spans en JSON compacto comprimido con zlib.
+
+    Cada span se guarda como [nombre, índice de imagen, inicio, duración, bytes, error]
+    y los nombres de imagen se almacenan una sola vez.
+    """
+    images = []
+    rows = []
+    for s in sorted(spans, key=lambda s: s['start_ms']):
+        image_index = -1
+        if s.get('image'):
+            if s['image'] not in images:
+                images.append(s['image'])
+            image_index = images.index(s['image'])
+        rows.append([s['name'], image_index, s['start_ms'], s['duration_ms'], s.get('bytes'), 1 if s.get('error') else 0])
+    payload = json.dumps({'i': images, 's': rows}, separators=(',', ':'))
+    return zlib.compress(payload.encode('utf-8'), 9)
+
+
+def decode_spans(blob):
+    """Inverso de encode_spans: devuelve una lista de diccionarios"""
+    if not blob:
+        return []
+    data = json.loads(zlib.decompress(blob).decode('utf-8'))
+    images = data.get('i', [])
+    return [{
+        'name': name,
+        'image': images[image_index] if image_index >= 0 else None,
+        'start_ms': start_ms,
+        'duration_ms': duration_ms,
+        'bytes': size,
+        'error': bool(error),
+    } for name, image_index, start_ms, duration_ms, size, error in data.get('s', [])]
+
+
+def should_store(trace, duration_ms):
+    """Muestreo: siempre se guardan las ejecuciones con error o lentas, el resto según TRACE_SAMPLE_RATE"""
+    if trace.status != 'success':
+        return True
+    if duration_ms >= app.config['TRACE_SLOW_MS']:
+        return True
+    return random.random() < app.config['TRACE_SAMPLE_RATE']
+
+
+def save_trace(trace):
+    """Guarda la traza si pasa el muestreo y recorta las trazas antiguas de la cuenta"""
+    duration_ms = trace.duration_ms
+    if not should_store(trace, duration_ms):
+        logging.debug(f"Traza {trace.run_id} descartada por muestreo")
+        return False
+
+    try:
+        db.session.add(PublicationTrace(
+            run_id=trace.run_id,
+            account_id=trace.account_id,
+            trigger=trace.trigger,
+            started_at=trace.started_at,
+            duration_ms=duration_ms,
+            status=trace.status,
+            span_count=len(trace.spans),
+            spans=encode_spans(trace.spans)
+        ))
+        db.session.commit()
+
+        # Mantener acotado el almacenamiento: solo las últimas TRACE_MAX_PER_ACCOUNT trazas por cuenta
+        keep_ids = db.session.query(PublicationTrace.id).filter_by(account_id=trace.account_id) \
+            .order_by(PublicationTrace.started_at.desc()).limit(app.config['TRACE_MAX_PER_ACCOUNT'])
+        PublicationTrace.query.filter(
+            PublicationTrace.account_id == trace.account_id,
+            PublicationTrace.id.not_in(keep_ids.scalar_subquery())
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        return True
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error al guardar la traza {trace.run_id}: {str(e)}")
+        return False
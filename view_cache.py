@@ -0,0 +1,123 @@
+import functools
+import hashlib
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+from flask import make_response, request, session
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+class MemoryCache:
+    """Backend en memoria del proceso. Cualquier objeto con get/set/clear sirve como alternativa"""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._data.get(key)
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class ViewCache:
+    """Caché de páginas renderizadas con invalidación por eventos y GET condicional.
+
+    Las entradas se invalidan al escribir en los modelos observados (historial,
+    cuentas, cola) y caducan tras VIEW_CACHE_TTL segundos para recoger los datos
+    que dependen de la hora (p. ej. publicaciones del mes).
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or MemoryCache()
+        self.ttl = 30
+        self.enabled = True
+        self.watched_tables = set()
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app, models):
+        self.ttl = app.config.get('VIEW_CACHE_TTL', self.ttl)
+        self.enabled = self.ttl > 0
+        self.watched_tables = {model.__table__.name for model in models}
+        event.listen(Session, 'after_flush', self._after_flush)
+        event.listen(Session, 'do_orm_execute', self._do_orm_execute)
+
+    def invalidate(self, reason=None):
+        with self._lock:
+            self._version += 1
+        self.backend.clear()
+        logging.debug(f"Caché de vistas invalidada ({reason})")
+
+    def _after_flush(self, session, flush_context):
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            table = getattr(obj, '__table__', None)
+            if table is not None and table.name in self.watched_tables:
+                self.invalidate(table.name)
+                return
+
+    def _do_orm_execute(self, orm_execute_state):
+        # query.update()/query.delete() no pasan por el flush
+        if orm_execute_state.is_update or orm_execute_state.is_delete:
+            mapper = orm_execute_state.bind_mapper
+            if mapper is not None and mapper.local_table.name in self.watched_tables:
+                self.invalidate(mapper.local_table.name)
+
+    def _key(self):
+        user_id = current_user.get_id() if current_user.is_authenticated else None
+        return f"{request.endpoint}|{request.full_path}|{user_id}"
+
+    def cached(self, view):
+        """Decorador para vistas GET cuyo HTML solo depende del usuario y de la URL"""
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            # Las páginas con mensajes flash pendientes no se sirven ni se guardan en caché
+            if not self.enabled or request.method != 'GET' or session.get('_flashes'):
+                return view(*args, **kwargs)
+
+            key = self._key()
+            entry = self.backend.get(key)
+            if entry is None or entry['version'] != self._version or entry['expires_at'] < time.monotonic():
+                version = self._version
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                body = response.get_data()
+                entry = {
+                    'body': body,
+                    'mimetype': response.mimetype,
+                    'etag': hashlib.sha1(body).hexdigest(),
+                    'last_modified': datetime.now(timezone.utc).replace(microsecond=0),
+                    'expires_at': time.monotonic() + self.ttl,
+                    'version': version,
+                }
+                self.backend.set(key, entry)
+
+            response = make_response(entry['body'])
+            response.mimetype = entry['mimetype']
+            response.set_etag(entry['etag'])
+            response.last_modified = entry['last_modified']
+            # El navegador (o la sonda) debe revalidar siempre; la respuesta será un 304 si no cambió
+            response.cache_control.no_cache = True
+            if current_user.is_authenticated:
+                response.cache_control.private = True
+            else:
+                response.cache_control.public = True
+            return response.make_conditional(request)
+
+        return wrapper
+
+
+view_cache = ViewCache()